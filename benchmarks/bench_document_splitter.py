@@ -0,0 +1,45 @@
+"""Throughput of split_document on large documents.
+
+python benchmarks/bench_document_splitter.py --megabytes 4
+"""
+import random
+import time
+
+import click
+
+from minichain.utils.document_splitter import split_document
+from minichain.utils.tokens import get_encoding
+
+
+def make_document(num_chars, seed=0):
+    """Paragraphs of sentences, plus some long lines without separators like minified code"""
+    rng = random.Random(seed)
+    vocabulary = [f"word{i}" for i in range(5000)]
+    paragraphs, length = [], 0
+    while length < num_chars:
+        if rng.random() < 0.02:
+            paragraph = "".join(rng.choice(vocabulary) for _ in range(2000))
+        else:
+            sentences = [" ".join(rng.choices(vocabulary, k=rng.randint(5, 30))) + rng.choice([".", "?", "!"]) for _ in range(rng.randint(1, 10))]
+            paragraph = "\n".join(" ".join(sentences[i : i + 3]) for i in range(0, len(sentences), 3))
+        paragraphs.append(paragraph)
+        length += len(paragraph) + 2
+    return "\n\n".join(paragraphs)
+
+
+@click.command()
+@click.option("--megabytes", default=1.0)
+@click.option("--tokens", default=1000)
+@click.option("--overlap", default=100)
+def main(megabytes, tokens, overlap):
+    document = make_document(int(megabytes * 2**20))
+    # load the encoding before timing
+    get_encoding()
+    start = time.perf_counter()
+    chunks = split_document(document, tokens=tokens, overlap=overlap)
+    duration = time.perf_counter() - start
+    print(f"{len(document) / 2**20:.1f}MB -> {len(chunks)} chunks in {duration:.2f}s ({len(document) / 2**20 / duration:.1f}MB/s)")
+
+
+if __name__ == "__main__":
+    main()
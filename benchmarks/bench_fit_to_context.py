@@ -0,0 +1,51 @@
+"""Per-turn overhead of Conversation.fit_to_context on long conversations.
+
+python benchmarks/bench_fit_to_context.py --num-messages 500
+"""
+import asyncio
+import contextlib
+import io
+import tempfile
+import time
+
+import click
+
+from minichain.dtypes import AssistantMessage, UserMessage
+from minichain.message_handler import MessageDB
+
+
+async def run(num_messages, message_words, context_size, turns):
+    with tempfile.TemporaryDirectory() as save_dir:
+        message_db = MessageDB(save_dir=save_dir)
+        conversation = await message_db.conversation(context_size=context_size)
+        functions = [{"name": f"function_{i}", "description": "does something " * 20, "parameters": {}} for i in range(10)]
+        text = " ".join(f"word{i}" for i in range(message_words))
+        # messages and to_memory print a lot
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i in range(num_messages):
+                message = UserMessage(text) if i % 2 == 0 else AssistantMessage(text)
+                await conversation.send(message)
+            start = time.perf_counter()
+            history = await conversation.fit_to_context(functions)
+            first = time.perf_counter() - start
+            durations = []
+            for i in range(turns):
+                await conversation.send(UserMessage(text))
+                start = time.perf_counter()
+                await conversation.fit_to_context(functions)
+                durations.append(time.perf_counter() - start)
+    print(f"messages: {num_messages}, in context: {len(history)}")
+    print(f"first fit: {first * 1000:.1f}ms, per turn: {sum(durations) / len(durations) * 1000:.2f}ms")
+
+
+@click.command()
+@click.option("--num-messages", default=500)
+@click.option("--message-words", default=50)
+@click.option("--context-size", default=8192)
+@click.option("--turns", default=20)
+def main(num_messages, message_words, context_size, turns):
+    asyncio.run(run(num_messages, message_words, context_size, turns))
+
+
+if __name__ == "__main__":
+    main()
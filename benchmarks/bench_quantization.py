@@ -0,0 +1,54 @@
+"""Resident memory, recall@k and latency of quantized VectorDB search compared to exact float32 search.
+
+python benchmarks/bench_quantization.py --num-keys 100000 --dim 1536
+"""
+import tempfile
+
+import click
+import numpy as np
+
+from bench_vector_index import clustered_embeddings, fill, timed_search
+from minichain.memory import VectorDB
+from minichain.utils.quantization import quantizers
+
+
+def saved_and_loaded(vector_db, memory_dir, quantizer=None):
+    """Returns a VectorDB that memory-maps the rows of `vector_db`, as after a restart"""
+    vector_db.save(memory_dir)
+    values = {value.id: value for value in vector_db.values.values()}
+    restored = VectorDB(embedding_function=None, quantizer=quantizer)
+    restored.load(memory_dir, values.get)
+    return restored
+
+
+@click.command()
+@click.option("--num-keys", default=100000)
+@click.option("--dim", default=1536)
+@click.option("--num-queries", default=200)
+@click.option("--k", default=10)
+@click.option("--rerank-factor", default=4)
+def main(num_keys, dim, num_queries, k, rerank_factor):
+    embeddings = clustered_embeddings(num_keys + num_queries, dim)
+    embeddings, queries = embeddings[:num_keys], embeddings[num_keys:]
+    vector_db = VectorDB(embedding_function=None)
+    fill(vector_db, embeddings)
+    expected, exact_latency = timed_search(vector_db, queries, k)
+    print(f"float64 dict (before VectorDB): {num_keys * dim * 8 / 2**20:.0f} MiB")
+    print(f"float32 rows: {num_keys * dim * 4 / 2**20:.0f} MiB in RAM, {exact_latency * 1000:.2f} ms/query")
+
+    with tempfile.TemporaryDirectory() as memory_dir:
+        for name, quantizer_class in quantizers.items():
+            if quantizer_class is None:
+                continue
+            quantized = saved_and_loaded(vector_db, memory_dir, quantizer_class())
+            quantized.rerank_factor = rerank_factor
+            found, latency = timed_search(quantized, queries, k)
+            recall = np.mean([len(set(a) & set(b)) / len(b) for a, b in zip(found, expected)])
+            print(
+                f"{name}: {quantized.quantizer.nbytes / 2**20:.0f} MiB in RAM, "
+                f"recall@{k}={recall:.3f}, {latency * 1000:.2f} ms/query"
+            )
+
+
+if __name__ == "__main__":
+    main()
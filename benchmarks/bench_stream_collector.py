@@ -0,0 +1,57 @@
+"""Time to stream a long message through a StreamCollector, compared to merging every chunk into the message.
+
+python benchmarks/bench_stream_collector.py --megabytes 1
+"""
+import asyncio
+import time
+
+import click
+
+from minichain.message_handler import StreamCollector, do_nothing, nested
+
+
+async def stream(collector, chunks):
+    for i, chunk in enumerate(chunks):
+        if i % 2 == 0:
+            await collector.chunk(chunk)
+        else:
+            await collector.chunk({"function_call": {"arguments": chunk}})
+    await collector.flush()
+    return collector.current_message
+
+
+def merge_every_chunk(chunks):
+    message = {}
+    for i, chunk in enumerate(chunks):
+        nested("add", message, {"content": chunk} if i % 2 == 0 else {"function_call": {"arguments": chunk}})
+    return message
+
+
+@click.command()
+@click.option("--megabytes", default=1.0)
+@click.option("--chunk-size", default=4, help="Characters per chunk, LLM streams send about one token per chunk")
+@click.option("--coalesce-window", default=0.0, help="Seconds in which chunks are merged into one frame, 0 sends every chunk")
+def main(megabytes, chunk_size, coalesce_window):
+    text = "x" * int(megabytes * 2**20)
+    chunks = [text[i : i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+    start = time.perf_counter()
+    shared = {
+        "on_message": do_nothing,
+        "coalesce": (coalesce_window, 16384),
+        "stream_stats": {"chunks": 0, "frames": 0},
+    }
+    message = asyncio.run(stream(StreamCollector(shared=shared), chunks))
+    collector_duration = time.perf_counter() - start
+
+    start = time.perf_counter()
+    expected = merge_every_chunk(chunks)
+    merge_duration = time.perf_counter() - start
+
+    assert message == expected
+    print(f"{len(chunks)} chunks, {megabytes:.1f}MB, {shared['stream_stats']['frames']} frames sent")
+    print(f"StreamCollector: {collector_duration:.2f}s, merging every chunk: {merge_duration:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
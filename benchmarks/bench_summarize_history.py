@@ -0,0 +1,55 @@
+"""Bookkeeping overhead of get_summarized_history on long histories. The LLM call is replaced by a stub that
+summarizes each chunk as one short message, so only the token counting and chunk selection are timed.
+
+python benchmarks/bench_summarize_history.py --num-messages 2000
+"""
+import asyncio
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+import click
+
+from minichain.utils import summarize_history
+from minichain.utils.tokens import get_encoding
+
+
+async def summarize_chunk(history):
+    return [{"role": "assistant", "content": f"(summarized):\n{len(history)} messages"}]
+
+
+async def run(num_messages, message_words, max_tokens):
+    text = " ".join(f"word{i}" for i in range(message_words))
+    messages = [{"role": "system", "content": "You are a helpful assistant."}] + [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"{i}: {text}"} for i in range(num_messages)
+    ]
+    summarize_history.summarize_chunk = summarize_chunk
+    # load the encoding before timing
+    get_encoding()
+    with tempfile.TemporaryDirectory() as work_dir:
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        os.makedirs(".minichain")
+        try:
+            # get_summarized_history prints every step
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                summarized = await summarize_history.get_summarized_history(messages, [], max_tokens=max_tokens)
+                duration = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+    print(f"messages: {len(messages)} -> {len(summarized)} in {duration * 1000:.1f}ms")
+
+
+@click.command()
+@click.option("--num-messages", default=2000)
+@click.option("--message-words", default=50)
+@click.option("--max-tokens", default=6000)
+def main(num_messages, message_words, max_tokens):
+    asyncio.run(run(num_messages, message_words, max_tokens))
+
+
+if __name__ == "__main__":
+    main()
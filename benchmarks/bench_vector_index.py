@@ -0,0 +1,68 @@
+"""Recall@k and latency of the approximate VectorDB index compared to exact search.
+
+python benchmarks/bench_vector_index.py --num-keys 100000 --dim 1536
+"""
+import contextlib
+import io
+import time
+from types import SimpleNamespace
+
+import click
+import numpy as np
+
+from minichain.memory import VectorDB
+from minichain.utils.vector_index import IVFFlatIndex
+
+
+def clustered_embeddings(num_keys, dim, num_clusters=1000, noise=1.5, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(num_clusters, dim))
+    vectors = centers[rng.integers(num_clusters, size=num_keys)] + noise * rng.normal(size=(num_keys, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def fill(vector_db, embeddings):
+    keys = {str(i): embedding for i, embedding in enumerate(embeddings)}
+    values = {str(i): SimpleNamespace(id=i, memory=SimpleNamespace(title=str(i))) for i in range(len(embeddings))}
+    vector_db.set_items(keys, values)
+
+
+def timed_search(vector_db, queries, k):
+    results, start = [], time.perf_counter()
+    # VectorDB.search prints every match
+    with contextlib.redirect_stdout(io.StringIO()):
+        for query in queries:
+            embedding = query[None]
+            results.append([i.value.id for i in vector_db._search(["query"], embedding, k)])
+    return results, (time.perf_counter() - start) / len(queries)
+
+
+@click.command()
+@click.option("--num-keys", default=100000)
+@click.option("--dim", default=1536)
+@click.option("--num-queries", default=200)
+@click.option("--k", default=10)
+@click.option("--nprobe", "nprobes", multiple=True, default=[1, 4, 8, 16, 32])
+def main(num_keys, dim, num_queries, k, nprobes):
+    embeddings = clustered_embeddings(num_keys + num_queries, dim)
+    embeddings, queries = embeddings[:num_keys], embeddings[num_keys:]
+
+    exact = VectorDB(embedding_function=None)
+    fill(exact, embeddings)
+    expected, exact_latency = timed_search(exact, queries, k)
+    print(f"exact: {exact_latency * 1000:.2f} ms/query")
+
+    index = IVFFlatIndex(exact_search_threshold=0)
+    approximate = VectorDB(embedding_function=None, index=index)
+    start = time.perf_counter()
+    fill(approximate, embeddings)
+    print(f"ivf: built {len(index.centroids)} lists in {time.perf_counter() - start:.1f}s")
+    for nprobe in nprobes:
+        index.nprobe = nprobe
+        found, latency = timed_search(approximate, queries, k)
+        recall = np.mean([len(set(a) & set(b)) / len(b) for a, b in zip(found, expected)])
+        print(f"ivf nprobe={nprobe}: recall@{k}={recall:.3f}, {latency * 1000:.2f} ms/query ({exact_latency / latency:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -404,20 +404,58 @@ function AuthorizedChatApp({token, backend, ws_backend}) {
             });
 
 
-        const client = new W3CWebSocket(`${ws_backend}/ws/${path[path.length - 1]}`);
-        client.onopen = () => {
-            console.log('WebSocket Client Connected');
-            setMessages([]);
-            setStreamingState({
-                messages: {},
-                sortedIds: []
-            });
-            // send token as first message
-            client.send(token);
+        // the server numbers all events. When we reconnect, we send the last number we have seen and
+        // only get the events we missed - unless the server restarted (new epoch) or no longer has them
+        let lastSeenSeq = null;
+        let epoch = null;
+        let client = null;
+        let closedByUs = false;
+        let reconnectDelay = 500;
+
+        const connect = () => {
+            client = new W3CWebSocket(`${ws_backend}/ws/${path[path.length - 1]}`);
+            client.onopen = () => {
+                console.log('WebSocket Client Connected');
+                reconnectDelay = 500;
+                // send the token and the last seen event as first message
+                client.send(JSON.stringify({
+                    token: token,
+                    last_seen_seq: lastSeenSeq,
+                    epoch: epoch
+                }));
+            };
+            client.onmessage = onMessage;
+            client.onclose = () => {
+                console.log('WebSocket Client Closed');
+                if (!closedByUs) {
+                    setTimeout(connect, reconnectDelay);
+                    reconnectDelay = Math.min(reconnectDelay * 2, 10000);
+                }
+            }
+            client.onerror = (e) => {
+                console.error('WebSocket error', e);
+            }
         };
 
-        client.onmessage = (messageRaw) => {
+        const onMessage = (messageRaw) => {
             const message = JSON.parse(messageRaw.data);
+            if (message.type === "sync") {
+                epoch = message.epoch;
+                if (message.full) {
+                    // the server sends the current state of all messages, as of message.seq
+                    lastSeenSeq = message.seq;
+                    setMessages([]);
+                    setStreamingState({
+                        messages: {},
+                        sortedIds: []
+                    });
+                }
+                return;
+            }
+            // otherwise the missed events follow, and only the events that arrived count as seen
+            if (message.seq !== undefined) {
+                lastSeenSeq = message.seq;
+            }
             /**
 
             {
@@ -498,13 +536,9 @@ function AuthorizedChatApp({token, backend, ws_backend}) {
             }
         };
 
-        client.onclose = () => {
-            console.log('WebSocket Client Closed');
-        }
-        client.onerror = (e) => {
-            console.error('WebSocket error', e);
-        }
+        connect();
         return () => {
+            closedByUs = true;
             client.close();
         }
     }, [path, token, backend, ws_backend]);
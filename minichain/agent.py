@@ -7,6 +7,7 @@ from minichain.dtypes import (SystemMessage, UserMessage, ExceptionForAgent,
 from minichain.functions import Function
 from minichain.schemas import DefaultResponse, DefaultQuery
 from minichain.message_handler import MessageDB, Conversation
+from minichain.utils.cache_keys import FunctionSchemas
 from minichain.utils.cached_openai import get_openai_response_stream
 
 
@@ -68,7 +69,11 @@ class Agent:
 
     @property
     def functions_openai(self):
-        return [i.openapi_json for i in self.functions]
+        # the schemas (and their cache key) are only recomputed when the functions change
+        functions = tuple(self.functions)
+        if getattr(self, "_functions_openai", (None, None))[0] != functions:
+            self._functions_openai = (functions, FunctionSchemas([i.openapi_json for i in functions]))
+        return self._functions_openai[1]
     
     async def before_run(self, conversation=None, **arguments):
         """Hook for subclasses to run code before the run method is called."""
@@ -168,7 +173,7 @@ class Session:
                 await self.conversation.send(UserMessage(msg))
 
     async def get_next_action(self):
-        history = await self.conversation.fit_to_context()
+        history = await self.conversation.fit_to_context(self.agent.functions_openai)
         # do the openai call
         async with self.conversation.to(AssistantMessage()) as message_handler:
             llm_response = await get_openai_response_stream(
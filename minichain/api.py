@@ -15,7 +15,6 @@ import click
 from minichain.dtypes import ConsumerClosed, FunctionCall, UserMessage
 from minichain.functions import tool
 from minichain.message_handler import MessageDB
-from minichain.utils.json_datetime import datetime_converter
 from minichain.auth import get_token_payload, get_token_payload_or_none, create_access_token
 from minichain import settings
 
@@ -98,6 +97,14 @@ async def get_agents(token_payload: dict = Depends(get_token_payload)):
     return list(agents.keys())
 
 
+@app.get("/stats/streaming")
+async def get_streaming_stats(token_payload: dict = Depends(get_token_payload)):
+    return {
+        "chunks": message_db.stream_stats(),
+        "consumers": message_db.consumer_stats(),
+    }
+
+
 @app.get("/byagent/{agent}")
 async def get_conversations_by_agent(agent: str, token_payload: dict = Depends(get_token_payload)):
     if "root" not in token_payload['scopes']:
@@ -327,11 +334,14 @@ async def create_workspace(workspace: Workspace):
 async def websocket_endpoint(websocket: WebSocket, conversation_id: str):
     await websocket.accept()
     print("websocket accepted")
-    # wait for the token
+    # wait for the handshake: {"token", "last_seen_seq", "epoch"}, or only the token
     try:
-        token = await websocket.receive_text()
-        print("websocket token", token)
-        token_payload = get_token_payload(token)
+        handshake = await websocket.receive_text()
+        try:
+            handshake = json.loads(handshake)
+        except ValueError:
+            handshake = {"token": handshake}
+        token_payload = get_token_payload(handshake["token"])
         print("websocket token_payload", token_payload)
     except Exception as e:
         print("websocket error", e)
@@ -341,33 +351,42 @@ async def websocket_endpoint(websocket: WebSocket, conversation_id: str):
         await websocket.close()
         return
 
-    async def send_to_websocket(message):
-        message = json.loads(json.dumps(message, default=datetime_converter))
+    async def send_to_websocket(text):
+        """Sends an event that is already encoded as JSON"""
         try:
-            await websocket.send_json(message)
+            await websocket.send_text(text)
         except Exception as e:
             print("websocket error", e)
             raise ConsumerClosed()
-        
-    conversation = message_db.get(conversation_id)
-    for message in conversation.messages:
-        await send_to_websocket({
-            "type": "set",
-            "chat": message.chat,
-            "meta": message.meta,
-            "id": message.path[-1],
-            "path": message.path,
-        })
-    
-    message_db.add_consumer(send_to_websocket, conversation_id)
-
-    # avoid closing the websocket
-    while True:
-        await asyncio.sleep(1)
-        if websocket.client_state == 3:
-            print("websocket closed")
-            break
-    
+
+    consumer = message_db.subscribe(
+        send_to_websocket,
+        conversation_id,
+        last_seen_seq=handshake.get("last_seen_seq"),
+        epoch=handshake.get("epoch"),
+    )
+
+    async def wait_for_disconnect():
+        try:
+            while (await websocket.receive())["type"] != "websocket.disconnect":
+                pass
+        except Exception as e:
+            print("websocket error", e)
+
+    # keep the websocket open until the client disconnects or the consumer is closed
+    disconnected = asyncio.ensure_future(wait_for_disconnect())
+    consumer_closed = asyncio.ensure_future(consumer.wait_closed())
+    await asyncio.wait([disconnected, consumer_closed], return_when=asyncio.FIRST_COMPLETED)
+    client_left = disconnected.done()
+    disconnected.cancel()
+    consumer_closed.cancel()
+    consumer.close()
+    if client_left:
+        print("websocket closed")
+    else:
+        # the client was too slow, see the consumer_overflow setting
+        print("websocket consumer disconnected")
+        await websocket.close()
 
 
 @app.on_event("startup")
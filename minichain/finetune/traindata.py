@@ -1,26 +1,14 @@
+import json
 import os
 import pickle
+import re
+from multiprocessing import Pool
 
-import pandas as pd
+import click
 
-
-def get_all_cached_examples(cache_path=".cache"):
-    data = []
-
-    keys = [
-        "disk_cache_object",
-        "disk_cache_args",
-        "disk_cache_kwargs",
-    ]
-    for file in os.listdir(cache_path):
-        if file.endswith(".pkl"):
-            with open(os.path.join(cache_path, file), "rb") as f:
-                i = pickle.load(f)
-                if isinstance(i, dict) and all(k in i for k in keys):
-                    for k, v in i["disk_cache_kwargs"].items():
-                        i[k] = v
-                    data.append(i)
-    return pd.DataFrame(data)
+from minichain.utils.cache_keys import ChatHistoryRef
+from minichain.utils.cache_store import SQLiteStore
+from minichain.utils.disk_cache import restore_args
 
 
 def find_all_caches(root="."):
@@ -29,51 +17,140 @@ def find_all_caches(root="."):
             yield os.path.join(root, ".cache")
 
 
-def extract_all_conversations(df):
-    conversations = []
-    for _, row in df.iterrows():
-        try:
-            history = row.disk_cache_args[0]
-            messages = [i.dict() for i in history]
-            functions = row.disk_cache_args[1]
-            response = row.disk_cache_object
-            conversations.append(
-                {
-                    "history": messages,
-                    "functions": functions,
-                    "response": response,
-                    "num_messages": len(messages),
-                }
-            )
-        except Exception as e:
-            print(e)
-            # # breakpoint()
-            pass
-    return conversations
+def key_ranges(prefix_length):
+    """Split the sha256 hex key space into 16**prefix_length ranges. The ranges do not depend on the
+    content of a cache, so an interrupted export can be resumed even if the cache has grown"""
+    num_ranges = 16**prefix_length
+    for i in range(num_ranges):
+        start = format(i, f"0{prefix_length}x")
+        # 'g' sorts after all hex digits
+        stop = format(i + 1, f"0{prefix_length}x") if i + 1 < num_ranges else "g"
+        yield start, stop
 
 
-if __name__ == "__main__":
-    dfs = []
-    for cache_path in find_all_caches():
+def to_conversation(entry, store=None, dedupe=True):
+    """Turns a cached get_openai_response_stream call into a train example, or returns None.
+
+    If `dedupe` is set, calls whose history is continued by a longer cached history are skipped: the longer
+    conversation contains them already. This needs the chain tables of `store`, so entries of caches written
+    before histories were stored as chains are always kept.
+    """
+    if not isinstance(entry, dict) or "disk_cache_args" not in entry:
+        return None
+    args = entry["disk_cache_args"]
+    if len(args) < 2:
+        return None
+    if store is not None and isinstance(args[0], ChatHistoryRef):
+        if dedupe and store.is_extended(args[0].head):
+            return None
+        args = restore_args(store, args)
+    history = [i.dict() if hasattr(i, "dict") else i for i in args[0]]
+    return {
+        "history": history,
+        "functions": list(args[1]),
+        "response": entry["disk_cache_object"],
+        "model": entry.get("disk_cache_kwargs", {}).get("model", "gpt-4-0613"),
+        "num_messages": len(history),
+    }
+
+
+def matches(conversation, model=None, agent=None):
+    """`model` is compared to the model of the call. Cache entries do not know their agent, so `agent` is a
+    regex that is searched in the system message"""
+    if model is not None and conversation["model"] != model:
+        return False
+    if agent is not None:
+        system_message = next((i for i in conversation["history"] if i.get("role") == "system"), None)
+        if system_message is None or not re.search(agent, system_message.get("content") or ""):
+            return False
+    return True
+
+
+def export_range(task):
+    """Writes the conversations of one key range of one cache to a shard. Runs in a worker process"""
+    cache_path, start, stop, shard_path, filters, legacy_paths = task
+    store = None
+    entries = []
+    if os.path.exists(os.path.join(cache_path, "cache.db")):
+        store = SQLiteStore(os.path.join(cache_path, "cache.db"))
+        entries = (pickle.loads(value) for _, value in store.items_in_range(start, stop))
+    written = 0
+    with open(shard_path + ".tmp", "w") as f:
+        for entry in entries:
+            conversation = to_conversation(entry, store, dedupe=filters["dedupe"])
+            if conversation is None or not matches(conversation, filters["model"], filters["agent"]):
+                continue
+            f.write(json.dumps(conversation, default=str) + "\n")
+            written += 1
+        # caches that have not been migrated yet
+        for path in legacy_paths:
+            try:
+                with open(path, "rb") as cached:
+                    conversation = to_conversation(pickle.load(cached))
+            except Exception as e:
+                print(path, e)
+                continue
+            if conversation is None or not matches(conversation, filters["model"], filters["agent"]):
+                continue
+            f.write(json.dumps(conversation, default=str) + "\n")
+            written += 1
+    # the shard only appears once it is complete, so that resuming redoes interrupted ranges
+    os.replace(shard_path + ".tmp", shard_path)
+    return written
+
+
+def legacy_files(cache_path, prefix_length):
+    """The .pkl files of a cache that was not migrated yet, by the key prefix of their key range"""
+    files = {}
+    for entry in os.scandir(cache_path):
+        if entry.name.endswith(".pkl"):
+            files.setdefault(entry.name[:prefix_length], []).append(entry.path)
+    return files
+
+
+def export_conversations(cache_paths, out_dir, model=None, agent=None, dedupe=True, workers=None, prefix_length=2):
+    """Streams the cached LLM calls of all caches into jsonl shards in `out_dir`, one per cache and key range.
+
+    Key ranges are exported in a process pool and only one range per worker is in memory at a time. Shards
+    that already exist are skipped, so rerunning an interrupted export resumes it.
+    Returns the number of conversations written in this run.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    filters = {"model": model, "agent": agent, "dedupe": dedupe}
+    tasks = []
+    for cache_index, cache_path in enumerate(cache_paths):
+        # scanned once per cache, not once per key range
+        legacy_paths = legacy_files(cache_path, prefix_length)
+        if len(legacy_paths) == 0 and not os.path.exists(os.path.join(cache_path, "cache.db")):
+            continue
+        for start, stop in key_ranges(prefix_length):
+            shard_path = os.path.join(out_dir, f"cache-{cache_index}-{start}.jsonl")
+            if not os.path.exists(shard_path):
+                tasks.append((cache_path, start, stop, shard_path, filters, legacy_paths.get(start, [])))
+    with open(os.path.join(out_dir, "caches.json"), "w") as f:
+        json.dump(list(cache_paths), f, indent=2)
+    written = 0
+    with Pool(workers) as pool:
+        for count in pool.imap_unordered(export_range, tasks):
+            written += count
+    return written
+
+
+@click.command()
+@click.argument("out_dir")
+@click.option("--root", default=".", help="Directory that is searched for .cache directories")
+@click.option("--model", default=None, help="Only export calls to this model")
+@click.option("--agent", default=None, help="Only export calls whose system message matches this regex")
+@click.option("--keep-prefixes", is_flag=True, help="Also export calls that are continued by a longer conversation")
+@click.option("--workers", default=None, type=int)
+def main(out_dir, root, model, agent, keep_prefixes, workers):
+    # the order of the caches must be stable for resuming
+    cache_paths = sorted(find_all_caches(root))
+    for cache_path in cache_paths:
         print(cache_path)
-        try:
-            df = get_all_cached_examples(cache_path)
-            print(df.info())
-            print(df.head())
-            print(df.describe())
-            dfs.append(df)
-        except Exception as e:
-            print(e)
-            print("-" * 100)
-    df = pd.concat(dfs)
-    print(df.info())
-
-    conversations = extract_all_conversations(df)
-    num_messages = sum(i["num_messages"] for i in conversations)
-
-    # breakpoint()
-    # df = get_all_cached_examples()
-    # print(df.info())
-    # print(df.head())
-    # print(df.describe())
-    # # breakpoint()
+    written = export_conversations(cache_paths, out_dir, model=model, agent=agent, dedupe=not keep_prefixes, workers=workers)
+    print(f"Exported {written} conversations to {out_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,15 +5,21 @@ from dataclasses import dataclass
 from typing import Any, List, Optional
 import uuid
 import hashlib
+import threading
 
 import numpy as np
 from pydantic import BaseModel, Field
 
+from minichain import settings
 from minichain.functions import tool
 from minichain.tools.codebase import get_visible_files, open_or_search_file
 from minichain.tools.text_to_memory import MemoryWithMeta, text_to_memory, text_to_single_memory
-from minichain.utils.cached_openai import get_embedding
+from minichain.utils.cached_openai import get_embedding, get_embeddings
 from minichain.utils.json_datetime import datetime_parser, datetime_converter
+from minichain.utils.lexical_index import BM25Index, reciprocal_rank_fusion
+from minichain.utils.local_embedding import get_embedder
+from minichain.utils.quantization import get_quantizer
+from minichain.utils.vector_index import get_index
 
 
 snippet_template = """## {title}
@@ -30,63 +36,571 @@ class VectorSearchScore:
     value: Any
 
 
+class _Rows:
+    """Read access to the memory-mapped rows followed by the rows in RAM, like one matrix"""
+    def __init__(self, base, tail, size):
+        self.base = base
+        self.tail = tail
+        self.num_base = 0 if base is None else len(base)
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, rows):
+        if isinstance(rows, slice):
+            rows = np.arange(*rows.indices(self.size))
+        rows = np.asarray(rows)
+        in_base = rows < self.num_base
+        if in_base.all():
+            return np.asarray(self.base[rows]) if len(rows) > 0 else np.zeros((0, self.dim), dtype=np.float32)
+        if not in_base.any():
+            return self.tail[rows - self.num_base]
+        gathered = np.empty((len(rows), self.dim), dtype=np.float32)
+        gathered[in_base] = self.base[rows[in_base]]
+        gathered[~in_base] = self.tail[rows[~in_base] - self.num_base]
+        return gathered
+
+    @property
+    def dim(self):
+        return (self.base if self.base is not None else self.tail).shape[1]
+
+    def dot(self, query):
+        scores = [np.dot(segment, query) for segment in [
+            self.base, None if self.tail is None else self.tail[:self.size - self.num_base]
+        ] if segment is not None]
+        return np.concatenate(scores) if len(scores) > 1 else scores[0]
+
+
+class _Partition:
+    """Growable array of the rows that have one label"""
+    def __init__(self):
+        self._rows = np.zeros(16, dtype=np.int64)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, row):
+        if self._size == len(self._rows):
+            self._rows = np.concatenate([self._rows, np.zeros(self._size, dtype=np.int64)])
+        self._rows[self._size] = row
+        self._size += 1
+
+    def rows(self):
+        return self._rows[:self._size]
+
+
+class EmbedderMismatch(ValueError):
+    """The saved embeddings were computed by another embedder than the one of the VectorDB"""
+
+
 class VectorDB:
-    def __init__(self, embedding_function=get_embedding):
-        self.values = {}
-        self.keys = {}
+    """Stores embeddings as float32 rows.
+
+    Rows that were loaded from disk are memory-mapped, new rows are appended to a preallocated matrix
+    that grows by doubling. `_row_value` maps each row to a slot in `_values`, and `_value_slot` maps
+    value ids to slots, so search is a single matmul. `_value_rows` maps value ids to their rows, so
+    removing a value does not scan the store. Removed rows are tombstoned via `_alive`, and dropped from
+    RAM once they outnumber the remaining rows in RAM.
+    An optional `index` (see minichain.utils.vector_index) restricts the rows a query is compared with.
+
+    An optional `quantizer` (see minichain.utils.quantization) keeps compact codes of all rows in RAM: queries
+    are first scored against the codes, and the best `rerank_factor * num_results` rows are re-scored with
+    the full-precision rows, so memory-mapped rows are mostly not read. Rows that were added since the
+    store was loaded are kept in float32 in RAM next to their codes, because the re-ranking needs them and
+    the saved rows are only memory-mapped on the next load. The quantizer saves RAM for the loaded rows.
+
+    `partition_by` maps partition names to functions that label a value, e.g. {"type": lambda v: v.memory.type}.
+    Rows are grouped by their labels, so `search(..., where={"type": "content"})` only scores matching rows.
+
+    On disk, `save` appends new rows to a raw float32 file and their keys to a jsonl log, deletions are
+    appended to the log as tombstones. `compact_files` rewrites both without the deleted entries.
+    The manifest records `embedder_id` (by default the `id` of the embedding function), and embeddings of
+    another embedder are not loaded or appended to.
+    """
+    # removed rows in RAM are dropped when there are at least this many and more than remaining rows in RAM
+    compaction_min_dead = 1024
+
+    def __init__(self, embedding_function=get_embedding, batch_embedding_function=None, initial_capacity=1024, index=None, partition_by=None, quantizer=None, rerank_factor=4, embedder_id=None):
         self.embedding_function = embedding_function
+        if batch_embedding_function is None and embedding_function is get_embedding:
+            batch_embedding_function = get_embeddings
+        self.batch_embedding_function = batch_embedding_function
+        if embedder_id is None:
+            embedder_id = "openai:text-embedding-ada-002" if embedding_function is get_embedding else getattr(embedding_function, "id", None)
+        self.embedder_id = embedder_id
+        self._initial_capacity = initial_capacity
+        self.index = index
+        self.partition_by = partition_by or {}
+        self.quantizer = quantizer
+        self.rerank_factor = rerank_factor
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._base = None
+        self._vectors = None
+        self._row_value = np.zeros(0, dtype=np.int64)
+        self._alive = np.zeros(0, dtype=bool)
+        self._row_key = []
+        self._key_row = {}
+        self._values = []
+        self._value_slot = {}
+        self._value_rows = {}
+        self._dead_tail = 0
+        self._row_labels = {name: np.zeros(0, dtype=np.int32) for name in self.partition_by}
+        self._label_codes = {name: {} for name in self.partition_by}
+        self._partitions = {name: [] for name in self.partition_by}
+        self._size = 0
+        self._dim = None
+        # persistence: rows < _saved_rows and all deletions except _deleted_keys are on disk
+        self._save_dir = None
+        self._saved_rows = 0
+        self._deleted_keys = []
+        self._saved_index_size = 0
+        self._disk_records = 0
+        self._disk_dead = 0
+        if self.index is not None:
+            self.index.reset()
+        if self.quantizer is not None:
+            self.quantizer.reset()
+
+    def __len__(self):
+        return len(self._key_row)
 
     def encode(self, texts):
-        return np.array([self.embedding_function(text) for text in texts])
-    
-    def _dict_to_list(self, dict):
-        return [dict[key] for key in sorted(self.keys.keys())]
+        return np.array([self.embedding_function(text) for text in texts], dtype=np.float32)
+
+    async def encode_batch(self, texts):
+        """Encode all texts with as few embedding requests as possible"""
+        if self.batch_embedding_function is None:
+            return self.encode(texts)
+        return np.array(await self.batch_embedding_function(texts), dtype=np.float32)
+
+    def _rows(self):
+        return _Rows(self._base, self._vectors, self._size)
+
+    @property
+    def keys(self):
+        rows = self._rows()
+        return {key: rows[[row]][0] for key, row in self._key_row.items()}
+
+    @property
+    def values(self):
+        return {key: self._values[self._row_value[row]] for key, row in self._key_row.items()}
+
+    def set_items(self, keys, values, index_state=None):
+        """Replace the content with `keys` (hash -> embedding) and `values` (hash -> value)"""
+        self._reset()
+        for key_hash in sorted(keys.keys()):
+            self._insert(key_hash, keys[key_hash], values[key_hash], train=False)
+        self._load_index(index_state)
+
+    def _load_index(self, index_state=None):
+        if self.index is None:
+            return
+        if index_state is not None:
+            self.index.load_state_dict(index_state, self._rows(), self._alive[:self._size])
+        self._maybe_train()
+
+    def _maybe_train(self):
+        if self.index is not None and self.index.needs_training(len(self)):
+            self.index.train(self._rows(), self._alive[:self._size])
 
-    def search(self, query_questions, num_results=3) -> List[VectorSearchScore]:
-        if len(query_questions) == 0 or len(self.keys) == 0:
+    def _grow(self):
+        capacity = max(2 * len(self._row_value), self._initial_capacity)
+        self._row_value = np.concatenate([self._row_value, np.zeros(capacity - len(self._row_value), dtype=np.int64)])
+        self._alive = np.concatenate([self._alive, np.zeros(capacity - len(self._alive), dtype=bool)])
+        for name, labels in self._row_labels.items():
+            self._row_labels[name] = np.concatenate([labels, np.full(capacity - len(labels), -1, dtype=np.int32)])
+
+    def _grow_tail(self):
+        capacity = self._initial_capacity if self._vectors is None else 2 * len(self._vectors)
+        vectors = np.zeros((capacity, self._dim), dtype=np.float32)
+        if self._vectors is not None:
+            vectors[:len(self._vectors)] = self._vectors
+        self._vectors = vectors
+
+    def _assign(self, row, value):
+        slot = self._value_slot.get(value.id)
+        if slot is None:
+            slot = len(self._values)
+            self._values.append(value)
+            self._value_slot[value.id] = slot
+        else:
+            self._values[slot] = value
+        self._row_value[row] = slot
+        self._value_rows.setdefault(value.id, set()).add(row)
+        self._label(row, value)
+
+    def _label(self, row, value):
+        for name, partition_function in self.partition_by.items():
+            label = partition_function(value)
+            codes = self._label_codes[name]
+            if label not in codes:
+                codes[label] = len(codes)
+                self._partitions[name].append(_Partition())
+            self._row_labels[name][row] = codes[label]
+            self._partitions[name][codes[label]].append(row)
+
+    def _matching_rows(self, where):
+        """Returns the alive rows whose labels match `where` ({partition name: label or list of labels})"""
+        selections = []
+        for name, labels in where.items():
+            if not isinstance(labels, (list, tuple, set)):
+                labels = [labels]
+            codes = [self._label_codes[name][label] for label in labels if label in self._label_codes[name]]
+            selections.append((sum([len(self._partitions[name][code]) for code in codes]), name, codes))
+        # start with the smallest partition, so the cost is proportional to its size
+        selections.sort(key=lambda selection: selection[0])
+        _, name, codes = selections[0]
+        rows = np.concatenate([np.zeros(0, dtype=np.int64)] + [self._partitions[name][code].rows() for code in codes])
+        rows = rows[self._alive[rows]]
+        for _, name, codes in selections[1:]:
+            rows = rows[np.isin(self._row_labels[name][rows], codes)]
+        return rows
+
+    def _insert(self, key_hash, embedding, value, train=True):
+        if key_hash in self._key_row:
+            self._remove_rows([self._key_row[key_hash]])
+        if self._dim is None:
+            self._dim = len(embedding)
+        row = self._size
+        num_base = 0 if self._base is None else len(self._base)
+        if row == len(self._row_value):
+            self._grow()
+        if self._vectors is None or row - num_base == len(self._vectors):
+            self._grow_tail()
+        self._vectors[row - num_base] = embedding
+        self._assign(row, value)
+        self._alive[row] = True
+        self._row_key.append(key_hash)
+        self._key_row[key_hash] = row
+        self._size += 1
+        if self.quantizer is not None:
+            self.quantizer.add(row, self._vectors[row - num_base : row - num_base + 1])
+        if self.index is not None:
+            self.index.add(row, self._vectors[row - num_base])
+            if train:
+                self._maybe_train()
+
+    def _remove_rows(self, rows):
+        num_base = 0 if self._base is None else len(self._base)
+        for row in rows:
+            if not self._alive[row]:
+                continue
+            self._alive[row] = False
+            key_hash = self._row_key[row]
+            del self._key_row[key_hash]
+            if row < self._saved_rows:
+                # rows that are not saved yet need no tombstone
+                self._deleted_keys.append(key_hash)
+            slot = int(self._row_value[row])
+            value_id = self._values[slot].id
+            self._value_rows[value_id].discard(row)
+            if len(self._value_rows[value_id]) == 0:
+                del self._value_rows[value_id]
+                del self._value_slot[value_id]
+                self._values[slot] = None
+            if row >= num_base:
+                self._dead_tail += 1
+            if self.index is not None:
+                self.index.remove(row)
+        if self._dead_tail >= max(self.compaction_min_dead, self._size - num_base - self._dead_tail):
+            self._compact()
+
+    def _compact(self):
+        """Drop the removed rows that are in RAM. Memory-mapped rows are removed from disk by `compact_files`"""
+        num_base = 0 if self._base is None else len(self._base)
+        keep = np.ones(self._size, dtype=bool)
+        keep[num_base:] = self._alive[num_base:self._size]
+        size = int(keep.sum())
+        tail = self._vectors[:self._size - num_base][keep[num_base:]]
+        self._vectors[:len(tail)] = tail
+        self._row_value[:size] = self._row_value[:self._size][keep]
+        self._alive[:size] = self._alive[:self._size][keep]
+        self._alive[size:] = False
+        for labels in self._row_labels.values():
+            labels[:size] = labels[:self._size][keep]
+        self._row_key = [key for key, kept in zip(self._row_key, keep.tolist()) if kept]
+        alive_rows = np.nonzero(self._alive[:size])[0].tolist()
+        self._key_row = {self._row_key[row]: row for row in alive_rows}
+        self._value_rows = {}
+        for row in alive_rows:
+            self._value_rows.setdefault(self._values[self._row_value[row]].id, set()).add(row)
+        for name, labels in self._row_labels.items():
+            self._partitions[name] = [_Partition() for _ in self._label_codes[name]]
+            for row in alive_rows:
+                self._partitions[name][labels[row]].append(row)
+        self._saved_rows = int(keep[:self._saved_rows].sum())
+        self._size = size
+        self._dead_tail = 0
+        if self.quantizer is not None:
+            self.quantizer.compact(keep)
+        if self.index is not None:
+            self.index.compact(keep)
+
+    def search(self, query_questions, num_results=3, where=None) -> List[VectorSearchScore]:
+        if len(query_questions) == 0 or len(self) == 0:
             return []
-        query_embeddings = self.encode(query_questions)
-        K, V = self._dict_to_list(self.keys), self._dict_to_list(self.values)
-        scores = np.dot(query_embeddings, np.array(K).T)
-        selection = []
+        return self._search(query_questions, self.encode(query_questions), num_results, where)
+
+    async def asearch(self, query_questions, num_results=3, where=None) -> List[VectorSearchScore]:
+        if len(query_questions) == 0 or len(self) == 0:
+            return []
+        return self._search(query_questions, await self.encode_batch(query_questions), num_results, where)
+
+    def _search(self, query_questions, query_embeddings, num_results, where=None):
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+        vectors = self._rows()
+        alive = self._alive[:self._size]
+        matching = None if where is None else self._matching_rows(where)
+        if self.index is None or (matching is not None and len(matching) < self.index.exact_search_threshold):
+            candidates = [matching] * len(query_embeddings)
+        else:
+            candidates = self.index.candidates(query_embeddings, len(self))
+            if matching is not None:
+                is_matching = np.zeros(self._size, dtype=bool)
+                is_matching[matching] = True
+                candidates = [matching if rows is None else rows[is_matching[rows]] for rows in candidates]
         num_results = max(num_results // len(query_embeddings), 1)
-        for i in range(len(scores)):
-            indices = np.argsort(scores[i])[::-1][:num_results]
-            selection += [
-                VectorSearchScore(scores[i][j], V[j]) for j in indices
-            ]
-            # print what contributes to the score
+        selection = []
+        selected_ids = set()
+        first_pass = vectors if self.quantizer is None else self.quantizer
+        for i, rows in enumerate(candidates):
+            if rows is None:
+                rows = np.nonzero(alive)[0]
+                scores = first_pass.dot(query_embeddings[i])[rows]
+            else:
+                rows = rows[alive[rows]]
+                scores = np.dot(vectors[rows], query_embeddings[i]) if self.quantizer is None else self.quantizer.dot(query_embeddings[i], rows)
+            k = min(num_results, len(rows))
+            if k == 0:
+                continue
+            if self.quantizer is not None:
+                # re-rank the best rows of the first pass with the full-precision rows
+                shortlist = np.argpartition(-scores, min(self.rerank_factor * k, len(rows)) - 1)[:self.rerank_factor * k]
+                rows = rows[shortlist]
+                scores = np.dot(vectors[rows], query_embeddings[i])
+            indices = np.argpartition(-scores, k - 1)[:k]
+            indices = indices[np.argsort(-scores[indices])]
             for j in indices:
-                print(f"{query_questions[i]} -> {V[j].memory.title} ({scores[i][j]})")
-        # remove duplicates
-        deduplicated = []
-        deduplicated_keys = []
-        for i in selection:
-            if i.value.id not in deduplicated_keys:
-                deduplicated.append(i)
-                deduplicated_keys.append(i.value.id)
-        return deduplicated
+                value = self._values[self._row_value[rows[j]]]
+                # print what contributes to the score
+                print(f"{query_questions[i]} -> {value.memory.title} ({scores[j]})")
+                # remove duplicates
+                if value.id not in selected_ids:
+                    selected_ids.add(value.id)
+                    selection.append(VectorSearchScore(float(scores[j]), value))
+        return selection
 
     def add(self, key, value):
         key_embedding = self.encode([key])[0]
-        key_hash = hash_string(key)
-        self.keys[key_hash] = key_embedding
-        self.values[key_hash] = value
-    
+        self._insert(hash_string(key), key_embedding, value)
+
+    async def add_batch(self, items):
+        """Add a list of (key, value) pairs"""
+        if len(items) == 0:
+            return
+        key_embeddings = await self.encode_batch([key for key, _ in items])
+        for (key, value), key_embedding in zip(items, key_embeddings):
+            self._insert(hash_string(key), key_embedding, value)
+
     def remove_key(self, key):
-        key_hash = hash_string(key)
-        del self.keys[key_hash]
-        del self.values[key_hash]
-    
+        row = self._key_row[hash_string(key)]
+        self._remove_rows([row])
+
     def remove_value(self, value):
-        delete = []
-        for k, v in self.values.items():
-            if v.id == value.id:
-                delete += [k]
-        for k in delete:
-            del self.keys[k]
-            del self.values[k]
-    
+        self._remove_rows(list(self._value_rows.get(value.id, [])))
+
+    # Persistence
+    @staticmethod
+    def _paths(memory_dir, generation):
+        return (
+            os.path.join(memory_dir, f"vector_db_embeddings.{generation}.f32"),
+            os.path.join(memory_dir, f"vector_db_keys.{generation}.jsonl"),
+        )
+
+    @staticmethod
+    def _read_manifest(memory_dir):
+        try:
+            with open(os.path.join(memory_dir, "vector_db.json"), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _write_manifest(memory_dir, manifest):
+        tmp_path = os.path.join(memory_dir, "vector_db.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, os.path.join(memory_dir, "vector_db.json"))
+
+    @staticmethod
+    def _replay(keys_path):
+        """Returns {key: (row, value_id)} for all keys that are not deleted, and the number of records"""
+        records, num_records = {}, 0
+        if not os.path.exists(keys_path):
+            return records, num_records
+        with open(keys_path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # incomplete last line of an interrupted save
+                    continue
+                num_records += 1
+                records.pop(record["key"], None)
+                if not record.get("deleted", False):
+                    records[record["key"]] = (record["row"], record["value"])
+        return records, num_records
+
+    def save(self, memory_dir):
+        """Append everything that changed since the last save to the files in memory_dir"""
+        # waits for a running compaction, otherwise the changes are lost if the process exits before the next save
+        with self._lock:
+            os.makedirs(memory_dir, exist_ok=True)
+            if self._save_dir != memory_dir:
+                # the files in memory_dir are not the ones this store was loaded from or saved to: replace them
+                self._saved_rows, self._deleted_keys = 0, []
+                self._saved_index_size = self._disk_records = self._disk_dead = 0
+                if self._read_manifest(memory_dir) is not None:
+                    self._clear_files(memory_dir)
+            manifest = self._read_manifest(memory_dir)
+            if manifest is None or manifest["dim"] is None:
+                manifest = {"dim": self._dim, "generation": 0 if manifest is None else manifest["generation"], "embedder": self.embedder_id}
+                self._write_manifest(memory_dir, manifest)
+            elif manifest.get("embedder") is None and self.embedder_id is not None:
+                # manifests of older versions do not know their embedder
+                manifest["embedder"] = self.embedder_id
+                self._write_manifest(memory_dir, manifest)
+            self._check_embedder(memory_dir, manifest)
+            if self._dim is not None and manifest["dim"] != self._dim:
+                raise ValueError(f"Can not save {self._dim} dimensional embeddings to {memory_dir}, which contains {manifest['dim']} dimensional embeddings")
+            embeddings_path, keys_path = self._paths(memory_dir, manifest["generation"])
+            rows = np.nonzero(self._alive[self._saved_rows:self._size])[0] + self._saved_rows
+            if len(rows) > 0:
+                with open(embeddings_path, "ab") as f:
+                    # drop a partial row of an interrupted save
+                    f.truncate(f.tell() - f.tell() % (4 * self._dim))
+                    first_row = f.seek(0, os.SEEK_END) // (4 * self._dim)
+                    f.write(self._rows()[rows].astype(np.float32).tobytes())
+            with open(keys_path, "a") as f:
+                for key_hash in self._deleted_keys:
+                    f.write(json.dumps({"key": key_hash, "deleted": True}) + "\n")
+                for i, row in enumerate(rows.tolist()):
+                    value_id = self._values[self._row_value[row]].id
+                    f.write(json.dumps({"key": self._row_key[row], "value": value_id, "row": first_row + i}) + "\n")
+            self._disk_records += len(rows) + len(self._deleted_keys)
+            self._disk_dead += 2 * len(self._deleted_keys)
+            self._save_dir, self._saved_rows, self._deleted_keys = memory_dir, self._size, []
+            if self.index is not None and self.index.is_trained and self.index.trained_size != self._saved_index_size:
+                with open(os.path.join(memory_dir, "vector_db_index.pkl"), "wb") as f:
+                    pickle.dump(self.index.state_dict(), f)
+                self._saved_index_size = self.index.trained_size
+
+    def load(self, memory_dir, get_value):
+        """Memory-map the embeddings in memory_dir. `get_value` returns the value for a value id.
+
+        Returns False if memory_dir contains no vector db.
+        """
+        manifest = self._read_manifest(memory_dir)
+        if manifest is None:
+            return False
+        self._check_embedder(memory_dir, manifest)
+        with self._lock:
+            self._reset()
+            self._dim = manifest["dim"]
+            embeddings_path, keys_path = self._paths(memory_dir, manifest["generation"])
+            records, self._disk_records = self._replay(keys_path)
+            num_rows = 0
+            if self._dim is not None and os.path.exists(embeddings_path):
+                num_rows = os.path.getsize(embeddings_path) // (4 * self._dim)
+            if num_rows > 0:
+                self._base = np.memmap(embeddings_path, dtype=np.float32, mode="r", shape=(num_rows, self._dim))
+                if self.quantizer is not None:
+                    self.quantizer.add(0, self._base)
+            self._row_value = np.zeros(num_rows, dtype=np.int64)
+            self._alive = np.zeros(num_rows, dtype=bool)
+            self._row_labels = {name: np.full(num_rows, -1, dtype=np.int32) for name in self.partition_by}
+            self._row_key = [None] * num_rows
+            for key_hash, (row, value_id) in records.items():
+                value = get_value(value_id)
+                if value is None or row >= num_rows:
+                    continue
+                self._row_key[row] = key_hash
+                self._key_row[key_hash] = row
+                self._alive[row] = True
+                self._assign(row, value)
+            self._size = self._saved_rows = num_rows
+            self._save_dir = memory_dir
+            self._disk_dead = self._disk_records - len(self._key_row)
+            index_state = None
+            if self.index is not None and os.path.exists(index_path := os.path.join(memory_dir, "vector_db_index.pkl")):
+                with open(index_path, "rb") as f:
+                    index_state = pickle.load(f)
+                self._saved_index_size = index_state["trained_size"]
+        self._load_index(index_state)
+        return True
+
+    def _check_embedder(self, memory_dir, manifest):
+        embedder_id = manifest.get("embedder")
+        if embedder_id is not None and self.embedder_id is not None and embedder_id != self.embedder_id:
+            raise EmbedderMismatch(f"{memory_dir} contains embeddings of {embedder_id}, not of {self.embedder_id}")
+
+    def clear_files(self, memory_dir):
+        """Start a new, empty generation of files in memory_dir, e.g. to save embeddings of another embedder"""
+        with self._lock:
+            self._clear_files(memory_dir)
+            if self._save_dir == memory_dir:
+                self._save_dir = None
+
+    def _clear_files(self, memory_dir):
+        manifest = self._read_manifest(memory_dir)
+        generation = 0 if manifest is None else manifest["generation"]
+        self._write_manifest(memory_dir, {"dim": None, "generation": generation + 1, "embedder": self.embedder_id})
+        for path in list(self._paths(memory_dir, generation)) + [os.path.join(memory_dir, "vector_db_index.pkl")]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def needs_compaction(self, min_dead=1000):
+        return self._disk_dead >= max(min_dead, self._disk_records - self._disk_dead)
+
+    def compact_files(self, memory_dir):
+        """Rewrite the files in memory_dir without deleted keys and embeddings.
+
+        Only the files are changed, rows that are loaded in memory stay valid. Can run in a background thread.
+        """
+        with self._lock:
+            manifest = self._read_manifest(memory_dir)
+            if manifest is None or manifest["dim"] is None:
+                return
+            embeddings_path, keys_path = self._paths(memory_dir, manifest["generation"])
+            new_embeddings_path, new_keys_path = self._paths(memory_dir, manifest["generation"] + 1)
+            records, _ = self._replay(keys_path)
+            num_rows = os.path.getsize(embeddings_path) // (4 * manifest["dim"]) if os.path.exists(embeddings_path) else 0
+            records = sorted([(row, key, value_id) for key, (row, value_id) in records.items() if row < num_rows])
+            embeddings = np.memmap(embeddings_path, dtype=np.float32, mode="r", shape=(num_rows, manifest["dim"])) if num_rows > 0 else None
+            with open(new_embeddings_path, "wb") as f:
+                for start in range(0, len(records), 8192):
+                    rows = [row for row, _, _ in records[start : start + 8192]]
+                    f.write(np.asarray(embeddings[rows]).tobytes())
+            with open(new_keys_path, "w") as f:
+                for new_row, (_, key, value_id) in enumerate(records):
+                    f.write(json.dumps({"key": key, "value": value_id, "row": new_row}) + "\n")
+            del embeddings
+            self._write_manifest(memory_dir, dict(manifest, generation=manifest["generation"] + 1))
+            for path in [embeddings_path, keys_path]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    # e.g. still memory-mapped on windows
+                    pass
+            self._disk_records, self._disk_dead = len(records), 0
+
 
 class IngestQuery(BaseModel):
     url: str = Field(..., description="The url of the website to read and tag.")
@@ -109,18 +623,97 @@ class RelatedQuestionList(BaseModel):
 def hash_string(string):
         return hashlib.sha256(string.encode("utf-8")).hexdigest()
 
+
+class MemoryList:
+    """Memories in insertion order with constant time lookup and removal by id.
+
+    Removed memories leave a tombstone (None) that is dropped once tombstones outnumber the memories.
+    """
+    def __init__(self, memories=(), min_dead=1024):
+        self.min_dead = min_dead
+        self._items = []
+        self._position = {}
+        self._dead = 0
+        self.extend(memories)
+
+    def __len__(self):
+        return len(self._position)
+
+    def __iter__(self):
+        return (i for i in self._items if i is not None)
+
+    def __contains__(self, memory):
+        return memory.id in self._position
+
+    def __iadd__(self, memories):
+        self.extend(memories)
+        return self
+
+    def get(self, memory_id, default=None):
+        position = self._position.get(memory_id)
+        return default if position is None else self._items[position]
+
+    def append(self, memory):
+        if memory.id in self._position:
+            self._items[self._position[memory.id]] = memory
+            return
+        self._position[memory.id] = len(self._items)
+        self._items.append(memory)
+
+    def extend(self, memories):
+        for memory in memories:
+            self.append(memory)
+
+    def remove(self, memory):
+        position = self._position.pop(memory.id, None)
+        if position is None:
+            raise ValueError(f"Memory {memory.id} not in list")
+        self._items[position] = None
+        self._dead += 1
+        if self._dead >= max(self.min_dead, len(self)):
+            self._items = list(self)
+            self._position = {memory.id: i for i, memory in enumerate(self._items)}
+            self._dead = 0
+
+
 class SemanticParagraphMemory:
     def __init__(
         self,
         auto_save_dir=".minichain/memory",
         agents_kwargs={},
     ):
-        self.memories: List[MemoryWithMeta] = []
-        self.vector_db = VectorDB()
+        self.memories = MemoryList()
+        memory_settings = (settings.yaml or {}).get("memory") or {}
+        embedder = get_embedder(memory_settings.get("embedding", "openai"), **(memory_settings.get("embedding_kwargs") or {}))
+        embedding_functions = {}
+        if embedder is not None:
+            embedding_functions = {"embedding_function": embedder, "batch_embedding_function": embedder.embed_batch}
+        self.vector_db = VectorDB(
+            **embedding_functions,
+            embedder_id=None if embedder is None else embedder.id,
+            index=get_index(memory_settings.get("index", "exact"), **(memory_settings.get("index_kwargs") or {})),
+            quantizer=get_quantizer(memory_settings.get("quantization", "none")),
+            partition_by={
+                "type": lambda memory: memory.memory.type,
+                "scope": lambda memory: memory.meta.scope,
+            },
+        )
+        self.lexical_index = BM25Index()
+        # vector, lexical (no embedding requests) or hybrid
+        self.retrieval = memory_settings.get("retrieval", "hybrid")
         self.snippet_template = snippet_template
         self.auto_save_dir = auto_save_dir
         self.agent_kwargs = agents_kwargs
         self.ingested_hashed = {}
+        # memories that were added, changed or forgotten (None) since the last save
+        self._unsaved_memories = {}
+        self._memories_save_dir = None
+        # ids of the memories that are alive in the log in _memories_save_dir
+        self._saved_memory_ids = set()
+        self._memory_log_records = 0
+        self._memory_log_dead = 0
+        self._lock = threading.Lock()
+        self._compaction = None
 
     def register_message_handler(self, message_handler):
         self.agent_kwargs["message_handler"] = message_handler
@@ -129,7 +722,9 @@ class SemanticParagraphMemory:
     def forget(self, memory):
         try:
             self.vector_db.remove_value(memory)
+            self.lexical_index.remove(memory.id)
             self.memories.remove(memory)
+            self._unsaved_memories[memory.id] = None
         except ValueError:
             pass
     
@@ -164,6 +759,7 @@ class SemanticParagraphMemory:
         end_line = start_line + len(memory.meta.content.split("\n")) - 1
         memory.memory.start_line = start_line
         memory.memory.end_line = end_line
+        self._unsaved_memories[memory.id] = memory
         return True
 
     async def ingest(self, content, source, watch_source=True, scope=None, return_summary=False):
@@ -190,13 +786,10 @@ class SemanticParagraphMemory:
             if scope:
                 memory.meta.scope = scope
             memory.meta.watch_source = watch_source
-            # title
-            self.vector_db.add(memory.memory.title, memory)
-            # questions
-            for question in memory.memory.relevant_questions:
-                key = f"({memory.meta.source}): {question}"
-                self.vector_db.add(key, memory)
+        await self.vector_db.add_batch(self.vector_db_items(memories))
+        self.add_to_lexical_index(memories)
         self.memories += memories
+        self._unsaved_memories.update({i.id: i for i in memories})
         self.ingested_hashed[source] = content_hash
         if self.auto_save_dir is not None:
             self.save(self.auto_save_dir)
@@ -205,6 +798,23 @@ class SemanticParagraphMemory:
         else:
             return memories
 
+    def vector_db_items(self, memories):
+        """Returns the (key, memory) pairs under which the memories are found: the title and each question"""
+        items = []
+        for memory in memories:
+            items.append((memory.memory.title, memory))
+            for question in memory.memory.relevant_questions:
+                items.append((f"({memory.meta.source}): {question}", memory))
+        return items
+
+    def add_to_lexical_index(self, memories):
+        for memory in memories:
+            text = "\n".join(
+                [memory.memory.title, memory.memory.symbol_id or "", memory.meta.content]
+                + memory.memory.relevant_questions
+            )
+            self.lexical_index.add(memory.id, text, memory)
+
     async def ingest_rec(self, path):
         if not os.path.exists(path):
             return []
@@ -225,31 +835,49 @@ class SemanticParagraphMemory:
         memory.meta.scope = scope
         memory.meta.watch_source = watch_source
         self.memories.append(memory)
-        self.vector_db.add(memory.memory.title, memory)
-        for question in memory.memory.relevant_questions:
-            key = f"({memory.meta.source}): {question}"
-            self.vector_db.add(key, memory)
+        self._unsaved_memories[memory.id] = memory
+        await self.vector_db.add_batch(self.vector_db_items([memory]))
+        self.add_to_lexical_index([memory])
         if self.auto_save_dir is not None:
             self.save(self.auto_save_dir)
         return memory
     
+    def _scope(self):
+        if self.agent_kwargs.get("message_handler"):
+            return list(self.agent_kwargs["message_handler"].path)
+        return ["root"]
+
     async def search_by_vector(self, question, num_results) -> List[MemoryWithMeta]:
         # query_questions = await self.generate_questions(question)
         query_questions = [question]
-        matches = self.vector_db.search(query_questions, num_results=num_results * 2)
-        # remove all matches that are out of scope
-        matches = [i for i in matches if i.value.memory.type == "content"]
-        # remove all matches that are out of scope
-        matches_in_scope, scope = [], ["root"]
-        if self.agent_kwargs.get("message_handler"):
-            scope = self.agent_kwargs["message_handler"].path
-        for match in matches:
-            if match.value.meta.scope in scope:
-                matches_in_scope.append(match)
-        return [i.value for i in matches_in_scope[:num_results]]
+        # only content memories that are in scope are searched
+        matches = await self.vector_db.asearch(
+            query_questions, num_results=num_results * 2, where={"type": "content", "scope": self._scope()}
+        )
+        return [i.value for i in matches[:num_results]]
+
+    def search_lexical(self, question, num_results) -> List[MemoryWithMeta]:
+        scope = self._scope()
+        matches = self.lexical_index.search(
+            question, num_results, where=lambda memory: memory.memory.type == "content" and memory.meta.scope in scope
+        )
+        return [self.lexical_index.values[memory_id] for memory_id, _ in matches]
+
+    async def search(self, question, num_results) -> List[MemoryWithMeta]:
+        """Find memories with the retrieval method set in the memory settings"""
+        if self.retrieval == "lexical":
+            return self.search_lexical(question, num_results)
+        if self.retrieval == "vector":
+            return await self.search_by_vector(question, num_results)
+        # hybrid: reciprocal rank fusion of both rankings
+        by_vector = await self.search_by_vector(question, 2 * num_results)
+        lexical = self.search_lexical(question, 2 * num_results)
+        memories = {i.id: i for i in by_vector + lexical}
+        ranking = reciprocal_rank_fusion([[i.id for i in by_vector], [i.id for i in lexical]])
+        return [memories[i] for i in ranking[:num_results]]
 
     async def retrieve(self, question: str, num_results=8) -> List[MemoryWithMeta]:
-        results = await self.search_by_vector(question, num_results)
+        results = await self.search(question, num_results)
         sources_to_update = []
         for i in results:
             if not self.check_if_still_valid(i):
@@ -299,39 +927,134 @@ class SemanticParagraphMemory:
             return summary
 
     def save(self, memory_dir):
+        """Append all changes since the last save to the files in memory_dir"""
         os.makedirs(memory_dir, exist_ok=True)
-        # save the vector db
-        with open(os.path.join(memory_dir, "vector_db_keys.pkl"), "wb") as f:
-            pickle.dump(self.vector_db.keys, f)
-        with open(os.path.join(memory_dir, "vector_db_values.pkl"), "wb") as f:
-            pickle.dump(self.vector_db.values, f)
-        # save the memories as json
-        with open(os.path.join(memory_dir, "memories.json"), "w") as f:
-            # we need to handle the datetime objects and save them as e.g. 2023-12-31T23:59:59.999999+00:00
-            json.dump([i.dict() for i in self.memories], f, default=datetime_converter)
+        self.vector_db.save(memory_dir)
+        self._save_memories(memory_dir)
         with open(os.path.join(memory_dir, "ingested_hashed.json"), "w") as f:
             json.dump(self.ingested_hashed, f)
+        if self._compaction is None or not self._compaction.is_alive():
+            if self.vector_db.needs_compaction() or self._memory_log_dead >= max(1000, self._memory_log_records - self._memory_log_dead):
+                self._compaction = threading.Thread(target=self.compact, args=(memory_dir,), daemon=True)
+                self._compaction.start()
+
+    def _save_memories(self, memory_dir):
+        # blocks while compact() rewrites the log
+        with self._lock:
+            mode = "a"
+            if self._memories_save_dir != memory_dir:
+                # the log in memory_dir is not the one this memory was loaded from or saved to: replace it
+                self._unsaved_memories = {i.id: i for i in self.memories}
+                self._saved_memory_ids = set()
+                self._memory_log_records = self._memory_log_dead = 0
+                mode = "w"
+            # forgotten memories that were never saved need no tombstone
+            self._unsaved_memories = {
+                memory_id: memory for memory_id, memory in self._unsaved_memories.items()
+                if memory is not None or memory_id in self._saved_memory_ids
+            }
+            # memories.jsonl is a log: the last record of a memory id wins
+            path = os.path.join(memory_dir, "memories.jsonl")
+            with open(path if mode == "a" else path + ".tmp", mode) as f:
+                for memory_id, memory in self._unsaved_memories.items():
+                    record = {"id": memory_id, "deleted": True} if memory is None else memory.dict()
+                    f.write(json.dumps(record, default=datetime_converter) + "\n")
+                    if memory is None:
+                        self._saved_memory_ids.discard(memory_id)
+                    else:
+                        self._saved_memory_ids.add(memory_id)
+            if mode == "w":
+                os.replace(path + ".tmp", path)
+            self._memory_log_records += len(self._unsaved_memories)
+            # a tombstone makes itself and the record it deletes obsolete
+            self._memory_log_dead += 2 * list(self._unsaved_memories.values()).count(None)
+            self._unsaved_memories = {}
+            self._memories_save_dir = memory_dir
+
+    @staticmethod
+    def _replay_memories(path):
+        """Returns {id: memory dict} of the memories that are not forgotten, and the number of records"""
+        records, num_records = {}, 0
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line, object_hook=datetime_parser)
+                except json.JSONDecodeError:
+                    # incomplete last line of an interrupted save
+                    continue
+                num_records += 1
+                records.pop(record["id"], None)
+                if not record.get("deleted", False):
+                    records[record["id"]] = record
+        return records, num_records
+
+    def compact(self, memory_dir):
+        """Rewrite the files in memory_dir without forgotten memories"""
+        self.vector_db.compact_files(memory_dir)
+        path = os.path.join(memory_dir, "memories.jsonl")
+        with self._lock:
+            if not os.path.exists(path):
+                return
+            records, _ = self._replay_memories(path)
+            with open(path + ".tmp", "w") as f:
+                for record in records.values():
+                    f.write(json.dumps(record, default=datetime_converter) + "\n")
+            os.replace(path + ".tmp", path)
+            self._memory_log_records, self._memory_log_dead = len(records), 0
 
     def load(self, memory_dir):
-        # load the vector db
         try:
-            with open(os.path.join(memory_dir, "vector_db_keys.pkl"), "rb") as f:
-                self.vector_db.keys = pickle.load(f)
-            with open(os.path.join(memory_dir, "vector_db_values.pkl"), "rb") as f:
-                self.vector_db.values = pickle.load(f)
-            with open(os.path.join(memory_dir, "memories.json"), "r") as f:
-                memories = json.load(f, object_hook=datetime_parser)
+            memories_path = os.path.join(memory_dir, "memories.jsonl")
+            if os.path.exists(memories_path):
+                with self._lock:
+                    records, num_records = self._replay_memories(memories_path)
+                self.memories = MemoryList([MemoryWithMeta(**i) for i in records.values()])
+                self._memory_log_records = num_records
+                self._memory_log_dead = num_records - len(records)
+                self._memories_save_dir = memory_dir
+                self._saved_memory_ids = set(records.keys())
+            else:
+                # stores written before memories.jsonl existed are converted with the next save
+                with open(os.path.join(memory_dir, "memories.json"), "r") as f:
+                    self.memories = MemoryList([MemoryWithMeta(**i) for i in json.load(f, object_hook=datetime_parser)])
+                self._memories_save_dir = None
+            self._unsaved_memories = {}
+            self.lexical_index = BM25Index()
+            self.add_to_lexical_index(self.memories)
+            try:
+                loaded = self.vector_db.load(memory_dir, self.memories.get)
+            except EmbedderMismatch as e:
+                print(f"{e} - embedding the memories again")
+                self.embed_again(memory_dir)
+                loaded = True
+            if not loaded:
+                with open(os.path.join(memory_dir, "vector_db_keys.pkl"), "rb") as f:
+                    keys = pickle.load(f)
+                with open(os.path.join(memory_dir, "vector_db_values.pkl"), "rb") as f:
+                    values = pickle.load(f)
+                values = {k: self.memories.get(v.id, v) for k, v in values.items()}
+                self.vector_db.set_items(keys, values)
             with open(os.path.join(memory_dir, "ingested_hashed.json"), "r") as f:
                 ingested_hashed = json.load(f)
                 for key, hash in ingested_hashed.items():
                     if any([i.meta.source == key for i in self.memories]):
                         self.ingested_hashed[key] = hash
-            self.memories = [MemoryWithMeta(**i) for i in memories]
         except:
             print("No memories found in", memory_dir)
         self.auto_save_dir = memory_dir
         return self
-    
+
+    def embed_again(self, memory_dir):
+        """Replace the embeddings in memory_dir by embeddings of the current embedder"""
+        items = self.vector_db_items(self.memories)
+        embeddings = self.vector_db.encode([key for key, _ in items])
+        self.vector_db.set_items(
+            {hash_string(key): embedding for (key, _), embedding in zip(items, embeddings)},
+            {hash_string(key): value for key, value in items},
+        )
+        self.vector_db.clear_files(memory_dir)
+        self.vector_db.save(memory_dir)
+
     def reload(self):
         self.load(self.auto_save_dir)
 
@@ -395,8 +1118,6 @@ async def main():
     
     # breakpoint()
 
-from minichain import settings
-
 settings.set_default_memory(
     SemanticParagraphMemory
 )
@@ -2,12 +2,16 @@ from typing import Any, List, Union, Dict
 import json
 import os
 from uuid import uuid4
-from collections import defaultdict
+from collections import defaultdict, deque
 import asyncio
+import copy
+import time
+from itertools import accumulate
 
-from minichain.utils.json_datetime import datetime_converter
+from minichain.utils.cache_keys import ChatHistory, content_hash
+from minichain.utils.json_datetime import EncodedEvent, datetime_converter, dumps_event
 from minichain.dtypes import Cancelled, ConsumerClosed, UserMessage
-from minichain.utils.tokens import count_tokens
+from minichain.utils.tokens import count_tokens, count_tokens_batch
 from minichain import settings
 
 
@@ -24,14 +28,82 @@ class StreamCollector():
     prepare() is sent first to tell the client where to put the message.
     set() replaces the message with the given chat.
     chunk() adds the given diff to the message.
+
+    Streamed strings are collected in a list per field and only joined when current_message is read,
+    so that streaming a long message does not copy it for every chunk.
+
+    If shared['coalesce'] is set to (window in seconds, max bytes), chunks are not sent one by one: consecutive
+    diffs are merged and sent once the window has passed or the merged strings exceed max bytes.
     """
     def __init__(self, path: List[str] = ["Trash"], current_message: Dict = None, meta: Dict = None, shared: Dict = None):
         self.path = path
-        self.current_message = current_message or {}
-        self.ignore_keys = [k for k, v in self.current_message.items() if v is not None and v != "" and k!='function_call']
+        self._message = current_message or {}
+        # field path, e.g. ('function_call', 'arguments') -> list of strings
+        self._buffers = {}
+        self.ignore_keys = [k for k, v in self._message.items() if v is not None and v != "" and k!='function_call']
         self.shared = shared or {'on_message': do_nothing}
         self.active = True
         self.meta = meta or {}
+        # coalesced chunks that have not been sent yet
+        self._pending = {}
+        self._pending_bytes = 0
+        self._pending_since = None
+        self._flush_handle = None
+        self._flush_task = None
+        self._flush_error = None
+
+    @property
+    def current_message(self):
+        """The message with all chunks applied"""
+        for field, parts in self._buffers.items():
+            target = self._message
+            for key in field[:-1]:
+                if not isinstance(target.get(key), dict):
+                    target[key] = {}
+                target = target[key]
+            target[field[-1]] = "".join(parts)
+        self._buffers = {}
+        return self._message
+
+    @current_message.setter
+    def current_message(self, message):
+        self._message = message
+        self._buffers = {}
+
+    def sent_message(self):
+        """The message as far as it was sent to the clients, i.e. without the pending coalesced chunks"""
+        message = self.current_message
+        if len(self._pending) == 0:
+            return message
+        message = copy.deepcopy(message)
+        for field, parts in self._pending.items():
+            target = message
+            for key in field[:-1]:
+                target = target[key]
+            pending = sum(len(i) for i in parts)
+            target[field[-1]] = target[field[-1]][: len(target[field[-1]]) - pending]
+        return message
+
+    def _get(self, field):
+        value = self._message
+        for key in field:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        return value
+
+    def _append(self, diff):
+        for field, value in flat_fields(diff):
+            if isinstance(value, str):
+                parts = self._buffers.get(field)
+                if parts is None:
+                    parts = self._buffers[field] = [self._get(field) or ""]
+                parts.append(value)
+            else:
+                # other values, e.g. lists, are rare and merged into the materialized message
+                for key in reversed(field):
+                    value = {key: value}
+                nested("add", self.current_message, value)
     
     @property
     def context(self):
@@ -66,6 +138,7 @@ class StreamCollector():
     async def chunk(self, diff=None, meta=None):
         if not self.active:
             return
+        self._raise_flush_error()
         if meta is not None:
             nested("add", self.meta, meta)
             # we don't stream meta updates
@@ -75,9 +148,83 @@ class StreamCollector():
             diff = {"content": diff}
         for key in self.ignore_keys:
             diff.pop(key, None)
-            
-        nested("add", self.current_message, diff)
 
+        self._append(diff)
+        stats = self.shared.get('stream_stats')
+        if stats is not None:
+            stats['chunks'] += 1
+        window, max_bytes = self.shared.get('coalesce', (0, 0))
+        if window <= 0 or not self._coalesce(diff):
+            if len(self._pending) > 0:
+                await self.flush()
+            await self._send_chunk(diff)
+            return
+        loop = asyncio.get_running_loop()
+        if (
+            self._pending_bytes >= max_bytes
+            or loop.time() - self._pending_since >= window
+            or self._is_cancelled()
+        ):
+            await self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(window, self._scheduled_flush)
+
+    def _coalesce(self, diff):
+        """Merges the strings of diff into the pending diff. Returns False if diff has other values"""
+        fields = list(flat_fields(diff))
+        if not all(isinstance(value, str) for _, value in fields):
+            return False
+        if self._pending_since is None:
+            self._pending_since = asyncio.get_running_loop().time()
+        for field, value in fields:
+            self._pending.setdefault(field, []).append(value)
+            self._pending_bytes += len(value)
+        return True
+
+    def _is_cancelled(self):
+        message_db = self.shared.get('message_db')
+        return message_db is not None and any(i in self.path for i in getattr(message_db, '_cancelled', []))
+
+    def _take_pending(self):
+        diff = {}
+        for field, parts in self._pending.items():
+            target = diff
+            for key in field[:-1]:
+                target = target.setdefault(key, {})
+            target[field[-1]] = "".join(parts)
+        self._pending, self._pending_bytes, self._pending_since = {}, 0, None
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        return diff
+
+    def _raise_flush_error(self):
+        if self._flush_error is not None:
+            error, self._flush_error = self._flush_error, None
+            raise error
+
+    async def flush(self):
+        """Send the coalesced chunks now"""
+        self._raise_flush_error()
+        if len(self._pending) == 0:
+            return
+        await self._send_chunk(self._take_pending())
+
+    def _scheduled_flush(self):
+        self._flush_handle = None
+        self._flush_task = asyncio.ensure_future(self._flush_in_background())
+
+    async def _flush_in_background(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            # e.g. Cancelled: raised by the next chunk() or set() of the producer
+            self._flush_error = e
+
+    async def _send_chunk(self, diff):
+        stats = self.shared.get('stream_stats')
+        if stats is not None:
+            stats['frames'] += 1
         msg = {
             "id": self.path[-1],
             "type": "chunk",
@@ -88,6 +235,9 @@ class StreamCollector():
     async def set(self, chat=None, meta=None):
         if not self.active:
             return
+        self._raise_flush_error()
+        # the set message contains the whole message, so pending chunks do not need to be sent
+        self._take_pending()
         if chat is not None:
             if isinstance(chat, str):
                 chat = {"content": chat}
@@ -108,6 +258,214 @@ class StreamCollector():
         await self.chunk(diff)
 
 
+class ConsumerQueue():
+    """Delivers the messages of a conversation to one consumer from its own task, so that the producer never
+    waits for slow consumers.
+
+    If more than max_size messages are queued, the overflow policy decides:
+    - coalesce: merge consecutive queued chunks of a message
+    - drop: replace consecutive queued messages of a message by its latest set, with the chunks after it applied
+    - disconnect: stop sending to the consumer
+    If the queue is still full after coalesce or drop, the consumer is disconnected as well.
+    """
+    def __init__(self, consume, encoded=False, max_size=1000, overflow="coalesce"):
+        self.consume = consume
+        self.encoded = encoded
+        self.max_size = max_size
+        self.overflow = overflow
+        # (msg, json text or None, time when it was queued)
+        self.queue = []
+        # events that a reconnecting client missed, sent before the queue and not limited by max_size
+        self.replay = deque()
+        self.closed = False
+        self._closed = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._task = None
+        self.stats = {"sent": 0, "coalesced": 0, "dropped": 0, "max_queued": 0}
+
+    def put(self, msg, event):
+        """Queues a message without waiting. msg must not change anymore"""
+        if self.closed:
+            return
+        self.queue.append((msg, event.text if self.encoded else None, time.monotonic()))
+        if len(self.queue) > self.max_size:
+            self._handle_overflow()
+            if self.closed:
+                return
+        self.stats["max_queued"] = max(self.stats["max_queued"], len(self.queue))
+        self._wake_writer()
+
+    def put_replay(self, items):
+        """Queues (msg, json text) pairs before all other messages"""
+        if self.closed:
+            return
+        now = time.monotonic()
+        self.replay.extend((msg, text, now) for msg, text in items)
+        self._wake_writer()
+
+    def _wake_writer(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        self._idle.clear()
+        self._wakeup.set()
+
+    def _handle_overflow(self):
+        if self.overflow == "coalesce":
+            self._merge_chunks()
+        elif self.overflow == "drop":
+            self._collapse_to_sets()
+        if self.overflow == "disconnect" or len(self.queue) > self.max_size:
+            print("Consumer is too slow, disconnecting")
+            self.close()
+
+    def _as_dict(self, item):
+        # the json text of encoded consumers is a snapshot of the message, the dict is not
+        msg, text, _ = item
+        return json.loads(text) if self.encoded else msg
+
+    def _item(self, msg, queued_at):
+        return (msg, dumps_event(msg) if self.encoded else None, queued_at)
+
+    def _merged(self, item, msg, queued_at):
+        # a merged item has the sequence number of the latest event in it
+        if "seq" in item[0]:
+            msg = {**msg, "seq": item[0]["seq"]}
+        return self._item(msg, queued_at)
+
+    def _merge_chunks(self):
+        # only consecutive chunks of a message are merged: when the client has the event with some seq, it has
+        # all earlier events, so that it can resume from the last seq it saw
+        queue = []
+        for item in self.queue:
+            msg = item[0]
+            if len(queue) > 0 and msg.get("type") == "chunk" and queue[-1][0].get("type") == "chunk" and queue[-1][0]["id"] == msg["id"]:
+                previous = self._as_dict(queue[-1])
+                diff = merge_diffs(previous["diff"], msg["diff"])
+                if diff is not None:
+                    queue[-1] = self._merged(item, {**previous, "diff": diff}, queue[-1][2])
+                    self.stats["coalesced"] += 1
+                    continue
+            queue.append(item)
+        self.queue = queue
+
+    def _collapse_to_sets(self):
+        queue = []
+        for item in self.queue:
+            msg = item[0]
+            previous = queue[-1][0] if len(queue) > 0 else {}
+            if msg.get("type") in ["set", "chunk"] and previous.get("type") in ["set", "chunk"] and previous.get("id") == msg.get("id"):
+                if msg["type"] == "set":
+                    # supersedes the previous event of the same message
+                    queue[-1] = item
+                    self.stats["dropped"] += 1
+                    continue
+                if previous["type"] == "set":
+                    # a chunk after a set: apply it to the set
+                    latest = self._as_dict(queue[-1])
+                    chat = nested("add", copy.deepcopy(latest.get("chat") or {}), msg["diff"])
+                    queue[-1] = self._merged(item, {**latest, "chat": chat}, queue[-1][2])
+                    self.stats["dropped"] += 1
+                    continue
+            queue.append(item)
+        self.queue = queue
+        self._merge_chunks()
+
+    def close(self):
+        self.closed = True
+        self.queue = []
+        self.replay.clear()
+        self._idle.set()
+        self._closed.set()
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+
+    async def wait_closed(self):
+        """Waits until the consumer is closed, e.g. because it was too slow or could not receive a message"""
+        await self._closed.wait()
+
+    async def _run(self):
+        while not self.closed:
+            if len(self.replay) > 0:
+                msg, text, _ = self.replay.popleft()
+            elif len(self.queue) > 0:
+                msg, text, _ = self.queue.pop(0)
+            else:
+                self._idle.set()
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            try:
+                await self.consume(text if self.encoded else msg)
+                self.stats["sent"] += 1
+            except ConsumerClosed:
+                print("Consumer closed")
+                self.close()
+            except Exception as e:
+                print("Consumer error", e)
+                self.close()
+
+    async def drain(self):
+        """Waits until all queued messages are sent"""
+        await self._idle.wait()
+
+    def lag(self):
+        """Seconds that the oldest queued message has been waiting"""
+        oldest = self.replay[0] if len(self.replay) > 0 else self.queue[0] if len(self.queue) > 0 else None
+        return time.monotonic() - oldest[2] if oldest is not None else 0
+
+    def get_stats(self):
+        return dict(self.stats, queued=len(self.queue), replay=len(self.replay), lag=self.lag(), closed=self.closed, overflow=self.overflow)
+
+
+class EventLog():
+    """The latest events sent to the consumers of one id, so that a reconnecting client only gets what it missed.
+    Keeps at most max_bytes of encoded events"""
+    def __init__(self, seq, max_bytes=4 * 2**20):
+        # (seq, {type, id}, json text)
+        self.events = deque()
+        self.bytes = 0
+        self.max_bytes = max_bytes
+        # the log contains all events with a larger sequence number
+        self.complete_after = seq
+        # since when the log has no consumers
+        self.idle_since = None
+
+    def append(self, seq, msg, text):
+        self.events.append((seq, {"type": msg.get("type"), "id": msg.get("id")}, text))
+        self.bytes += len(text)
+        while self.bytes > self.max_bytes:
+            dropped_seq, _, dropped_text = self.events.popleft()
+            self.bytes -= len(dropped_text)
+            self.complete_after = dropped_seq
+
+    def since(self, seq):
+        """(msg, json text) of the events after seq, or None if some of them are not in the log anymore"""
+        if seq < self.complete_after:
+            return None
+        missed = []
+        for event_seq, msg, text in reversed(self.events):
+            if event_seq <= seq:
+                break
+            missed.append((msg, text))
+        return missed[::-1]
+
+
+def merge_diffs(first, second):
+    """Diff of two consecutive chunks, or None if they have fields that are not strings"""
+    fields = list(flat_fields(first)) + list(flat_fields(second))
+    if not all(isinstance(value, str) for _, value in fields):
+        return None
+    merged = {}
+    for field, value in fields:
+        target = merged
+        for key in field[:-1]:
+            target = target.setdefault(key, {})
+        target[field[-1]] = target.get(field[-1], "") + value
+    return merged
+
+
 class StreamToStdout(StreamCollector):
     """Can be used as default stream target for agents that are not connected to a client"""
     def __init__(self):
@@ -122,6 +480,49 @@ def datetime_or_str_to_datetime(value):
 def sort_by_timestamp(items):
     return sorted(items, key=lambda x: datetime_or_str_to_datetime(x.meta['timestamp']))
 
+OUTLINE_HEADER = "Our chat history is already quite long. Here are the topics we discussed earlier:\n"
+
+
+def flat_fields(diff, path=()):
+    """Yields (field path, value) for the values of a nested chunk diff"""
+    for key, value in diff.items():
+        if isinstance(value, dict):
+            yield from flat_fields(value, path + (key,))
+        else:
+            yield path + (key,), value
+
+
+def get_memo(memos, chat):
+    """The value memoized for `chat`, or None if chat was mutated since - e.g. by streaming into it.
+    Fields are compared by identity, which is enough because strings are replaced when they change"""
+    memoized = memos.get(id(chat))
+    if memoized is None or memoized[0] is not chat:
+        return None
+    fields = list(flat_fields(chat))
+    if len(fields) != len(memoized[1]) or any(
+        path != old_path or value is not old_value
+        for (path, value), (old_path, old_value) in zip(fields, memoized[1])
+    ):
+        return None
+    return memoized[2]
+
+
+def set_memo(memos, chat, value):
+    # keeps chat and its fields alive, so that their ids are not reused while they are memoized
+    if id(chat) not in memos and len(memos) >= 16:
+        memos.clear()
+    memos[id(chat)] = (chat, list(flat_fields(chat)), value)
+    return value
+
+
+def count_message_tokens(pairs):
+    """Token counts of (message, chat) pairs. Counts that are not memoized on the message yet are computed in one batch"""
+    missing = [(message, chat) for message, chat in pairs if not message.has_chat_tokens(chat)]
+    for (message, chat), tokens in zip(missing, count_tokens_batch([chat for _, chat in missing])):
+        message.set_chat_tokens(chat, tokens)
+    return [message.chat_tokens(chat) for message, chat in pairs]
+
+
 import datetime as dt
 def get_default_meta(chat_summary=None):
     meta = {
@@ -139,6 +540,7 @@ class Message():
                  path: List[str]=None,
                  shared=None):
         self.shared = shared
+        self._stream_target = None
         self.chat = chat or {}
         self.meta = get_default_meta(chat)
         self.meta.update(meta or {})
@@ -146,10 +548,24 @@ class Message():
         if message_id is None:
             message_id = str(uuid4().hex[:8])
             self.path = self.path + [message_id]
-        self._stream_target = None
+        self._chat_hashes = {}
+        self._chat_tokens = {}
+        self._outline_tokens = (None, 0)
         self.shared['message_db'].register_message(self)
         self.meta['children'] = self.child_ids
 
+    @property
+    def chat(self):
+        """While the message is streamed, the chat as far as it was sent to the clients - so that events that
+        contain the chat (e.g. replays for new consumers) are consistent with the chunks that follow"""
+        if self._stream_target is not None and self._stream_target.active:
+            return self._stream_target.sent_message()
+        return self._chat
+
+    @chat.setter
+    def chat(self, chat):
+        self._chat = chat
+
     async def __aenter__(self):
         """Returns a stream target that can be used to update the message"""
         self._stream_target = StreamCollector(current_message=self.chat, meta=self.meta, path=self.path, shared=self.shared)
@@ -167,9 +583,16 @@ class Message():
             await self._stream_target.set(meta={
                 'duration': duration
             })
+        try:
+            await self._stream_target.flush()
+        except Exception:
+            if exc_type is None:
+                raise
         self.chat = self._stream_target.current_message
         self.meta.update(self._stream_target.meta)
         self._stream_target.off()
+        self._chat_hashes = {}
+        self._chat_tokens = {}
         self.meta["_chat_summary"] = self.chat # will be overwritten by to_memory when needed
         self.save()
 
@@ -180,7 +603,7 @@ class Message():
             print("already in memory: ", self.meta)
             return
         conversation = self.shared['message_db'].get(self.path[-2])
-        tokens = count_tokens(self.chat)
+        tokens = self.chat_tokens()
         self.meta['_tokens'] = tokens
 
         # check if this messages should be memorized
@@ -239,6 +662,35 @@ class Message():
             self.meta["_chat_summary"] = self.chat
         self.save()
     
+    def chat_hash(self, chat=None):
+        """Content hash of `chat` (default: self.chat), memoized until the chat is updated"""
+        chat = self.chat if chat is None else chat
+        memoized = get_memo(self._chat_hashes, chat)
+        if memoized is None:
+            memoized = set_memo(self._chat_hashes, chat, content_hash(chat))
+        return memoized
+
+    def chat_tokens(self, chat=None):
+        """Number of tokens of `chat` (default: self.chat), memoized until the chat is updated"""
+        chat = self.chat if chat is None else chat
+        memoized = get_memo(self._chat_tokens, chat)
+        if memoized is None:
+            memoized = set_memo(self._chat_tokens, chat, count_tokens(chat))
+        return memoized
+
+    def outline_tokens(self):
+        """Number of tokens of the outline of this message, 0 before it is memorized"""
+        outline = self.meta.get('_outline') or ""
+        if self._outline_tokens[0] != outline:
+            self._outline_tokens = (outline, count_tokens({"content": outline}) if outline else 0)
+        return self._outline_tokens[1]
+
+    def has_chat_tokens(self, chat):
+        return get_memo(self._chat_tokens, chat) is not None
+
+    def set_chat_tokens(self, chat, tokens):
+        set_memo(self._chat_tokens, chat, tokens)
+
     def as_document(self):
         document = f"Message from {self.chat['role']} {self.chat.get('name', '')}\n{self.chat['content']}"
         if (name:= (self.chat.get("function_call", None) or {}).get("name", None)) is not None:
@@ -316,6 +768,8 @@ class Conversation():
         self.insert_after = insert_after
         self.context_size = context_size
         self.memory = memory
+        self._last_history = None
+        self._functions_tokens = (None, 0)
     
     @property
     def first_user_message(self):
@@ -337,40 +791,90 @@ class Conversation():
         result += [i for i in self._messages if i is not None and i.meta.get('deleted', False)==False]
         return result
     
-    async def fit_to_context(self):
+    async def fit_to_context(self, functions=None):
+        """Returns the history for the LLM: the oldest messages are replaced by an outline until the history and
+        the function schemas fit into 80% of the context"""
         init_messages = [i for i in self.messages if i.meta.get('is_initial', False)]
         messages = [i for i in self.messages if i.meta.get('is_initial', False)==False]
+        count_message_tokens([(i, i.chat) for i in init_messages + messages] + [(i, i.meta['_chat_summary']) for i in messages])
         # Move original user message to init messages (where it does not get summarized)
         # unless it is very long
-        if count_tokens(messages[0].chat) < self.context_size * 0.2:
+        if messages[0].chat_tokens() < self.context_size * 0.2:
             init_messages += [messages.pop(0)]
         # if there are no messages that could be summarized, return
         if len(messages) == 0:
-            return [i.chat for i in init_messages]
-        
-        # replace old message by their outline iteratively - start by replacing 0 (change nothing)
+            return self._chat_history(init_messages, [], [])
+
+        budget = self.context_size * 0.8 - self._function_tokens(functions) - sum(i.chat_tokens() for i in init_messages)
         while True:
-            for i, message in enumerate(messages):
-                summarized = [i.chat for i in init_messages] + [
-                    UserMessage(
-                        "Our chat history is already quite long. Here are the topics we discussed earlier:\n" + 
-                        "\n".join([i.meta['_outline'] for i in messages[:i]])
-                    )
-                ][:i] +[
-                    i.meta['_chat_summary'] for i in messages[i:] 
-                ]
-                total_tokens = sum([count_tokens(j) for j in summarized])
-                if total_tokens < self.context_size * 0.8:
-                    return summarized
-                print(total_tokens, "do not fit into context - summarizing", i)
-                await message.to_memory()
-                # before .to_memory is called, _chat_summary is a copy of the original message. We now also call it for the most recent message
-                # to replace very long messages with a summary, without replacing the entire conversation by an outline
-                await messages[-1].to_memory()
+            cut = self._find_cut(messages, budget)
+            # the outline of a message is only known after to_memory, so messages before the cut need to be memorized
+            # before we know that the cut fits. Until then, their outline counts as empty
+            pending = [i for i in messages[:len(messages) if cut is None else cut] if i.meta.get('_memories') is None]
+            # to_memory also replaces a very long last message by a summary
+            if cut != 0 and messages[-1].meta.get('_memories') is None and messages[-1] not in pending:
+                pending.append(messages[-1])
+            if len(pending) > 0:
+                print(f"History does not fit into context - summarizing {len(pending)} messages")
+                # one after the other: to_memory adds to the memory of the conversation
+                for message in pending:
+                    await message.to_memory()
+                continue
+            if cut is not None:
+                return self._chat_history(init_messages, self._outline(messages[:cut]), messages[cut:])
+            if len(messages) == 1:
+                # the last message is never replaced by its outline
+                return self._chat_history(init_messages, [], messages)
             # if we get here, we have summarized all messages, but they still don't fit into the context
             # we now cutoff from the beginning
             messages = messages[len(messages)//2:]
-    
+
+    def _outline(self, messages):
+        return [
+            UserMessage(OUTLINE_HEADER + "\n".join([i.meta['_outline'] for i in messages]))
+        ][:len(messages)]
+
+    def _find_cut(self, messages, budget):
+        """The smallest number of messages that need to be replaced by the outline so that the history fits into
+        `budget` tokens, or None. The last message is never outlined. Messages that are not memorized yet count
+        with an empty outline"""
+        summary_tokens = count_message_tokens([(i, i.meta['_chat_summary']) for i in messages])
+        # tokens[i]: the first i messages are outlined, the others are included as their _chat_summary
+        suffix = list(accumulate(reversed(summary_tokens), initial=0))[::-1]
+        outline_tokens = [i.outline_tokens() + 1 for i in messages]
+        prefix = [0] + [count_tokens(UserMessage(OUTLINE_HEADER)) + i for i in accumulate(outline_tokens)]
+        fits = lambda i: prefix[i] + suffix[i] < budget
+        if fits(0):
+            return 0
+        if not fits(len(messages) - 1):
+            return None
+        # outlines are shorter than messages, so after the header of the outline is added, the tokens decrease
+        # with the number of outlined messages
+        low, high = 1, len(messages) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if fits(middle):
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def _function_tokens(self, functions):
+        if not functions:
+            return 0
+        if self._functions_tokens[0] is not functions:
+            self._functions_tokens = (functions, count_tokens({"content": json.dumps(list(functions))}))
+        return self._functions_tokens[1]
+
+    def _chat_history(self, init_messages, outline, messages):
+        """The history for the LLM, with message hashes for its cache key"""
+        chats = [(i.chat, i.chat_hash()) for i in init_messages]
+        chats += [(i, content_hash(i)) for i in outline]
+        chats += [(i.meta['_chat_summary'], i.chat_hash(i.meta['_chat_summary'])) for i in messages]
+        history = ChatHistory([chat for chat, _ in chats], [chat_hash for _, chat_hash in chats], previous=self._last_history)
+        self._last_history = history
+        return history
+
     def fork(self, message_id, new_path=None):
         """Returns a new conversation that is forked from the given message_id"""
         if new_path is None:
@@ -472,11 +976,15 @@ class MessageDB():
             import minichain.memory
         self.memory = settings.default_memory
         on_message = on_message or do_nothing
+        streaming_settings = (settings.yaml or {}).get("streaming") or {}
+        self.streaming_settings = streaming_settings
         self.shared = {
             'on_message': self.on_message,
             'consumers': defaultdict(list),
             'message_db': self,
-            'save_dir': save_dir
+            'save_dir': save_dir,
+            'coalesce': (streaming_settings.get('coalesce_window', 0.04), streaming_settings.get('coalesce_bytes', 16384)),
+            'stream_stats': {'chunks': 0, 'frames': 0},
         }
         self.conversations = []
         self.messages = []
@@ -485,9 +993,21 @@ class MessageDB():
             "path": ["root"]
         }
         self._cancelled = []
+        # events have sequence numbers that increase over all conversations. A client that reconnects to the
+        # same MessageDB (same epoch) sends the last sequence number it saw and gets the events it missed
+        self.epoch = uuid4().hex[:8]
+        self._seq = 0
+        self.event_logs = {}
+        self._logs_checked = time.monotonic()
     
     def cancel(self, conversation_id):
         self._cancelled.append(conversation_id)
+
+    def stream_stats(self):
+        """Number of streamed chunks, and of chunk frames that were sent after coalescing"""
+        stats = dict(self.shared['stream_stats'])
+        stats['frames_saved'] = stats['chunks'] - stats['frames']
+        return stats
     
     async def on_message(self, msg):
         # send the message to all other consumers if they want to consume it
@@ -513,19 +1033,46 @@ class MessageDB():
         path[-2] -> normal message of this conversation
         path[-1] -> messages addressed to the conversation itsefl, e.g. meta updates. should actually not be used
         """
+        self._seq += 1
+        msg["seq"] = self._seq
+        # the message is encoded at most once for all consumers of both targets
+        event = EncodedEvent(msg)
         for target in path[-2:]:
-            await self.send_to_consumers(target, msg)
+            if (log := self.event_logs.get(target)) is not None:
+                log.append(self._seq, msg, event.text)
+            await self.send_to_consumers(target, msg, event)
+        self.release_idle_logs()
+
+    def release_idle_logs(self, now=None):
+        """Drops the event logs of conversations that had no consumers for replay_idle_timeout seconds, e.g.
+        because they are finished. Their clients get the full state when they reconnect"""
+        now = time.monotonic() if now is None else now
+        timeout = self.streaming_settings.get('replay_idle_timeout', 300)
+        if now - self._logs_checked < min(timeout, 10):
+            return
+        self._logs_checked = now
+        for conversation_id, log in list(self.event_logs.items()):
+            if any(not i.closed for i in self.shared['consumers'].get(conversation_id, [])):
+                log.idle_since = None
+            elif log.idle_since is None:
+                log.idle_since = now
+            elif now - log.idle_since >= timeout:
+                del self.event_logs[conversation_id]
     
-    async def send_to_consumers(self, target, msg):
-        alive = []
-        consumers = self.shared['consumers'].get(target, [])
-        for consume in consumers:
-            try:
-                await consume(msg)
-                alive += [consume]
-            except ConsumerClosed:
-                print("Consumer closed")
-        self.shared['consumers'][target] = alive
+    async def send_to_consumers(self, target, msg, event=None):
+        """Queues the message for the consumers of target. Does not wait until they received it"""
+        consumers = [i for i in self.shared['consumers'].get(target, []) if not i.closed]
+        self.shared['consumers'][target] = consumers
+        if len(consumers) == 0:
+            return
+        event = event or EncodedEvent(msg)
+        if msg.get('type') != 'chunk':
+            # set messages contain the live chat and meta of a message, which change until the consumer gets them
+            frozen = copy.deepcopy(msg) if any(not i.encoded for i in consumers) else msg
+        else:
+            frozen = msg
+        for consumer in consumers:
+            consumer.put(frozen, event)
     
     def register_conversation(self, conversation):
         if not conversation.path[-1] in [c.path[-1] for c in self.conversations]:
@@ -586,8 +1133,60 @@ class MessageDB():
     def children_of(self, message_id):
         return [c for c in self.conversations if c.path[-2] == message_id and c.meta.get('deleted', False)==False]
     
-    def add_consumer(self, consumer, conversation_id):
-        self.shared['consumers'][conversation_id].append(consumer)
+    def add_consumer(self, consumer, conversation_id, encoded=False, max_size=None, overflow=None):
+        """consumer is called with each message of the conversation, or with its JSON text if encoded is set.
+        See ConsumerQueue for max_size and overflow"""
+        queue = ConsumerQueue(
+            consumer,
+            encoded=encoded,
+            max_size=max_size or self.streaming_settings.get('consumer_queue_size', 1000),
+            overflow=overflow or self.streaming_settings.get('consumer_overflow', 'coalesce'),
+        )
+        self.shared['consumers'][conversation_id].append(queue)
+        return queue
+
+    def subscribe(self, consumer, conversation_id, last_seen_seq=None, epoch=None, **kwargs):
+        """Adds an encoded consumer of a conversation. It first gets a sync event, then the events after
+        last_seen_seq if they are still in the event log, or otherwise the current state of every message"""
+        log = self.event_logs.get(conversation_id)
+        if log is None:
+            log = self.event_logs[conversation_id] = EventLog(self._seq, self.streaming_settings.get('replay_buffer_bytes', 4 * 2**20))
+        missed = None
+        if epoch == self.epoch and last_seen_seq is not None:
+            missed = log.since(last_seen_seq)
+        full = missed is None
+        if full:
+            missed = []
+            conversation = self.get(conversation_id)
+            for message in (conversation.messages if conversation is not None else []):
+                msg = {
+                    "type": "set",
+                    "chat": message.chat,
+                    "meta": message.meta,
+                    "id": message.path[-1],
+                    "path": message.path,
+                    "seq": self._seq,
+                }
+                missed.append((msg, dumps_event(msg)))
+        sync = {"type": "sync", "epoch": self.epoch, "seq": self._seq, "full": full}
+        # no await until the consumer is registered, so that no event is missed or sent twice
+        queue = self.add_consumer(consumer, conversation_id, encoded=True, **kwargs)
+        queue.put_replay([(sync, dumps_event(sync))] + missed)
+        return queue
+
+    def consumer_stats(self):
+        """Queue length, lag in seconds and sent, coalesced and dropped messages of each consumer"""
+        return {
+            target: [i.get_stats() for i in consumers]
+            for target, consumers in self.shared['consumers'].items()
+            if len(consumers) > 0
+        }
+
+    async def drain(self):
+        """Waits until all consumers received the queued messages"""
+        for consumers in list(self.shared['consumers'].values()):
+            for consumer in consumers:
+                await consumer.drain()
 
     def load(self):
         load_dir = self.shared['save_dir'] + "/root"
@@ -0,0 +1,84 @@
+import hashlib
+import json
+
+
+def content_hash(obj):
+    """sha256 of the canonical json of `obj`"""
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class ChatHistory(list):
+    """The chat messages (dicts) of an LLM call, with a cache key chained from per-message hashes.
+
+    `message_hashes` are usually memoized on the messages (see `Message.chat_hash`). The chain hashes of
+    the prefix shared with `previous` (e.g. the history of the previous call) are reused, so computing a key
+    only hashes the new messages.
+    """
+    def __init__(self, messages=(), message_hashes=None, previous=None):
+        super().__init__(messages)
+        self.message_hashes = message_hashes
+        self.previous = previous
+        self._chain = None
+
+    def chain(self):
+        if self._chain is None:
+            if self.message_hashes is None:
+                self.message_hashes = [content_hash(i) for i in self]
+            previous_hashes, previous_chain = [], []
+            if self.previous is not None:
+                previous_chain = self.previous.chain()
+                previous_hashes = self.previous.message_hashes
+                # the previous history is only needed until the chain is computed
+                self.previous = None
+            chain, parent, shared = [], "", True
+            for i, message_hash in enumerate(self.message_hashes):
+                shared = shared and i < len(previous_chain) and previous_hashes[i] == message_hash
+                if shared:
+                    parent = previous_chain[i]
+                else:
+                    parent = hashlib.sha256((parent + message_hash).encode("utf-8")).hexdigest()
+                chain.append(parent)
+            self._chain = chain
+        return self._chain
+
+    def cache_key(self):
+        chain = self.chain()
+        return chain[-1] if len(chain) > 0 else ""
+
+
+class ChatHistoryRef:
+    """Stored in cache entries instead of a ChatHistory: the messages are stored once per message chain"""
+    def __init__(self, head, length):
+        self.head = head
+        self.length = length
+
+    def __repr__(self):
+        return f"ChatHistoryRef({self.head}, {self.length} messages)"
+
+
+class FunctionSchemas(list):
+    """The openapi schemas of the functions of an agent, hashed once"""
+    def __init__(self, schemas=()):
+        super().__init__(schemas)
+        self._cache_key = None
+
+    def cache_key(self):
+        if self._cache_key is None:
+            self._cache_key = content_hash(list(self))
+        return self._cache_key
+
+
+class CacheKeyStub:
+    """Stands in for an argument with a `cache_key` method when the repr of cache keys is built"""
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __repr__(self):
+        return f"{type(self.obj).__name__}({self.obj.cache_key()})"
+
+
+def stub_structured(value):
+    """Replace a value with a stub if its type defines `cache_key`, other values are kept as they are"""
+    if callable(getattr(type(value), "cache_key", None)):
+        return CacheKeyStub(value)
+    return value
@@ -0,0 +1,246 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class SQLiteStore:
+    """Key-value store in a single SQLite file, shared safely by threads and processes.
+
+    The database runs in WAL mode, so readers do not block the writer. Values are zlib-compressed.
+    When the store exceeds `max_bytes`, the least recently used entries are deleted; entries older than
+    `ttl` seconds are treated as missing. Entries can reference chat history chains (`heads`); chain nodes
+    and messages that are no longer referenced by any entry are deleted with the entries.
+    """
+    def __init__(self, path, max_bytes=2 * 2**30, ttl=None, touch_interval=60, evict_every=256):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # reads only update the access time if it is older than this, so that most reads do not write
+        self.touch_interval = touch_interval
+        self.evict_every = evict_every
+        self._local = threading.local()
+        self._puts = 0
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, size INTEGER, created REAL, accessed REAL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+            # content-addressed chat histories: each chain node links a message to the node of the previous message
+            connection.execute("CREATE TABLE IF NOT EXISTS chain (hash TEXT PRIMARY KEY, parent TEXT, message TEXT)")
+            connection.execute("CREATE INDEX IF NOT EXISTS chain_parent ON chain (parent)")
+            connection.execute("CREATE TABLE IF NOT EXISTS messages (hash TEXT PRIMARY KEY, value BLOB)")
+            # the chain heads referenced by each cache entry
+            connection.execute("CREATE TABLE IF NOT EXISTS refs (key TEXT, head TEXT, PRIMARY KEY (key, head))")
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    def get(self, key):
+        now = time.time()
+        row = self._connection().execute("SELECT value, created, accessed FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, created, accessed = row
+        if self.ttl is not None and created < now - self.ttl:
+            return None
+        if accessed < now - self.touch_interval:
+            self._connection().execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        return zlib.decompress(value)
+
+    def put(self, key, data, nodes=(), heads=()):
+        """Insert or replace an entry that references the chains ending with `heads`. The `nodes` of these
+        chains that are not stored yet are stored in the same transaction (see put_chain)"""
+        self.put_many([(key, data)], replace=True, nodes=nodes, refs=[(key, head) for head in heads])
+
+    def put_many(self, items, replace=False, nodes=(), refs=()):
+        """Insert (key, data) pairs, chain nodes and (key, head) references in one transaction.
+        Existing entries are kept unless `replace` is set"""
+        now = time.time()
+        connection = self._connection()
+        statement = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            self._insert_chain(connection, nodes)
+            for key, data in items:
+                value = zlib.compress(data, 3)
+                cursor = connection.execute(
+                    f"{statement} INTO cache (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                    (key, value, len(value), now, now),
+                )
+                if cursor.rowcount > 0:
+                    connection.execute("DELETE FROM refs WHERE key = ?", (key,))
+            connection.executemany("INSERT OR IGNORE INTO refs (key, head) VALUES (?, ?)", refs)
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        self._puts += len(items)
+        if self._puts >= self.evict_every:
+            self._puts = 0
+            self.evict()
+
+    def has_chain(self, head):
+        return self._connection().execute("SELECT 1 FROM chain WHERE hash = ?", (head,)).fetchone() is not None
+
+    def is_extended(self, head):
+        """Whether a longer stored chain starts with the chain that ends with `head`"""
+        return self._connection().execute("SELECT 1 FROM chain WHERE parent = ? LIMIT 1", (head,)).fetchone() is not None
+
+    def items_in_range(self, start, stop):
+        """Iterate over the (key, data) pairs with start <= key < stop"""
+        rows = self._connection().execute("SELECT key, value FROM cache WHERE key >= ? AND key < ?", (start, stop))
+        for key, value in rows:
+            yield key, zlib.decompress(value)
+
+    def put_chain(self, nodes):
+        """Store (hash, parent hash, message hash, message data) chain nodes. Known messages are not stored again"""
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            self._insert_chain(connection, nodes)
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _insert_chain(connection, nodes):
+        for node_hash, parent, message_hash, data in nodes:
+            connection.execute("INSERT OR IGNORE INTO chain (hash, parent, message) VALUES (?, ?, ?)", (node_hash, parent, message_hash))
+            connection.execute("INSERT OR IGNORE INTO messages (hash, value) VALUES (?, ?)", (message_hash, zlib.compress(data, 3)))
+
+    def get_chain(self, head):
+        """The message data of the chain that ends with `head`, first message first"""
+        rows = self._connection().execute(
+            """
+            WITH RECURSIVE nodes (hash, parent, message, depth) AS (
+                SELECT hash, parent, message, 0 FROM chain WHERE hash = ?
+                UNION ALL
+                SELECT chain.hash, chain.parent, chain.message, nodes.depth + 1 FROM chain JOIN nodes ON chain.hash = nodes.parent
+            )
+            SELECT messages.value FROM nodes JOIN messages ON messages.hash = nodes.message ORDER BY nodes.depth DESC
+            """,
+            (head,),
+        ).fetchall()
+        return [zlib.decompress(value) for value, in rows]
+
+    def items(self, batch_size=256):
+        """Iterate over all (key, data) pairs"""
+        last_key = ""
+        while True:
+            rows = self._connection().execute(
+                "SELECT key, value FROM cache WHERE key > ? ORDER BY key LIMIT ?", (last_key, batch_size)
+            ).fetchall()
+            if len(rows) == 0:
+                return
+            for key, value in rows:
+                yield key, zlib.decompress(value)
+            last_key = rows[-1][0]
+
+    def delete(self, key):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            self._delete_entries(connection, [key])
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+
+    def size(self):
+        """Bytes of the entries, the chain nodes and the messages"""
+        connection = self._connection()
+        return (
+            connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+            + connection.execute("SELECT COALESCE(SUM(LENGTH(hash) + LENGTH(parent) + LENGTH(message)), 0) FROM chain").fetchone()[0]
+            + connection.execute("SELECT COALESCE(SUM(LENGTH(value) + LENGTH(hash)), 0) FROM messages").fetchone()[0]
+        )
+
+    def evict(self):
+        """Delete expired entries, then the least recently used ones until the store is below max_bytes"""
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if self.ttl is not None:
+                expired = connection.execute("SELECT key FROM cache WHERE created < ?", (time.time() - self.ttl,)).fetchall()
+                if len(expired) > 0:
+                    self._delete_entries(connection, [key for key, in expired])
+                    self._collect_chains(connection)
+            size = self.size()
+            # delete a bit more than necessary, so that eviction does not run on every put
+            target = None if self.max_bytes is None else self.max_bytes - self.max_bytes // 10
+            while target is not None and size > self.max_bytes:
+                count = connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+                if count == 0:
+                    break
+                # chat histories are shared by entries, so their bytes are attributed to all entries evenly
+                num_evicted = max(1, math.ceil((size - target) / (size / count)))
+                rows = connection.execute("SELECT key FROM cache ORDER BY accessed LIMIT ?", (num_evicted,)).fetchall()
+                self._delete_entries(connection, [key for key, in rows])
+                self._collect_chains(connection)
+                size = self.size()
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _delete_entries(connection, keys):
+        for key in keys:
+            connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+            connection.execute("DELETE FROM refs WHERE key = ?", (key,))
+
+    @staticmethod
+    def _collect_chains(connection):
+        """Delete the chain nodes and messages that are not part of a chain referenced by an entry"""
+        connection.execute(
+            """
+            WITH RECURSIVE live (hash) AS (
+                SELECT head FROM refs
+                UNION
+                SELECT chain.parent FROM chain JOIN live ON chain.hash = live.hash
+            )
+            DELETE FROM chain WHERE hash NOT IN (SELECT hash FROM live)
+            """
+        )
+        connection.execute("DELETE FROM messages WHERE hash NOT IN (SELECT message FROM chain)")
+
+
+def migrate_pickle_files(cache_dir, store, batch_size=1000):
+    """Move the `<sha256>.pkl` files of the old one-file-per-key cache into `store`. Returns the number of files.
+
+    After a successful migration, a marker file is written, so that later calls do not scan cache_dir again.
+    """
+    marker_path = os.path.join(cache_dir, "pickles-migrated")
+    if os.path.exists(marker_path):
+        return 0
+    paths = [entry.path for entry in os.scandir(cache_dir) if entry.name.endswith(".pkl") and entry.is_file()]
+    for start in range(0, len(paths), batch_size):
+        batch = paths[start : start + batch_size]
+        items = []
+        for path in batch:
+            try:
+                with open(path, "rb") as f:
+                    items.append((os.path.basename(path)[: -len(".pkl")], f.read()))
+            except OSError:
+                # migrated by a concurrent process
+                pass
+        store.put_many(items)
+        for path in batch:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    if len(paths) > 0:
+        print(f"Migrated {len(paths)} cache files to {store.path}")
+    with open(marker_path, "w") as f:
+        f.write(f"{len(paths)} files migrated at {time.time()}\n")
+    return len(paths)
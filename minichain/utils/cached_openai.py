@@ -30,10 +30,16 @@ def fix_common_errors(response: Dict[str, Any]) -> Dict[str, Any]:
 
 
 def format_history(messages: list) -> list:
-    """Format the history to be compatible with the openai api - json dumps all arguments"""
+    """Format the history to be compatible with the openai api - json dumps all arguments.
+
+    Returns copies, the messages of the history are not modified."""
+    messages = [dict(message) for message in messages]
     for i, message in enumerate(messages):
         if (function_call := message.get("function_call")) is not None:
+            function_call = dict(function_call)
+            message["function_call"] = function_call
             if function_call.get("arguments", None) is not None and isinstance(function_call["arguments"], dict):
+                function_call["arguments"] = dict(function_call["arguments"])
                 content = function_call["arguments"].pop("content", None)
                 message["content"] = content or message["content"]
                 function_call["arguments"] = json.dumps(function_call["arguments"])
@@ -125,3 +131,86 @@ async def get_openai_response_stream(
 def get_embedding(text):
     response = openai.Embedding.create(model="text-embedding-ada-002", input=text)
     return np.array(response["data"][0]["embedding"])
+
+
+class EmbeddingService:
+    """Embeds texts of concurrent callers in micro-batches.
+
+    Texts that are requested while a batch is being collected are deduplicated, and cache hits are
+    answered without a network call. A batch is sent after `max_wait` seconds or once it is full.
+    Results share the cache entries of `get_embedding`.
+    """
+    def __init__(self, model="text-embedding-ada-002", max_batch_size=256, max_wait=0.01, cache=disk_cache, tries=10):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.cache = cache
+        self.tries = tries
+        self._pending = {}
+        self._in_flight = {}
+        self._flush_handle = None
+
+    async def embed(self, texts):
+        loop = asyncio.get_running_loop()
+        futures = []
+        for text in texts:
+            future = self._pending.get(text) or self._in_flight.get(text)
+            if future is None:
+                future = loop.create_future()
+                cached = self.cache.load_from_cache(get_embedding.cache_key(text))
+                if cached is not None:
+                    future.set_result(cached)
+                else:
+                    self._pending[text] = future
+            futures.append(future)
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif len(self._pending) > 0 and self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_wait, self._flush)
+        # the futures are shared with other callers, which must not be cancelled with this one
+        return list(await asyncio.gather(*[asyncio.shield(i) for i in futures]))
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = list(self._pending.items()), {}
+        self._in_flight.update(batch)
+        for i in range(0, len(batch), self.max_batch_size):
+            texts = [text for text, _ in batch[i : i + self.max_batch_size]]
+            asyncio.ensure_future(self._request(texts))
+
+    async def _request(self, texts):
+        try:
+            embeddings = await self._create(texts)
+        except Exception as e:
+            for text in texts:
+                future = self._in_flight.pop(text)
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for text, embedding in zip(texts, embeddings):
+            self.cache.save_to_cache(get_embedding.cache_key(text), (text,), {}, embedding)
+            future = self._in_flight.pop(text)
+            if not future.done():
+                future.set_result(embedding)
+
+    async def _create(self, texts):
+        for attempt in range(self.tries):
+            try:
+                response = await openai.Embedding.acreate(model=self.model, input=texts)
+                break
+            except Exception as e:
+                if attempt == self.tries - 1:
+                    raise e
+                print("Embedding request failed, retrying...", e)
+                await asyncio.sleep(min(2 ** attempt, 60))
+        data = sorted(response["data"], key=lambda i: i["index"])
+        return [np.array(i["embedding"]) for i in data]
+
+
+embedding_service = EmbeddingService()
+
+
+async def get_embeddings(texts):
+    return await embedding_service.embed(texts)
@@ -1,46 +1,187 @@
+import asyncio
+import atexit
+import copy
 import hashlib
 import os
 import pickle
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from minichain.utils.cache_keys import ChatHistory, ChatHistoryRef, stub_structured
+from minichain.utils.cache_store import SQLiteStore, migrate_pickle_files
+
+
+class MemoryCache:
+    """In-process LRU cache of pickled values, limited by number of items and bytes.
+
+    Values are kept pickled so that callers that modify a returned value do not modify the cache.
+    """
+    def __init__(self, max_items=1024, max_bytes=64 * 2**20):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            data = self._items.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        with self._lock:
+            self._pop(key)
+            if len(data) > self.max_bytes or self.max_items == 0:
+                return
+            self._items[key] = data
+            self._bytes += len(data)
+            while len(self._items) > self.max_items or self._bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def remove(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def _pop(self, key):
+        data = self._items.pop(key, None)
+        if data is not None:
+            self._bytes -= len(data)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "items": len(self._items),
+            "bytes": self._bytes,
+        }
 
 
 class DiskCache:
-    def __init__(self, cache_dir="./.cache"):
+    """Pickles function results into `cache_dir`/cache.db, with an LRU tier in RAM in front of the database.
+
+    `max_bytes` bounds the size of the database, `ttl` (seconds) optionally expires entries.
+    Cache files of older versions (one .pkl file per key) are migrated into the database.
+    """
+    def __init__(self, cache_dir="./.cache", memory_items=1024, memory_bytes=64 * 2**20, max_bytes=2 * 2**30, ttl=None, chain_items=65536):
         self.cache_dir = cache_dir
         os.makedirs(self.cache_dir, exist_ok=True)
+        self.memory = MemoryCache(memory_items, memory_bytes)
+        self.store = SQLiteStore(os.path.join(cache_dir, "cache.db"), max_bytes=max_bytes, ttl=ttl)
+        # LRU of chain nodes that are known to be stored, so that shared prefixes are not looked up again
+        self._stored_chain = OrderedDict()
+        self.chain_items = chain_items
+        migrate_pickle_files(cache_dir, self.store)
 
     @staticmethod
     def _hash_string(string):
         return hashlib.sha256(string.encode("utf-8")).hexdigest()
 
-    def _get_cache_path(self, key):
-        return os.path.join(self.cache_dir, f"{self._hash_string(key)}.pkl")
+    @staticmethod
+    def make_key(func, args, kwargs):
+        # arguments with a cache_key method (e.g. chat histories) are represented by their key
+        args = tuple(stub_structured(i) for i in args)
+        kwargs = {key: stub_structured(value) for key, value in kwargs.items()}
+        return str(repr({"args": args, "kwargs": kwargs, "f": func.__name__}))
 
     def load_from_cache(self, key):
-        cache_path = self._get_cache_path(key)
+        data = self.memory.get(key)
         try:
-            with open(cache_path, "rb") as cache_file:
-                output = pickle.load(cache_file)
-                try:
-                    output = output.get("disk_cache_object", output)
-                except:
-                    pass
-                return output
+            if data is None:
+                data = self.store.get(self._hash_string(key))
+                if data is None:
+                    return None
+                self.memory.put(key, data)
+            output = pickle.loads(data)
+            try:
+                output = output.get("disk_cache_object", output)
+            except:
+                pass
+            return output
         except:
             return None
 
-    def save_to_cache(self, key, args, kwargs, value):
-        value = {
+    def _serialize(self, args, kwargs, value, nodes=None):
+        """Returns the pickled entry, and the new chain nodes and the heads of the chat histories in args.
+        `nodes` collects the new nodes of several entries that are stored together"""
+        nodes, heads = {} if nodes is None else nodes, []
+        args = tuple(self._store_history(i, nodes, heads) for i in args)
+        data = pickle.dumps({
             "disk_cache_object": value,
             "disk_cache_args": args,
             "disk_cache_kwargs": kwargs,
-        }
-        cache_path = self._get_cache_path(key)
-        with open(cache_path, "wb") as cache_file:
-            pickle.dump(value, cache_file)
+        })
+        return data, nodes, heads
+
+    def save_to_cache(self, key, args, kwargs, value):
+        data, nodes, heads = self._serialize(args, kwargs, value)
+        self.store.put(self._hash_string(key), data, nodes=nodes.values(), heads=heads)
+        self._remember_chain(heads)
+        self.memory.put(key, data)
+
+    def _store_history(self, value, nodes, heads):
+        """Collect the nodes of a ChatHistory that are not stored yet in `nodes`, and return a reference to it"""
+        if not isinstance(value, ChatHistory):
+            return value
+        chain = value.chain()
+        # walk back until the rest of the chain is already stored
+        for i in reversed(range(len(chain))):
+            if chain[i] in self._stored_chain:
+                # stored nodes are deleted by evictions, possibly in another process
+                if self.store.has_chain(chain[i]):
+                    self._stored_chain.move_to_end(chain[i])
+                    break
+                del self._stored_chain[chain[i]]
+            elif chain[i] in nodes or self.store.has_chain(chain[i]):
+                break
+            parent = chain[i - 1] if i > 0 else ""
+            nodes[chain[i]] = (chain[i], parent, value.message_hashes[i], pickle.dumps(value[i]))
+        heads.append(value.cache_key())
+        return ChatHistoryRef(value.cache_key(), len(value))
+
+    def _remember_chain(self, heads):
+        # a stored head implies that its whole chain is stored
+        for head in heads:
+            self._stored_chain[head] = True
+            self._stored_chain.move_to_end(head)
+        while len(self._stored_chain) > self.chain_items:
+            self._stored_chain.popitem(last=False)
+
+    def restore_args(self, args):
+        """Replace the chat history references in the args of a cache entry by the chat histories"""
+        return restore_args(self.store, args)
+
+    def save_many_to_cache(self, entries):
+        """Save {key: (args, kwargs, value)} in one transaction"""
+        items, nodes, refs = [], {}, []
+        for key, entry in entries.items():
+            data, _, heads = self._serialize(*entry, nodes=nodes)
+            items.append((key, data))
+            refs += [(self._hash_string(key), head) for head in heads]
+        self.store.put_many([(self._hash_string(key), data) for key, data in items], replace=True, nodes=nodes.values(), refs=refs)
+        self._remember_chain([head for _, head in refs])
+        for key, data in items:
+            self.memory.put(key, data)
+
+    def stats(self):
+        """Hits, misses and evictions of the in-memory tier"""
+        return self.memory.stats()
 
     def cache(self, func):
         def wrapper(*args, **kwargs):
-            key = str(repr({"args": args, "kwargs": kwargs, "f": func.__name__}))
+            key = self.make_key(func, args, kwargs)
             cached_value = self.load_from_cache(key)
             if cached_value is not None:
                 return cached_value
@@ -50,12 +191,13 @@ class DiskCache:
                 self.save_to_cache(key, args, kwargs, result)
                 return result
 
+        wrapper.cache_key = lambda *args, **kwargs: self.make_key(func, args, kwargs)
         return wrapper
 
     def invalidate(self, func, *args, **kwargs):
-        key = str(repr({"args": args, "kwargs": kwargs, "f": func.__name__}))
-        cache_path = self._get_cache_path(key)
-        os.remove(cache_path)
+        key = self.make_key(func, args, kwargs)
+        self.memory.remove(key)
+        self.store.delete(self._hash_string(key))
 
     def __call__(self, func):
         return self.cache(func)
@@ -64,26 +206,194 @@ class DiskCache:
 disk_cache = DiskCache()
 
 
+def restore_args(store, args):
+    """Replace ChatHistoryRefs in `args` by the chat histories stored in `store`"""
+    return tuple(
+        ChatHistory([pickle.loads(i) for i in store.get_chain(arg.head)]) if isinstance(arg, ChatHistoryRef) else arg
+        for arg in args
+    )
+
+
+class FanOutStream:
+    """Stream target of a call that forwards all chunks to the streams of identical concurrent calls.
+
+    Streams that subscribe late first receive the chunks they missed.
+    """
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.events = []
+        self.subscribers = []
+
+    def __getattr__(self, name):
+        # e.g. current_message of the wrapped stream
+        if name == "stream":
+            raise AttributeError(name)
+        return getattr(self.stream, name)
+
+    async def chunk(self, *args, **kwargs):
+        await self._forward("chunk", args, kwargs)
+
+    async def set(self, *args, **kwargs):
+        await self._forward("set", args, kwargs)
+
+    async def __call__(self, diff):
+        await self.chunk(diff)
+
+    async def _forward(self, method, args, kwargs):
+        event = (method, copy.deepcopy(args), copy.deepcopy(kwargs))
+        self.events.append(event)
+        if self.stream is not None:
+            await getattr(self.stream, method)(*args, **kwargs)
+        for subscriber in list(self.subscribers):
+            await self._send(subscriber, event)
+
+    async def subscribe(self, stream):
+        sent = 0
+        while sent < len(self.events):
+            await self._send(stream, self.events[sent])
+            sent += 1
+        self.subscribers.append(stream)
+
+    async def _send(self, stream, event):
+        method, args, kwargs = event
+        try:
+            await getattr(stream, method)(*copy.deepcopy(args), **copy.deepcopy(kwargs))
+        except Exception:
+            # a failing subscriber must not break the call it is subscribed to
+            traceback.print_exc()
+            if stream in self.subscribers:
+                self.subscribers.remove(stream)
+
+
+class InFlightCall:
+    def __init__(self, stream):
+        self.future = asyncio.get_running_loop().create_future()
+        self.stream = FanOutStream(stream)
+        self.streaming = stream is not None
+
+
 class AsyncDiskCache(DiskCache):
+    """Like DiskCache, and concurrent calls with the same key share one call of the cached function.
+
+    Reads and (de)serialization run in a thread pool of `io_workers` threads, so they do not block the
+    event loop. Writes return immediately and are flushed in batches every `flush_interval` seconds.
+    """
+    def __init__(self, *args, io_workers=4, flush_interval=0.05, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._in_flight = {}
+        self.io_workers = io_workers
+        self.flush_interval = flush_interval
+        self._executor = None
+        self._pending_writes = {}
+        self._flush_handle = None
+        self._flush_loop = None
+        atexit.register(self._flush_at_exit)
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.io_workers, thread_name_prefix="disk-cache")
+        return self._executor
+
+    async def aload_from_cache(self, key):
+        if key in self._pending_writes:
+            # a copy, so that callers that modify the value do not modify the entry that will be written
+            return pickle.loads(self._pending_writes[key][2])
+        return await asyncio.get_running_loop().run_in_executor(self._get_executor(), self.load_from_cache, key)
+
+    def save_later(self, key, args, kwargs, value):
+        """Write-behind save: returns immediately, the entry is written with the next batch.
+        The value is pickled now, so that later changes to it are not written"""
+        data = pickle.dumps(value)
+        self._pending_writes[key] = (args, kwargs, data)
+        self._schedule_flush()
+        return data
+
+    def _schedule_flush(self):
+        loop = asyncio.get_running_loop()
+        # a flush that was scheduled on another (e.g. closed) event loop will never run
+        if self._flush_handle is None or self._flush_loop is not loop:
+            self._flush_loop = loop
+            self._flush_handle = loop.call_later(self.flush_interval, lambda: asyncio.ensure_future(self._scheduled_flush()))
+
+    async def _scheduled_flush(self):
+        self._flush_handle = None
+        await self.flush()
+        if len(self._pending_writes) > 0:
+            self._schedule_flush()
+
+    async def flush(self):
+        """Write all pending entries"""
+        batch = dict(self._pending_writes)
+        if len(batch) == 0:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._get_executor(), self._write_pending, batch)
+        except Exception:
+            traceback.print_exc()
+        for key, entry in batch.items():
+            # keep entries that were overwritten while the batch was written
+            if self._pending_writes.get(key) is entry:
+                del self._pending_writes[key]
+
+    def _flush_at_exit(self):
+        if len(self._pending_writes) > 0:
+            self._write_pending(self._pending_writes)
+            self._pending_writes = {}
+
+    def _write_pending(self, batch):
+        self.save_many_to_cache({key: (args, kwargs, pickle.loads(data)) for key, (args, kwargs, data) in batch.items()})
+
     def cache(self, func):
         async def wrapper(*args, **kwargs):
             # special case to support streaming openai completions
             stream = kwargs.pop("stream", None)
-            key = str(repr({"args": args, "kwargs": kwargs, "f": func.__name__}))
-            cached_value = self.load_from_cache(key)
-            if cached_value is not None:
-                if stream:
-                    await stream.set(cached_value)
-                return cached_value
-            else:
-                print(f"Cache miss")
+            key = self.make_key(func, args, kwargs)
+            while True:
+                cached_value = await self.aload_from_cache(key)
+                if cached_value is not None:
+                    if stream:
+                        await stream.set(cached_value)
+                    return cached_value
+                call = self._in_flight.get(key)
+                if call is None:
+                    break
+                # an identical call is running: wait for its result instead of calling func again
+                try:
+                    if stream and call.streaming:
+                        await call.stream.subscribe(stream)
+                    # the pickled result: each waiter gets its own copy
+                    result = pickle.loads(await asyncio.shield(call.future))
+                except asyncio.CancelledError:
+                    if not call.future.cancelled():
+                        raise
+                    # the running call was cancelled, not this one: try again
+                    continue
+                if stream and not call.streaming:
+                    await stream.set(result)
+                return result
+
+            print(f"Cache miss")
+            call = InFlightCall(stream)
+            self._in_flight[key] = call
+            try:
                 if stream:
-                    result = await func(*args, **kwargs, stream=stream)
+                    result = await func(*args, **kwargs, stream=call.stream)
                 else:
                     result = await func(*args, **kwargs)
-                self.save_to_cache(key, args, kwargs, result)
+                call.future.set_result(self.save_later(key, args, kwargs, result))
                 return result
+            except asyncio.CancelledError:
+                call.future.cancel()
+                raise
+            except Exception as e:
+                call.future.set_exception(e)
+                # mark the exception as retrieved, in case no identical call is waiting for it
+                call.future.exception()
+                raise
+            finally:
+                del self._in_flight[key]
 
+        wrapper.cache_key = lambda *args, **kwargs: self.make_key(func, args, kwargs)
         return wrapper
 
 
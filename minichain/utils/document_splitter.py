@@ -1,57 +1,95 @@
-import tiktoken
+import re
+from bisect import bisect_left
 
+from minichain.utils.tokens import get_encoding
 
-def split_recursively(text, split_at=["\n"], max_length=1000):
+
+class TokenOffsets:
+    """Counts the tokens of any slice of a text, which is tokenized only once"""
+    def __init__(self, text):
+        encoding = get_encoding()
+        tokens = encoding.encode(text, disallowed_special=())
+        # character offset at which each token starts
+        _, self.offsets = encoding.decode_with_offsets(tokens)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def count(self, start, end):
+        """Number of tokens that start in text[start:end]"""
+        return bisect_left(self.offsets, end) - bisect_left(self.offsets, start)
+
+    def position(self, token):
+        return self.offsets[token] if token < len(self.offsets) else None
+
+
+def split_spans(text, split_at, max_length, tokens, start=0, end=None):
+    """Returns (start, end) spans that cover text[start:end]. Spans end after a separator of split_at[0], or are
+    split at the next separator if they have more than max_length tokens"""
+    end = len(text) if end is None else end
     if split_at == []:
-        return [text]
-    splits = []
-    for i in text.split(split_at[0]):
-        if len(tiktoken.encoding_for_model("gpt-3.5-turbo").encode(i)) > max_length:
-            # split finer using the next token
-            # print("splitting finer:", i)
-            splits += split_recursively(i, split_at[1:])
+        return [(start, end)]
+    spans = []
+    separator = split_at[0]
+    while start < end:
+        position = text.find(separator, start, end)
+        stop = end if position == -1 else position + len(separator)
+        if tokens.count(start, stop) > max_length:
+            # split finer using the next separator
+            spans += split_spans(text, split_at[1:], max_length, tokens, start, stop)
         else:
-            splits.append(i + split_at[0])
-    return splits
+            spans.append((start, stop))
+        start = stop
+    return spans
+
+
+def split_recursively(text, split_at=["\n"], max_length=1000):
+    return [text[start:end] for start, end in split_spans(text, split_at, max_length, TokenOffsets(text))]
+
+
+def force_split(text, tokens, start, end, max_length, words):
+    """Splits text[start:end] every `words` words, and pieces without whitespace every max_length tokens"""
+    boundaries = [match.start() for match in re.finditer(r"\S+", text[start:end])][words::words]
+    spans = []
+    for span_start, span_end in zip([start] + [start + i for i in boundaries], [start + i for i in boundaries] + [end]):
+        while tokens.count(span_start, span_end) > max_length:
+            cut = tokens.position(bisect_left(tokens.offsets, span_start) + max_length)
+            spans.append((span_start, cut))
+            span_start = cut
+        spans.append((span_start, span_end))
+    return spans
 
 
 def split_document(
     text, tokens=1000, overlap=100, split_at=["\n\n", "\n", ".", "?", "!"]
 ):
-    total_tokens = len(tiktoken.encoding_for_model("gpt-3.5-turbo").encode(text))
-    if total_tokens < tokens:
+    """Splits text into chunks of about `tokens` tokens. Each chunk starts with the last split of the previous
+    chunk, or with its last `overlap` words if the split is longer"""
+    token_offsets = TokenOffsets(text)
+    if len(token_offsets) < tokens:
         return [text]
-    # total_words = len(text.split())
-    # if total_words < words:
-    #     return [text]
-    splits = split_recursively(text, split_at, tokens)
-    # make sure no split is longer than the max length
-    idx = 0
-    while idx < len(splits):
-        i = splits[idx]
-        if len(tiktoken.encoding_for_model("gpt-3.5-turbo").encode(i)) > tokens:
+    spans = []
+    for start, end in split_spans(text, split_at, tokens, token_offsets):
+        if token_offsets.count(start, end) > tokens:
             # force split every overlap words
-            finer_split = []
-            for j in range(0, len(i.split(" ")), overlap):
-                finer_split.append(" ".join(i.split()[j : j + overlap]))
-            # replace the split with the finer split
-            splits = splits[:idx] + finer_split + splits[idx + 1 :]
-            idx += len(finer_split) - 1
-        idx += 1
+            spans += force_split(text, token_offsets, start, end, tokens, overlap)
+        else:
+            spans.append((start, end))
 
     merged_splits = []
-    current_chunk = ""
-    while len(splits) > 0:
-        current_split = splits.pop(0)
-
-        # Add the split to the current chunk
-        current_chunk += current_split
-
+    prefix, chunk_start, has_new_splits = "", spans[0][0], False
+    for start, end in spans:
+        has_new_splits = True
         # If the current chunk is full, add the chunk to the list of merged splits and start a new chunk
-        if len(tiktoken.encoding_for_model("gpt-3.5-turbo").encode(current_chunk)) > tokens - overlap:
-            merged_splits.append(current_chunk)
-            if len(current_split.split()) <= overlap:
-                current_chunk = current_split
+        if token_offsets.count(chunk_start, end) > tokens - overlap:
+            merged_splits.append(prefix + text[chunk_start:end])
+            words = [match.start() for match in re.finditer(r"\S+", text[start:end])]
+            if len(words) <= overlap:
+                prefix, chunk_start = "", start
             else:
-                current_chunk = "..." + " ".join(current_split.split()[-overlap:])
+                prefix, chunk_start = "...", start + words[-overlap]
+            has_new_splits = False
+    # the last chunk is not full, but contains splits that are not in the previous chunk
+    if has_new_splits:
+        merged_splits.append(prefix + text[chunk_start:])
     return merged_splits
@@ -7,6 +7,24 @@ def datetime_converter(o):
         return o.strftime("%Y-%m-%dT%H:%M:%S")
 
 
+def dumps_event(event):
+    """JSON text of an event for the clients, datetimes are formatted like datetime_converter"""
+    return json.dumps(event, default=datetime_converter)
+
+
+class EncodedEvent:
+    """An event and its JSON text, which is encoded once when the first consumer needs it"""
+    def __init__(self, event, text=None):
+        self.event = event
+        self._text = text
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = dumps_event(self.event)
+        return self._text
+
+
 def datetime_parser(dct):
     for k, v in dct.items():
         try:
@@ -0,0 +1,81 @@
+import heapq
+import math
+import re
+from collections import Counter
+
+
+def tokenize(text):
+    """Lowercased words, plus identifiers like `src/agent.py:Agent.run` or `get_embedding` as a whole"""
+    tokens = []
+    for compound in re.findall(r"[\w./:-]+", text.lower()):
+        compound = compound.strip("./:-")
+        parts = re.findall(r"[a-z0-9]+", compound)
+        if len(parts) > 1:
+            tokens.append(compound)
+        tokens += parts
+    return tokens
+
+
+class BM25Index:
+    """Inverted index that ranks documents with BM25. Documents can be added and removed at any time."""
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.values = {}
+        self._postings = {}
+        self._doc_terms = {}
+        self._doc_length = {}
+        self._total_length = 0
+
+    def __len__(self):
+        return len(self._doc_terms)
+
+    def add(self, doc_id, text, value=None):
+        if doc_id in self._doc_terms:
+            self.remove(doc_id)
+        terms = Counter(tokenize(text))
+        for term, count in terms.items():
+            self._postings.setdefault(term, {})[doc_id] = count
+        self._doc_terms[doc_id] = list(terms.keys())
+        self._doc_length[doc_id] = sum(terms.values())
+        self._total_length += self._doc_length[doc_id]
+        self.values[doc_id] = value
+
+    def remove(self, doc_id):
+        if doc_id not in self._doc_terms:
+            return
+        for term in self._doc_terms.pop(doc_id):
+            postings = self._postings[term]
+            del postings[doc_id]
+            if len(postings) == 0:
+                del self._postings[term]
+        self._total_length -= self._doc_length.pop(doc_id)
+        del self.values[doc_id]
+
+    def search(self, query, num_results=10, where=None):
+        """Returns the best (doc_id, score) pairs. `where` optionally filters by value"""
+        if len(self) == 0:
+            return []
+        average_length = self._total_length / len(self)
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if postings is None:
+                continue
+            idf = math.log(1 + (len(self) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, count in postings.items():
+                length_norm = 1 - self.b + self.b * self._doc_length[doc_id] / average_length
+                scores[doc_id] = scores.get(doc_id, 0) + idf * count * (self.k1 + 1) / (count + self.k1 * length_norm)
+        candidates = scores.items()
+        if where is not None:
+            candidates = [i for i in candidates if where(self.values[i[0]])]
+        return heapq.nlargest(num_results, candidates, key=lambda item: item[1])
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Fuse lists of ids that are ordered by relevance. Returns all ids, best first"""
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0) + 1 / (k + rank + 1)
+    return sorted(scores.keys(), key=lambda doc_id: -scores[doc_id])
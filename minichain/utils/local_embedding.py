@@ -0,0 +1,65 @@
+import zlib
+
+import numpy as np
+
+from minichain.utils.lexical_index import tokenize
+
+
+class HashingEmbedder:
+    """Embeds texts locally by hashing words and character trigrams onto `dim` signed dimensions.
+
+    Counts are weighted sublinearly (log1p) and the vectors are L2-normalized, so dot products are
+    cosine similarities. No network, GPU or fitted vocabulary is needed, and embeddings of a text never
+    change - which makes it a stand-in for the openai embeddings in offline runs and load tests.
+    """
+    def __init__(self, dim=1536, trigrams=True):
+        self.dim = dim
+        self.trigrams = trigrams
+
+    @property
+    def id(self):
+        """Identifies the embedding space, e.g. in the manifest of saved embeddings"""
+        return f"local:hashing-{self.dim}" + ("-trigrams" if self.trigrams else "")
+
+    def features(self, text):
+        tokens = tokenize(text)
+        if self.trigrams:
+            tokens += [f"#{token[i : i + 3]}" for token in tokens if len(token) > 3 for i in range(len(token) - 2)]
+        return tokens
+
+    def embed(self, texts):
+        """Returns a (len(texts), dim) float32 matrix"""
+        rows, hashes = [], []
+        for row, text in enumerate(texts):
+            features = self.features(text)
+            rows += [row] * len(features)
+            hashes += [zlib.crc32(feature.encode("utf-8")) for feature in features]
+        rows = np.array(rows, dtype=np.int64)
+        hashes = np.array(hashes, dtype=np.int64)
+        # the lowest bit decides the sign, so that collisions cancel out on average
+        signs = 1 - 2 * (hashes & 1)
+        columns = (hashes >> 1) % self.dim
+        counts = np.bincount(rows * self.dim + columns, weights=signs, minlength=len(texts) * self.dim)
+        vectors = (np.sign(counts) * np.log1p(np.abs(counts))).reshape(len(texts), self.dim)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return (vectors / norms).astype(np.float32)
+
+    def __call__(self, text):
+        return self.embed([text])[0]
+
+    async def embed_batch(self, texts):
+        return self.embed(texts)
+
+
+embedders = {
+    "openai": None,
+    "local": HashingEmbedder,
+}
+
+
+def get_embedder(name="openai", **kwargs):
+    embedder_class = embedders[name]
+    if embedder_class is None:
+        return None
+    return embedder_class(**kwargs)
@@ -0,0 +1,120 @@
+import abc
+
+import numpy as np
+
+
+class ScalarQuantizer(abc.ABC):
+    """Keeps a compact copy of the VectorDB rows for a fast, approximate first search pass.
+
+    The best rows of the first pass are re-ranked with the full-precision vectors, which can stay
+    memory-mapped on disk. Subclasses define how rows are encoded.
+    """
+    def __init__(self, initial_capacity=1024, chunk_size=256):
+        self.initial_capacity = initial_capacity
+        self.chunk_size = chunk_size
+        self.reset()
+
+    def reset(self):
+        self._codes = None
+        self._scales = None
+        self.size = 0
+
+    @property
+    def nbytes(self):
+        if self._codes is None:
+            return 0
+        return self._codes[:self.size].nbytes + (0 if self._scales is None else self._scales[:self.size].nbytes)
+
+    @abc.abstractmethod
+    def encode(self, vectors):
+        """Returns the codes and the per-row scales (or None) of float32 `vectors`"""
+
+    def _chunk_dot(self, codes, query):
+        return codes.astype(np.float32) @ query
+
+    def _grow(self, size, dim, scales):
+        capacity = max(self.initial_capacity, size, 2 * (0 if self._codes is None else len(self._codes)))
+        codes = np.zeros((capacity, dim), dtype=self.dtype)
+        if self._codes is not None:
+            codes[:self.size] = self._codes[:self.size]
+        self._codes = codes
+        if scales:
+            new_scales = np.ones(capacity, dtype=np.float32)
+            if self._scales is not None:
+                new_scales[:self.size] = self._scales[:self.size]
+            self._scales = new_scales
+
+    def add(self, start, vectors):
+        """Encode `vectors` as the rows `start, start + 1, ...`"""
+        for offset in range(0, len(vectors), self.chunk_size):
+            codes, scales = self.encode(np.asarray(vectors[offset : offset + self.chunk_size], dtype=np.float32))
+            rows = slice(start + offset, start + offset + len(codes))
+            if self._codes is None or rows.stop > len(self._codes):
+                self._grow(rows.stop, codes.shape[1], scales is not None)
+            self._codes[rows] = codes
+            if scales is not None:
+                self._scales[rows] = scales
+            self.size = max(self.size, rows.stop)
+
+    def compact(self, keep):
+        """Rows were compacted: row `i` of the rows where keep is True becomes row `i`"""
+        codes = self._codes[:len(keep)][keep]
+        self._codes[:len(codes)] = codes
+        if self._scales is not None:
+            self._scales[:len(codes)] = self._scales[:len(keep)][keep]
+        self.size = len(codes)
+
+    def dot(self, query, rows=None):
+        """Approximate scores of `query` for `rows`, or for all rows if rows is None"""
+        num_rows = self.size if rows is None else len(rows)
+        scores = np.empty(num_rows, dtype=np.float32)
+        for start in range(0, num_rows, self.chunk_size):
+            end = min(start + self.chunk_size, num_rows)
+            # small chunks stay in the CPU cache while they are converted to float32
+            chunk = slice(start, end) if rows is None else rows[start:end]
+            scores[start:end] = self._chunk_dot(self._codes[chunk], query)
+            if self._scales is not None:
+                scores[start:end] *= self._scales[chunk]
+        return scores
+
+
+class Float16Quantizer(ScalarQuantizer):
+    """Half the memory of float32 rows, with nearly identical scores"""
+    dtype = np.float16
+
+    def encode(self, vectors):
+        return vectors.astype(np.float16), None
+
+    def _chunk_dot(self, codes, query):
+        # numpy converts float16 to float32 one value at a time. Instead, the sign and the exponent and mantissa
+        # bits are moved to their float32 positions with integer operations. This leaves the exponent 112 too
+        # small, which is corrected by scaling the query
+        bits = codes.view(np.int16).astype(np.int32)
+        bits <<= 13
+        bits &= np.int32(-0x70002000)
+        return bits.view(np.float32) @ (query * np.float32(2.0**112))
+
+
+class Int8Quantizer(ScalarQuantizer):
+    """A quarter of the memory of float32 rows: each row is scaled so that its largest component is 127"""
+    dtype = np.int8
+
+    def encode(self, vectors):
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        codes = np.round(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+
+quantizers = {
+    "none": None,
+    "float16": Float16Quantizer,
+    "int8": Int8Quantizer,
+}
+
+
+def get_quantizer(name="none", **kwargs):
+    quantizer_class = quantizers[name]
+    if quantizer_class is None:
+        return None
+    return quantizer_class(**kwargs)
@@ -1,17 +1,27 @@
 import json
-
-import tiktoken
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import accumulate
 
 from minichain.dtypes import FunctionCall, SystemMessage
 from minichain.schemas import ShortenedHistory
+from minichain.utils.cache_keys import ChatHistory
+from minichain.utils.disk_cache import async_disk_cache
+from minichain.utils.tokens import get_encoding
 
 
+@lru_cache(maxsize=4096)
 def count_tokens(text):
-    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-    num_tokens = len(encoding.encode(text))
+    num_tokens = len(get_encoding().encode(text))
     return num_tokens
 
 
+def message_tokens(messages):
+    """Tokens of each message in json.dumps(messages), including the separator after it"""
+    return [count_tokens(json.dumps(message)) + 1 for message in messages]
+
+
+@async_disk_cache
 async def summarize_chunk(history):
     from minichain.agent import Agent
 
@@ -93,26 +103,27 @@ async def get_summarized_history(messages, functions, max_tokens=6000):
     assert tokens < max_tokens, f"Too many tokens in functions: {tokens} > {max_tokens}"
     # while the total token number is too large, we summarize the first max_token/2 messages and try again
     step = 1
-    function_tokens = count_tokens(json.dumps(functions))
-    while count_tokens(json.dumps(messages)) + function_tokens > max_tokens:
+    function_tokens = tokens
+    # prefix[i]: tokens of messages[:i]
+    prefix = list(accumulate(message_tokens(messages), initial=0))
+    while prefix[-1] + function_tokens > max_tokens and len(messages) > 1:
         print(
             "TOKENS",
-            count_tokens(json.dumps(messages)) + function_tokens,
+            prefix[-1] + function_tokens,
             function_tokens,
             max_tokens,
         )
         print("step", step)
         # Get as many messages as possible without exceeding the token limit. We first summarize only the first 75%, if that was not enough we summarize 87.5%, 93.75%, ...
-        for i in range(1, len(messages)):
-            if count_tokens(json.dumps(messages[:i])) > (
-                max_tokens - function_tokens
-            ) * (1 - 0.5 ** (step + 1)):
-                break
+        limit = (max_tokens - function_tokens) * (1 - 0.5 ** (step + 1))
+        i = min(max(bisect_right(prefix, limit), 1), len(messages) - 1)
         step += 1
         # Try to summarize the chunk until we get a summary that is smaller than the chunk. If we fail, increase the chunk size and try again
-        tokens_to_summarize = count_tokens(json.dumps(messages[:i]))
-        summary = await summarize_chunk(messages[:i])
-        summarized_tokens = count_tokens(json.dumps(summary))
+        tokens_to_summarize = prefix[i]
+        # summaries are cached by the content hashes of the messages
+        summary = await summarize_chunk(ChatHistory(messages[:i]))
+        summary_tokens = message_tokens(summary)
+        summarized_tokens = sum(summary_tokens)
 
         print("CHUNK TOKENS", tokens_to_summarize)
         print("MAYBE FAILED?", summarized_tokens, "/", tokens_to_summarize)
@@ -122,9 +133,13 @@ async def get_summarized_history(messages, functions, max_tokens=6000):
             continue  # with increased step, and therefore larger chunk
         # breakpoint()
         messages = summary + messages[i:]
+        summary_prefix = list(accumulate(summary_tokens, initial=0))
+        prefix = summary_prefix + [summary_prefix[-1] + j - prefix[i] for j in prefix[i + 1 :]]
 
-    if messages[-1]["content"].startswith("(summarized)"):
-        messages[-1]["content"] += "\n\nOkay let's continue with the task."
+    if (messages[-1].get("content") or "").startswith("(summarized)"):
+        # a copy: the message belongs to the caller or to a cached summary
+        last_message = dict(messages[-1], content=messages[-1]["content"] + "\n\nOkay let's continue with the task.")
+        messages = messages[:-1] + [last_message]
 
     with open(".minichain/last_summarized_history_final.json", "w") as f:
         json.dump(
@@ -1,13 +1,35 @@
-import tiktoken
 import json
+from functools import lru_cache
 
+import tiktoken
 
-def count_tokens(chat_message: dict):
-    """Counts the number of tokens in a chat message"""
-    text = chat_message["content"]
+
+@lru_cache(maxsize=None)
+def get_encoding(model="gpt-3.5-turbo"):
+    """The tiktoken encoding of `model`, loaded once per process"""
+    return tiktoken.encoding_for_model(model)
+
+
+def message_text(chat_message: dict):
+    """The text of a chat message that counts towards the context"""
+    text = chat_message.get("content") or ""
     if (function_call := chat_message.get("function_call")) is not None:
         text += json.dumps(function_call)
-    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-    num_tokens = len(encoding.encode(text, allowed_special={'<|endoftext|>'}))
-    print("Counted tokens:", num_tokens, "for message:", text[:100], "...")
-    return num_tokens
\ No newline at end of file
+    return text
+
+
+def count_tokens(chat_message: dict):
+    """Counts the number of tokens in a chat message"""
+    encoding = get_encoding()
+    return len(encoding.encode(message_text(chat_message), allowed_special={'<|endoftext|>'}))
+
+
+def count_tokens_batch(chat_messages, num_threads=8):
+    """Counts the tokens of many chat messages, encoded in parallel by tiktoken's thread pool"""
+    if len(chat_messages) == 0:
+        return []
+    encoding = get_encoding()
+    encoded = encoding.encode_batch(
+        [message_text(i) for i in chat_messages], num_threads=num_threads, allowed_special={'<|endoftext|>'}
+    )
+    return [len(i) for i in encoded]
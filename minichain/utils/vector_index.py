@@ -0,0 +1,146 @@
+import numpy as np
+
+
+def kmeans(vectors, num_clusters, iterations=10, seed=0):
+    """Spherical k-means: centroids are normalized so they can be compared by dot product"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), num_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = assign(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        empty = norms[:, 0] == 0
+        sums[~empty] /= norms[~empty]
+        # keep the previous centroid for clusters that lost all members
+        sums[empty] = centroids[empty]
+        centroids = sums
+    return centroids
+
+
+def assign(vectors, centroids, chunk_size=8192):
+    """Returns the index of the closest centroid for each vector"""
+    assignment = np.zeros(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_size):
+        scores = vectors[start : start + chunk_size] @ centroids.T
+        assignment[start : start + chunk_size] = np.argmax(scores, axis=1)
+    return assignment
+
+
+class IVFFlatIndex:
+    """Inverted file index: rows are bucketed by their closest k-means centroid.
+
+    A query is only compared with the rows in the `nprobe` buckets whose centroids are closest to it.
+    Below `exact_search_threshold` rows, the index is not trained and search falls back to exact search.
+    The centroids are retrained once the number of rows has grown by `retrain_factor`.
+    """
+    def __init__(self, nprobe=8, num_lists=None, exact_search_threshold=20000, retrain_factor=4, kmeans_iterations=10, max_train_size=65536):
+        self.nprobe = nprobe
+        self.num_lists = num_lists
+        self.exact_search_threshold = exact_search_threshold
+        self.retrain_factor = retrain_factor
+        self.kmeans_iterations = kmeans_iterations
+        self.max_train_size = max_train_size
+        self.reset()
+
+    def reset(self):
+        self.centroids = None
+        self.trained_size = 0
+        self._lists = []
+        self._row_list = np.zeros(0, dtype=np.int64)
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def needs_training(self, size):
+        if size < self.exact_search_threshold:
+            return False
+        return not self.is_trained or size >= self.retrain_factor * self.trained_size
+
+    def train(self, vectors, alive=None):
+        """Train the centroids on `vectors[alive]` and assign those rows to lists"""
+        rows = np.arange(len(vectors)) if alive is None else np.nonzero(alive)[0]
+        num_lists = self.num_lists or max(int(np.sqrt(len(rows))), 1)
+        sample = rows
+        if len(rows) > self.max_train_size:
+            sample = np.sort(np.random.default_rng(0).choice(rows, self.max_train_size, replace=False))
+        self.centroids = kmeans(np.asarray(vectors[sample]), num_lists, self.kmeans_iterations)
+        self.trained_size = len(rows)
+        self.rebuild(vectors, alive)
+
+    def rebuild(self, vectors, alive=None):
+        """Assign the rows of `vectors[alive]` to their lists"""
+        rows = np.arange(len(vectors)) if alive is None else np.nonzero(alive)[0]
+        self._row_list = np.full(len(vectors), -1, dtype=np.int64)
+        self._lists = [set() for _ in range(len(self.centroids))]
+        for start in range(0, len(rows), 65536):
+            chunk = rows[start : start + 65536]
+            self._row_list[chunk] = assign(np.asarray(vectors[chunk]), self.centroids)
+        for row in rows.tolist():
+            self._lists[self._row_list[row]].add(row)
+
+    def add(self, row, vector):
+        if not self.is_trained:
+            return
+        if row >= len(self._row_list):
+            row_list = np.full(max(2 * len(self._row_list), row + 1), -1, dtype=np.int64)
+            row_list[:len(self._row_list)] = self._row_list
+            self._row_list = row_list
+        list_id = int(np.argmax(self.centroids @ vector))
+        self._row_list[row] = list_id
+        self._lists[list_id].add(row)
+
+    def remove(self, row):
+        if not self.is_trained or row >= len(self._row_list) or self._row_list[row] < 0:
+            return
+        self._lists[self._row_list[row]].discard(row)
+        self._row_list[row] = -1
+
+    def compact(self, keep):
+        """Rows were compacted: row `i` of the rows where keep is True becomes row `i`"""
+        if not self.is_trained:
+            return
+        row_list = self._row_list[:len(keep)][keep]
+        self._row_list = row_list
+        self._lists = [set() for _ in range(len(self.centroids))]
+        for row, list_id in enumerate(row_list.tolist()):
+            if list_id >= 0:
+                self._lists[list_id].add(row)
+
+    def candidates(self, query_embeddings, size):
+        """Returns for each query the rows to compare with, or None to compare with all rows"""
+        if not self.is_trained or size < self.exact_search_threshold:
+            return [None] * len(query_embeddings)
+        nprobe = min(self.nprobe, len(self.centroids))
+        probes = np.argsort(-(query_embeddings @ self.centroids.T), axis=1)[:, :nprobe]
+        candidates = []
+        for probe in probes:
+            rows = [row for list_id in probe for row in self._lists[list_id]]
+            candidates.append(np.array(rows, dtype=np.int64))
+        return candidates
+
+    def state_dict(self):
+        return {
+            "centroids": self.centroids,
+            "trained_size": self.trained_size,
+        }
+
+    def load_state_dict(self, state, vectors, alive=None):
+        self.centroids = state["centroids"]
+        self.trained_size = state["trained_size"]
+        if self.is_trained:
+            self.rebuild(vectors, alive)
+
+
+indexes = {
+    "exact": None,
+    "ivf": IVFFlatIndex,
+}
+
+
+def get_index(name="exact", **kwargs):
+    index_class = indexes[name]
+    if index_class is None:
+        return None
+    return index_class(**kwargs)
@@ -0,0 +1,92 @@
+import copy
+import pickle
+
+from minichain.utils.cache_keys import ChatHistory, FunctionSchemas
+from minichain.utils.cached_openai import format_history
+from minichain.utils.disk_cache import DiskCache
+
+
+def get_response(history, functions, model="gpt-4"):
+    pass
+
+
+def test_chat_history_cache_key():
+    messages = [{"role": "system", "content": "hi"}, {"role": "user", "content": "x" * 10000}]
+    first = ChatHistory(messages)
+    assert first.cache_key() == ChatHistory(copy.deepcopy(messages)).cache_key()
+    assert first.cache_key() != ChatHistory(messages[:1] + [{"role": "user", "content": "y"}]).cache_key()
+
+    # the chain of the shared prefix is reused, new messages extend it
+    second = ChatHistory(messages + [{"role": "assistant", "content": "ok"}], previous=first)
+    assert second.chain()[:2] == first.chain()
+    assert second.cache_key() == ChatHistory(messages + [{"role": "assistant", "content": "ok"}]).cache_key()
+
+
+def test_make_key_uses_structural_keys():
+    history = ChatHistory([{"role": "user", "content": "x" * 10000}])
+    functions = FunctionSchemas([{"name": "return", "parameters": {}}])
+    key = DiskCache.make_key(get_response, (history, functions), {"model": "gpt-4"})
+    assert len(key) < 300 and history.cache_key() in key
+    # keys of plain arguments are unchanged
+    assert DiskCache.make_key(get_response, ("text",), {}) == str(repr({"args": ("text",), "kwargs": {}, "f": "get_response"}))
+
+
+def test_format_history_does_not_modify_messages():
+    messages = [
+        {"role": "assistant", "content": "", "function_call": {"name": "edit", "arguments": {"content": "code", "path": "a.py"}}},
+        {"role": "user", "content": "hi", "function_call": None},
+    ]
+    original = copy.deepcopy(messages)
+    formatted = format_history(messages)
+    assert messages == original
+    assert formatted[0]["content"] == "code"
+    assert formatted[0]["function_call"]["arguments"] == '{"path": "a.py"}'
+    assert "function_call" not in formatted[1]
+
+
+def test_chat_histories_are_stored_once(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    messages = [{"role": "user", "content": f"message {i}"} for i in range(10)]
+    previous = None
+    for length in range(1, 11):
+        history = ChatHistory(messages[:length], previous=previous)
+        cache.save_to_cache(f"call {length}", (history, "functions"), {}, f"response {length}")
+        previous = history
+    connection = cache.store._connection()
+    assert connection.execute("SELECT COUNT(*) FROM chain").fetchone()[0] == 10
+    assert connection.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == 10
+
+    entry = pickle.loads(cache.store.get(DiskCache._hash_string("call 4")))
+    args = cache.restore_args(entry["disk_cache_args"])
+    assert list(args[0]) == messages[:4] and args[1] == "functions"
+    assert cache.load_from_cache("call 4") == "response 4"
+
+
+def test_evicted_entries_release_their_chains(tmp_path):
+    cache = DiskCache(str(tmp_path), chain_items=4)
+    connection = cache.store._connection()
+    shared = [{"role": "system", "content": "shared prefix"}]
+    for i in range(10):
+        history = ChatHistory(shared + [{"role": "user", "content": f"conversation {i} " * 50}])
+        cache.save_to_cache(f"call {i}", (history,), {}, f"response {i}")
+    assert len(cache._stored_chain) <= 4
+    # the store size includes the chat histories
+    entries_size = connection.execute("SELECT SUM(size) FROM cache").fetchone()[0]
+    assert cache.store.size() > entries_size
+
+    cache.store.max_bytes = cache.store.size() // 2
+    cache.store.evict()
+    remaining = connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+    assert 0 < remaining < 10
+    # one node per remaining conversation, plus the shared prefix
+    assert connection.execute("SELECT COUNT(*) FROM chain").fetchone()[0] == remaining + 1
+    assert connection.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == remaining + 1
+    assert cache.load_from_cache("call 9") == "response 9"
+    entry = pickle.loads(cache.store.get(DiskCache._hash_string("call 9")))
+    assert list(cache.restore_args(entry["disk_cache_args"])[0])[0] == shared[0]
+
+    # chains that were evicted are stored again, even if they are still in the LRU of stored chains
+    history = ChatHistory(shared + [{"role": "user", "content": "conversation 0 " * 50}])
+    cache.save_to_cache("call 0", (history,), {}, "response 0")
+    entry = pickle.loads(cache.store.get(DiskCache._hash_string("call 0")))
+    assert len(cache.restore_args(entry["disk_cache_args"])[0]) == 2
@@ -1,4 +1,10 @@
-from minichain.utils.disk_cache import disk_cache
+import asyncio
+import os
+import pickle
+
+import pytest
+
+from minichain.utils.disk_cache import AsyncDiskCache, DiskCache, disk_cache
 
 
 def test_disk_cache():
@@ -14,3 +20,166 @@ def test_disk_cache():
     assert f(1) == 1
     assert f(2) == 2
     assert f(2) == 2
+
+
+def test_disk_cache_memory_tier(tmp_path):
+    cache = DiskCache(str(tmp_path), memory_items=2)
+
+    @cache
+    def f(x):
+        return [x]
+
+    assert f(1) == [1]
+    # the cached value can not be modified through a returned value
+    f(1).append(2)
+    assert f(1) == [1]
+    assert cache.stats()["hits"] == 2
+
+    # hot keys are answered without reading the database
+    store, cache.store = cache.store, None
+    assert f(1) == [1]
+    cache.store = store
+    f(2), f(3)
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["items"] == 2
+
+
+def test_disk_cache_store_eviction_and_migration(tmp_path):
+    with open(tmp_path / f"{DiskCache._hash_string('old key')}.pkl", "wb") as f:
+        pickle.dump({"disk_cache_object": "old value"}, f)
+    cache = DiskCache(str(tmp_path), memory_items=0, max_bytes=2000)
+    assert cache.load_from_cache("old key") == "old value"
+    assert not any(path.suffix == ".pkl" for path in tmp_path.iterdir())
+    # the directory is only scanned until the first migration succeeded
+    with open(tmp_path / "late.pkl", "wb") as f:
+        pickle.dump({"disk_cache_object": "late value"}, f)
+    DiskCache(str(tmp_path))
+    assert (tmp_path / "late.pkl").exists()
+    os.remove(tmp_path / "late.pkl")
+
+    for i in range(50):
+        cache.save_to_cache(f"key {i}", (), {}, os.urandom(100))
+    cache.store.evict()
+    assert cache.store.size() <= 2000
+    assert cache.load_from_cache("key 49") is not None
+    assert cache.load_from_cache("key 0") is None
+
+    cache.store.ttl = 0
+    assert cache.load_from_cache("key 49") is None
+
+
+class RecordingStream:
+    def __init__(self):
+        self.chunks = []
+        self.current_message = {}
+
+    async def chunk(self, diff):
+        self.chunks.append(diff)
+
+    async def set(self, chat):
+        self.current_message = chat
+
+
+@pytest.mark.asyncio
+async def test_async_disk_cache_single_flight(tmp_path):
+    cache = AsyncDiskCache(str(tmp_path))
+    calls = []
+
+    @cache
+    async def complete(prompt, stream=None):
+        calls.append(prompt)
+        for word in ["a", "b"]:
+            await stream.chunk(word)
+            await asyncio.sleep(0.01)
+        await stream.set(prompt.upper())
+        return prompt.upper()
+
+    streams = [RecordingStream() for _ in range(3)]
+    results = await asyncio.gather(*[complete("hi", stream=stream) for stream in streams])
+    assert results == ["HI"] * 3 and calls == ["hi"]
+    assert all(i.chunks == ["a", "b"] and i.current_message == "HI" for i in streams)
+
+
+@pytest.mark.asyncio
+async def test_async_disk_cache_single_flight_results_are_copies(tmp_path):
+    cache = AsyncDiskCache(str(tmp_path))
+
+    @cache
+    async def f(x):
+        await asyncio.sleep(0.01)
+        return {"content": x}
+
+    results = await asyncio.gather(*[f("hi") for _ in range(3)])
+    assert results == [{"content": "hi"}] * 3
+    assert len(set(id(i) for i in results)) == 3
+    results[0]["content"] = "modified"
+    assert results[1:] == [{"content": "hi"}] * 2
+
+
+@pytest.mark.asyncio
+async def test_async_disk_cache_single_flight_errors(tmp_path):
+    cache = AsyncDiskCache(str(tmp_path))
+    calls = []
+
+    @cache
+    async def fail(x):
+        calls.append(x)
+        await asyncio.sleep(0.01)
+        raise ValueError(x)
+
+    results = await asyncio.gather(fail(1), fail(1), return_exceptions=True)
+    assert len(calls) == 1 and all(isinstance(i, ValueError) for i in results)
+
+    release = asyncio.Event()
+
+    @cache
+    async def slow(x):
+        calls.append(x)
+        await release.wait()
+        return x
+
+    first = asyncio.ensure_future(slow(2))
+    await asyncio.sleep(0)
+    second = asyncio.ensure_future(slow(2))
+    await asyncio.sleep(0.01)
+    first.cancel()
+    await asyncio.sleep(0.01)
+    release.set()
+    # the waiting call takes over when the running call is cancelled
+    assert await second == 2
+    assert calls == [1, 2, 2]
+
+
+@pytest.mark.asyncio
+async def test_async_disk_cache_write_behind(tmp_path):
+    cache = AsyncDiskCache(str(tmp_path), flush_interval=0.01)
+
+    @cache
+    async def f(x):
+        return [x]
+
+    assert await asyncio.gather(*[f(i) for i in range(20)]) == [[i] for i in range(20)]
+    # writes are acknowledged before they are flushed, and pending entries are already cache hits
+    assert len(cache._pending_writes) == 20
+    assert await f(3) == [3]
+    await asyncio.sleep(0.05)
+    assert len(cache._pending_writes) == 0
+    assert DiskCache(str(tmp_path)).load_from_cache(f.cache_key(7)) == [7]
+
+
+@pytest.mark.asyncio
+async def test_async_disk_cache_pending_writes_are_copies(tmp_path):
+    cache = AsyncDiskCache(str(tmp_path), flush_interval=0.01)
+
+    @cache
+    async def f(x):
+        return [x]
+
+    result = await f(1)
+    result.append("modified by the caller")
+    hit = await f(1)
+    assert hit == [1]
+    hit.append("modified by another caller")
+    assert await f(1) == [1]
+    await cache.flush()
+    assert DiskCache(str(tmp_path)).load_from_cache(f.cache_key(1)) == [1]
@@ -0,0 +1,80 @@
+import re
+
+import pytest
+
+from minichain.utils import document_splitter
+from minichain.utils.document_splitter import split_document
+
+
+class WordEncoding:
+    """Stands in for the tiktoken encoding, which cannot be downloaded in tests: each word and the
+    whitespace before it is one token, and a token is represented by its character offset"""
+    def encode(self, text, **kwargs):
+        return [match.start() for match in re.finditer(r"\s*\S+", text)]
+
+    def decode_with_offsets(self, tokens):
+        return None, list(tokens)
+
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    monkeypatch.setattr(document_splitter, "get_encoding", lambda: WordEncoding())
+
+
+def count_tokens(text):
+    return len(WordEncoding().encode(text))
+
+
+def make_document():
+    paragraphs = []
+    for i in range(30):
+        sentences = [f"Paragraph {i}  sentence {j}\twith some  words." for j in range(i % 5 + 1)]
+        paragraphs.append("\n".join(sentences))
+    return "\n\n".join(paragraphs) + "\n\nThe last sentence"
+
+
+def test_short_documents_are_not_split():
+    assert split_document("a short  document", tokens=10, overlap=2) == ["a short  document"]
+
+
+def test_chunks_preserve_whitespace_and_fit():
+    text = make_document()
+    chunks = split_document(text, tokens=60, overlap=10)
+    assert len(chunks) > 5
+    for chunk in chunks:
+        # chunks are slices of the text, spaces, tabs and line breaks are kept as they are
+        assert chunk.removeprefix("...") in text
+        # a chunk is closed once it has more than tokens - overlap tokens, with a last split of at most tokens
+        assert count_tokens(chunk) <= 60 - 10 + 60
+
+
+def test_chunks_overlap():
+    text = make_document()
+    chunks = split_document(text, tokens=60, overlap=10)
+    for previous, chunk in zip(chunks, chunks[1:]):
+        chunk = chunk.removeprefix("...")
+        # the chunk starts with the end of the previous chunk: its last split, or its last overlap words
+        overlap = max(i for i in range(len(chunk) + 1) if previous.endswith(chunk[:i]))
+        assert 0 < count_tokens(chunk[:overlap]) <= 10
+    # all chunks together cover the text
+    position = 0
+    for chunk in chunks:
+        chunk = chunk.removeprefix("...")
+        start = text.index(chunk, max(0, position - len(chunk)))
+        assert start <= position
+        position = start + len(chunk)
+    assert position == len(text)
+
+
+def test_the_last_chunk_is_kept():
+    text = make_document()
+    chunks = split_document(text, tokens=60, overlap=10)
+    assert chunks[-1].endswith("The last sentence")
+
+
+def test_long_pieces_without_separators_are_force_split():
+    text = "intro.\n\n" + " ".join(f"word{i}" for i in range(300)) + "\n\noutro."
+    chunks = split_document(text, tokens=50, overlap=5)
+    assert all(count_tokens(chunk) <= 50 - 5 + 50 for chunk in chunks)
+    assert "word299" in chunks[-1] or "word299" in chunks[-2]
+    assert chunks[-1].endswith("outro.")
@@ -0,0 +1,52 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from minichain.utils.cached_openai import EmbeddingService
+from minichain.utils.disk_cache import DiskCache
+
+
+@pytest.mark.asyncio
+async def test_embedding_service_batches_and_deduplicates(tmp_path):
+    requests = []
+
+    async def create(texts):
+        requests.append(list(texts))
+        return [np.array([len(text), 1.0]) for text in texts]
+
+    service = EmbeddingService(cache=DiskCache(str(tmp_path)))
+    service._create = create
+
+    first, second = await asyncio.gather(
+        service.embed(["a", "bb", "a"]),
+        service.embed(["bb", "ccc"]),
+    )
+    assert requests == [["a", "bb", "ccc"]]
+    assert [i[0] for i in first] == [1, 2, 1]
+    assert [i[0] for i in second] == [2, 3]
+
+    # cache hits do not cause a request
+    await service.embed(["ccc", "a"])
+    assert len(requests) == 1
+
+
+@pytest.mark.asyncio
+async def test_cancelled_callers_do_not_cancel_others(tmp_path):
+    release = asyncio.Event()
+
+    async def create(texts):
+        await release.wait()
+        return [np.array([len(text), 1.0]) for text in texts]
+
+    service = EmbeddingService(cache=DiskCache(str(tmp_path)))
+    service._create = create
+
+    cancelled = asyncio.ensure_future(service.embed(["a", "bb"]))
+    waiting = asyncio.ensure_future(service.embed(["bb"]))
+    await asyncio.sleep(0.05)
+    cancelled.cancel()
+    await asyncio.sleep(0)
+    release.set()
+    assert [i[0] for i in await waiting] == [2]
+    assert cancelled.cancelled()
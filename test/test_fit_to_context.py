@@ -0,0 +1,75 @@
+import pytest
+
+from minichain import message_handler
+from minichain.dtypes import AssistantMessage, UserMessage
+from minichain.message_handler import OUTLINE_HEADER, MessageDB
+from minichain.utils.tokens import message_text
+
+
+def count_words(chat):
+    """Counts words and line breaks instead of tokens, because the tokenizer cannot be downloaded in tests"""
+    text = message_text(chat)
+    return len(text.split()) + text.count("\n")
+
+
+@pytest.fixture(autouse=True)
+def fake_tokens(monkeypatch):
+    monkeypatch.setattr(message_handler, "count_tokens", count_words)
+    monkeypatch.setattr(message_handler, "count_tokens_batch", lambda chats: [count_words(i) for i in chats])
+
+
+def linear_cut(messages, budget):
+    """The algorithm that fit_to_context used before: try each number of outlined messages in turn"""
+    for i in range(len(messages)):
+        outline = [UserMessage(OUTLINE_HEADER + "\n".join([j.meta['_outline'] for j in messages[:i]]))][:i]
+        total_tokens = sum(count_words(j) for j in outline) + sum(count_words(j.meta['_chat_summary']) for j in messages[i:])
+        if total_tokens < budget:
+            return i
+    return None
+
+
+@pytest.mark.asyncio
+async def test_find_cut_matches_the_linear_search(tmp_path):
+    message_db = MessageDB(save_dir=str(tmp_path))
+    conversation = await message_db.conversation()
+    for i in range(40):
+        message = UserMessage("word " * ((i * 37) % 50 + 5)) if i % 2 == 0 else AssistantMessage("word " * ((i * 11) % 30 + 5))
+        await conversation.send(message)
+    messages = conversation.messages
+    for i, message in enumerate(messages):
+        # as if to_memory was called
+        message.meta['_memories'] = []
+        message.meta['_outline'] = f"{message.chat['role']}: topic {i}"
+    total = sum(count_words(i.meta['_chat_summary']) for i in messages)
+    cuts = []
+    for budget in range(0, total + 20, 7):
+        cut = conversation._find_cut(messages, budget)
+        # the prefix sums count a line break after each outline line, which is one token more than the
+        # outline has: the result is between the linear search with this budget and with one token less
+        fewest, most = linear_cut(messages, budget), linear_cut(messages, budget - 1)
+        if cut is None:
+            assert most is None
+        else:
+            assert fewest is not None and fewest <= cut and (most is None or cut <= most)
+        cuts.append(cut)
+    assert cuts[-1] == 0 and cuts[0] is None and len(set(cuts)) > 10
+    assert all(cut is None or cut < len(messages) for cut in cuts)
+
+
+@pytest.mark.asyncio
+async def test_the_last_message_is_never_outlined(tmp_path):
+    message_db = MessageDB(save_dir=str(tmp_path))
+    conversation = await message_db.conversation(context_size=100)
+    await conversation.send(UserMessage("start"))
+    for i in range(6):
+        await conversation.send(AssistantMessage("answer " * 10))
+    await conversation.send(UserMessage("the current prompt " * 30))
+    for i, message in enumerate(conversation.messages):
+        message.meta['_memories'] = []
+        message.meta['_outline'] = f"{message.chat['role']}: t{i}"
+    messages = conversation.messages[1:]
+    # only outlining all messages would fit
+    outlined = count_words(conversation._outline(messages)[0])
+    assert conversation._find_cut(messages, outlined + 1) is None
+    history = await conversation.fit_to_context()
+    assert history[-1]["content"] == "the current prompt " * 30
@@ -0,0 +1,52 @@
+import pytest
+
+from minichain.memory import SemanticParagraphMemory
+from minichain.utils.lexical_index import BM25Index, reciprocal_rank_fusion, tokenize
+from test_vector_db import make_memory
+
+
+def test_tokenize_keeps_identifiers():
+    tokens = tokenize("See src/agent.py:Agent.run and get_embedding().")
+    assert "src/agent.py:agent.run" in tokens
+    assert "get_embedding" in tokens
+    assert "agent" in tokens and "embedding" in tokens
+
+
+def test_bm25_index_add_search_remove():
+    index = BM25Index()
+    index.add("a", "The vector database stores embeddings", "A")
+    index.add("b", "def get_embedding(text): returns the embedding of a text", "B")
+    index.add("c", "Unrelated notes about the user interface", "C")
+
+    results = index.search("get_embedding", num_results=3)
+    assert [doc_id for doc_id, _ in results] == ["b"]
+    assert index.search("embeddings database")[0][0] == "a"
+    assert index.search("the", where=lambda value: value == "C")[0][0] == "c"
+
+    index.remove("b")
+    assert index.search("get_embedding") == []
+    assert len(index) == 2
+    # re-adding a document replaces it
+    index.add("a", "user interface", "A")
+    assert set(doc_id for doc_id, _ in index.search("interface")) == {"a", "c"}
+    assert index.search("embeddings") == []
+
+
+def test_reciprocal_rank_fusion():
+    assert reciprocal_rank_fusion([["a", "b", "c"], ["b", "d"]])[0] == "b"
+    assert set(reciprocal_rank_fusion([["a"], ["d"]])) == {"a", "d"}
+
+
+@pytest.mark.asyncio
+async def test_lexical_retrieval_does_not_embed():
+    memory = SemanticParagraphMemory(auto_save_dir=None)
+    memory.retrieval = "lexical"
+    memory.vector_db.embedding_function = None
+    memory.vector_db.batch_embedding_function = None
+    memories = [make_memory("How memories are stored"), make_memory("The find_memory tool")]
+    memory.memories += memories
+    memory.add_to_lexical_index(memories)
+    results = await memory.search("find_memory", num_results=2)
+    assert [i.id for i in results] == [memories[1].id]
+    memory.forget(memories[1])
+    assert await memory.search("find_memory", num_results=2) == []
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from minichain import settings
+from minichain.memory import EmbedderMismatch, SemanticParagraphMemory, VectorDB
+from minichain.utils.local_embedding import HashingEmbedder
+from test_vector_db import make_memory
+
+
+def test_hashing_embedder():
+    embedder = HashingEmbedder(dim=256)
+    embeddings = embedder.embed(["how are memories saved", "where are memories saved?", "docker sandbox", ""])
+    assert embeddings.shape == (4, 256) and embeddings.dtype == np.float32
+    assert np.allclose(np.linalg.norm(embeddings[:3], axis=1), 1)
+    assert np.allclose(embeddings[3], 0)
+    assert embeddings[0] @ embeddings[1] > embeddings[0] @ embeddings[2]
+    # a text always has the same embedding, also in a batch
+    assert np.allclose(embedder("docker sandbox"), embeddings[2])
+
+
+def test_vector_db_with_local_embeddings():
+    embedder = HashingEmbedder()
+    vector_db = VectorDB(embedding_function=embedder, batch_embedding_function=embedder.embed_batch)
+    memories = [make_memory(title) for title in ["Saving memories to disk", "Starting the docker sandbox", "Agent system prompts"]]
+    for memory in memories:
+        vector_db.add(memory.memory.title, memory)
+    assert vector_db.search(["how is the docker container started"], num_results=1)[0].value.id == memories[1].id
+
+
+def test_embeddings_of_another_embedder_are_not_loaded(tmp_path):
+    memory_dir = str(tmp_path)
+    memories = [make_memory(title) for title in ["Saving memories to disk", "Starting the docker sandbox"]]
+    embedder = HashingEmbedder(dim=64)
+    vector_db = VectorDB(embedding_function=embedder)
+    for memory in memories:
+        vector_db.add(memory.memory.title, memory)
+    vector_db.save(memory_dir)
+
+    other_embedder = HashingEmbedder(dim=64, trigrams=False)
+    other = VectorDB(embedding_function=other_embedder)
+    by_id = {i.id: i for i in memories}
+    with pytest.raises(EmbedderMismatch):
+        other.load(memory_dir, by_id.get)
+    assert VectorDB(embedding_function=embedder).load(memory_dir, by_id.get)
+    # a store that was not loaded from memory_dir replaces its files
+    other.add(memories[0].memory.title, memories[0])
+    other.save(memory_dir)
+    with pytest.raises(EmbedderMismatch):
+        VectorDB(embedding_function=embedder).load(memory_dir, by_id.get)
+    restored = VectorDB(embedding_function=other_embedder)
+    assert restored.load(memory_dir, by_id.get) and len(restored) == 1
+
+
+def test_memories_are_embedded_again_for_another_embedder(tmp_path, monkeypatch):
+    memory_dir = str(tmp_path)
+    monkeypatch.setattr(settings, "yaml", {"memory": {"embedding": "local", "embedding_kwargs": {"dim": 64}}})
+    memory = SemanticParagraphMemory(auto_save_dir=memory_dir)
+    memories = [make_memory(title) for title in ["Saving memories to disk", "Starting the docker sandbox"]]
+    memory.memories += memories
+    memory._unsaved_memories.update({i.id: i for i in memories})
+    for key, value in memory.vector_db_items(memories):
+        memory.vector_db.add(key, value)
+    memory.save(memory_dir)
+
+    monkeypatch.setattr(settings, "yaml", {"memory": {"embedding": "local", "embedding_kwargs": {"dim": 32}}})
+    loaded = SemanticParagraphMemory(auto_save_dir=memory_dir).load(memory_dir)
+    assert len(loaded.vector_db) == 2
+    assert loaded.vector_db.search(["how is the docker container started"], num_results=1)[0].value.id == memories[1].id
+    # the saved embeddings were replaced
+    reloaded = SemanticParagraphMemory(auto_save_dir=memory_dir).load(memory_dir)
+    assert reloaded.vector_db._dim == 32 and len(reloaded.vector_db) == 2
@@ -0,0 +1,68 @@
+import pytest
+
+from minichain import message_handler
+from minichain.dtypes import AssistantMessage, UserMessage
+from minichain.message_handler import MessageDB
+from minichain.utils.tokens import message_text
+
+
+@pytest.fixture
+def counted(monkeypatch):
+    """Counts words instead of tokens, because the tokenizer cannot be downloaded in tests"""
+    calls = []
+
+    def count_tokens(chat):
+        calls.append(chat)
+        return len(message_text(chat).split())
+
+    monkeypatch.setattr(message_handler, "count_tokens", count_tokens)
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_chat_hash_and_tokens_are_memoized(tmp_path, counted):
+    message_db = MessageDB(save_dir=str(tmp_path))
+    conversation = await message_db.conversation()
+    await conversation.send(UserMessage("one two three"))
+    message = conversation.messages[-1]
+    assert message.chat_tokens() == 3
+    assert message.chat_tokens() == 3
+    assert len(counted) == 1
+    assert message.chat_hash() == message.chat_hash()
+
+
+@pytest.mark.asyncio
+async def test_memos_are_invalidated_when_the_chat_is_mutated(tmp_path, counted):
+    message_db = MessageDB(save_dir=str(tmp_path))
+    conversation = await message_db.conversation()
+    await conversation.send(UserMessage("one two three"))
+    message = conversation.messages[-1]
+    chat_hash = message.chat_hash()
+    assert message.chat_tokens() == 3
+    # the same dict, mutated in place
+    message.chat["content"] += " four"
+    assert message.chat_tokens() == 4
+    assert message.chat_hash() != chat_hash
+    message.chat["function_call"] = {"name": "f", "arguments": "{}"}
+    assert message.chat_hash() != chat_hash
+
+
+@pytest.mark.parametrize("window", [0, 10])
+@pytest.mark.asyncio
+async def test_memos_are_invalidated_when_streaming(tmp_path, counted, window):
+    message_db = MessageDB(save_dir=str(tmp_path))
+    message_db.shared["coalesce"] = (window, 1000)
+    conversation = await message_db.conversation()
+    async with conversation.to(AssistantMessage()) as stream:
+        message = conversation.messages[-1]
+        await stream.chunk("one two")
+        await stream.flush()
+        chat_hash = message.chat_hash()
+        assert message.chat_tokens() == 2
+        await stream.chunk(" three")
+        await stream.flush()
+        assert message.chat_tokens() == 3
+        assert message.chat_hash() != chat_hash
+        chat_hash = message.chat_hash()
+    assert message.chat_tokens() == 3
+    assert message.chat_hash() == chat_hash
@@ -0,0 +1,318 @@
+import asyncio
+import datetime as dt
+import json
+
+import pytest
+
+from minichain.dtypes import AssistantMessage, Cancelled, UserMessage
+from minichain.message_handler import MessageDB, StreamCollector
+from minichain.utils import json_datetime
+
+
+def make_collector(window=0.05, max_bytes=1000, on_message=None):
+    sent = []
+
+    async def collect(msg):
+        sent.append(msg)
+
+    shared = {
+        "on_message": on_message or collect,
+        "coalesce": (window, max_bytes),
+        "stream_stats": {"chunks": 0, "frames": 0},
+    }
+    return StreamCollector(path=["root", "conversation", "message"], shared=shared), sent
+
+
+@pytest.mark.asyncio
+async def test_stream_collector_merges_fields():
+    collector, sent = make_collector(window=0)
+    await collector.chunk({"role": "assistant", "content": "Hel"})
+    await collector.chunk("lo")
+    await collector.chunk({"function_call": {"name": "edit", "arguments": '{"a'}})
+    await collector.chunk({"function_call": {"arguments": '": 1}'}})
+    assert collector.current_message == {
+        "role": "assistant",
+        "content": "Hello",
+        "function_call": {"name": "edit", "arguments": '{"a": 1}'},
+    }
+    assert len(sent) == 4
+
+
+@pytest.mark.asyncio
+async def test_chunks_are_coalesced():
+    collector, sent = make_collector()
+    for i in range(100):
+        await collector.chunk(str(i % 10))
+    await collector.chunk({"function_call": {"arguments": "{}"}})
+    assert sent == []
+    # the window passes without new chunks
+    await asyncio.sleep(0.1)
+    assert len(sent) == 1
+    assert sent[0]["diff"] == {"content": "0123456789" * 10, "function_call": {"arguments": "{}"}}
+    assert collector.shared["stream_stats"] == {"chunks": 101, "frames": 1}
+
+    # chunks that exceed the byte budget are sent right away, set replaces pending chunks
+    await collector.chunk("x" * 1000)
+    await collector.chunk("y")
+    await collector.set(meta={"done": True})
+    assert len(sent) == 3
+    assert sent[1]["diff"] == {"content": "x" * 1000}
+    assert sent[2]["type"] == "set" and sent[2]["chat"]["content"].endswith("xy")
+    await asyncio.sleep(0.1)
+    assert len(sent) == 3
+
+
+@pytest.mark.asyncio
+async def test_errors_of_scheduled_flushes_are_raised():
+    async def cancelled(msg):
+        raise Cancelled()
+
+    collector, _ = make_collector(on_message=cancelled)
+    await collector.chunk("a")
+    await asyncio.sleep(0.1)
+    with pytest.raises(Cancelled):
+        await collector.chunk("b")
+
+
+@pytest.mark.asyncio
+async def test_messages_are_encoded_once_for_all_consumers(tmp_path, monkeypatch):
+    message_db = MessageDB(save_dir=str(tmp_path))
+    received, encoded = [], []
+    dumps_event = json_datetime.dumps_event
+
+    def counting_dumps(event):
+        encoded.append(event)
+        return dumps_event(event)
+
+    async def consume(text):
+        received.append(text)
+
+    monkeypatch.setattr(json_datetime, "dumps_event", counting_dumps)
+    queues = [message_db.add_consumer(consume, "conversation", encoded=True) for _ in range(3)]
+    queues.append(message_db.add_consumer(consume, "message", encoded=True))
+    timestamp = dt.datetime(2023, 1, 2)
+    await message_db.on_message({"type": "set", "id": "message", "path": ["root", "conversation", "message"], "meta": {"timestamp": timestamp}})
+    await message_db.drain()
+    for queue in queues:
+        queue.close()
+    assert len(encoded) == 1 and len(received) == 4
+    assert json.loads(received[0])["meta"]["timestamp"] == "2023-01-02T00:00:00"
+
+
+def chunk(text, msg_id="message"):
+    return {"type": "chunk", "id": msg_id, "diff": {"content": text}}
+
+
+async def slow_consumer(message_db, received, release, **kwargs):
+    async def consume(msg):
+        await release.wait()
+        received.append(msg)
+
+    return message_db.add_consumer(consume, "conversation", **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_slow_consumers_do_not_block_producers(tmp_path):
+    message_db = MessageDB(save_dir=str(tmp_path))
+    fast, slow, release = [], [], asyncio.Event()
+
+    async def consume(msg):
+        fast.append(msg)
+
+    fast_queue = message_db.add_consumer(consume, "conversation")
+    slow_queue = await slow_consumer(message_db, slow, release, max_size=5, overflow="coalesce")
+    await message_db.send_to_consumers("conversation", {"type": "set", "id": "message", "chat": {"content": ""}})
+    for i in range(20):
+        await message_db.send_to_consumers("conversation", chunk(str(i % 10)))
+    await asyncio.sleep(0.01)
+    assert len(fast) == 21
+    assert slow_queue.get_stats()["queued"] <= 5 and slow_queue.get_stats()["lag"] > 0
+    release.set()
+    await message_db.drain()
+    # the first message was already being sent when the others were coalesced
+    assert slow[0]["type"] == "set"
+    assert "".join(i["diff"]["content"] for i in slow[1:]) == "01234567890123456789"
+    assert message_db.consumer_stats()["conversation"][1]["coalesced"] > 0
+    fast_queue.close()
+    slow_queue.close()
+
+
+@pytest.mark.asyncio
+async def test_overflow_policies(tmp_path):
+    message_db = MessageDB(save_dir=str(tmp_path))
+    received, release = [], asyncio.Event()
+    queue = await slow_consumer(message_db, received, release, max_size=3, overflow="drop", encoded=True)
+    # only consecutive events of a message are collapsed
+    for msg_id in ["b", "a"]:
+        await message_db.on_message({"type": "set", "id": msg_id, "path": ["conversation", msg_id], "chat": {"content": "x"}})
+    for i in range(10):
+        await message_db.on_message(dict(chunk("y", "a"), path=["conversation", "a"]))
+    release.set()
+    await message_db.drain()
+    messages = [json.loads(i) for i in received]
+    final = [i for i in messages if i["id"] == "a"][-1]
+    assert final["type"] == "set" and final["chat"]["content"] == "x" + "y" * 10
+    assert queue.get_stats()["dropped"] > 0
+    queue.close()
+
+    queue = await slow_consumer(message_db, [], asyncio.Event(), max_size=3, overflow="disconnect")
+    for i in range(5):
+        await message_db.send_to_consumers("conversation", chunk("y"))
+    assert queue.closed
+    await asyncio.wait_for(queue.drain(), 1)
+    assert message_db.consumer_stats() == {}
+
+
+@pytest.mark.asyncio
+async def test_reconnecting_clients_get_missed_events(tmp_path):
+    message_db = MessageDB(save_dir=str(tmp_path))
+    message_db.streaming_settings = {"coalesce_window": 0, "replay_buffer_bytes": 2000}
+    message_db.shared["coalesce"] = (0, 0)
+    conversation = await message_db.conversation()
+    conversation_id = conversation.path[-1]
+    await conversation.send(UserMessage("before"))
+
+    async def connect(**handshake):
+        received = []
+
+        async def consume(text):
+            received.append(json.loads(text))
+
+        queue = message_db.subscribe(consume, conversation_id, **handshake)
+        await queue.drain()
+        return queue, received
+
+    queue, received = await connect()
+    sync, last_seen_seq = received[0], received[-1]["seq"]
+    assert sync["type"] == "sync" and sync["full"]
+    assert [i["chat"]["content"] for i in received[1:]] == ["before"]
+    queue.close()
+
+    # the client is offline
+    async with conversation.to(AssistantMessage()) as stream:
+        await stream.chunk("missed")
+    queue, received = await connect(last_seen_seq=last_seen_seq, epoch=sync["epoch"])
+    assert not received[0]["full"]
+    assert [i["type"] for i in received[1:]] == ["set", "chunk", "set"]
+    assert all(i["seq"] > last_seen_seq for i in received[1:])
+    queue.close()
+
+    # clients of another epoch, and clients that missed more events than the log keeps, get everything
+    queue, received = await connect(last_seen_seq=last_seen_seq, epoch="restarted")
+    assert received[0]["full"] and len(received) == 3
+    queue.close()
+    for i in range(5):
+        await conversation.send(UserMessage(str(i)))
+    queue, received = await connect(last_seen_seq=last_seen_seq, epoch=sync["epoch"])
+    assert received[0]["full"] and len(received) == 8
+    queue.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("overflow", ["coalesce", "drop"])
+async def test_clients_that_reconnect_after_an_overflow_apply_no_event_twice(tmp_path, overflow):
+    message_db = MessageDB(save_dir=str(tmp_path))
+    conversation = await message_db.conversation()
+    conversation_id = conversation.path[-1]
+    received, release = [], asyncio.Event()
+
+    async def consume(text):
+        await release.wait()
+        received.append(json.loads(text))
+
+    queue = message_db.subscribe(consume, conversation_id, max_size=6, overflow=overflow)
+    for msg_id in ["a", "b"]:
+        await message_db.on_message({"type": "set", "id": msg_id, "path": [conversation_id, msg_id], "chat": {"content": ""}})
+    # interleaved streams of two messages
+    for start in [0, 5]:
+        for msg_id in ["a", "b"]:
+            for i in range(start, start + 5):
+                await message_db.on_message(dict(chunk(str(i), msg_id), path=[conversation_id, msg_id]))
+    release.set()
+    await queue.drain()
+    assert queue.get_stats()["coalesced"] + queue.get_stats()["dropped"] > 0
+    queue.close()
+
+    def apply(content, msg):
+        if msg["type"] == "set":
+            content[msg["id"]] = msg["chat"]["content"]
+        elif msg["type"] == "chunk":
+            content[msg["id"]] += msg["diff"]["content"]
+
+    # the client may disconnect after any event, and reconnects with the last seq it saw like the UI
+    for delivered in range(1, len(received) + 1):
+        content = {}
+        for msg in received[:delivered]:
+            apply(content, msg)
+        last_seen_seq = received[delivered - 1]["seq"]
+        for msg, text in message_db.event_logs[conversation_id].since(last_seen_seq):
+            apply(content, json.loads(text))
+        assert content == {"a": "0123456789", "b": "0123456789"}
+
+
+@pytest.mark.parametrize("window", [0, 10])
+@pytest.mark.asyncio
+async def test_clients_that_connect_mid_stream_get_the_whole_message(tmp_path, window):
+    message_db = MessageDB(save_dir=str(tmp_path))
+    message_db.shared["coalesce"] = (window, 1000)
+    conversation = await message_db.conversation()
+    received = []
+
+    async def consume(text):
+        received.append(json.loads(text))
+
+    async with conversation.to(AssistantMessage()) as stream:
+        await stream.chunk("hello ")
+        await stream.flush()
+        # with coalescing, this chunk is still pending when the client connects
+        await stream.chunk("wor")
+        queue = message_db.subscribe(consume, conversation.path[-1])
+        await queue.drain()
+        await stream.chunk("ld!")
+        await stream.flush()
+        await queue.drain()
+        # the set event at the end of the stream would hide lost text
+        content = None
+        for msg in received:
+            if msg["type"] == "set" and "chat" in msg:
+                content = msg["chat"].get("content")
+            elif msg["type"] == "chunk":
+                content = (content or "") + msg["diff"].get("content", "")
+        assert content == "hello world!"
+    queue.close()
+
+
+@pytest.mark.asyncio
+async def test_event_logs_of_idle_conversations_are_released(tmp_path):
+    message_db = MessageDB(save_dir=str(tmp_path))
+    message_db.streaming_settings = {"replay_idle_timeout": 60}
+    conversation = await message_db.conversation()
+    conversation_id = conversation.path[-1]
+
+    async def consume(text):
+        pass
+
+    queue = message_db.subscribe(consume, conversation_id)
+    await queue.drain()
+    last_seen_seq = message_db._seq
+    now = message_db._logs_checked
+    message_db.release_idle_logs(now + 100)
+    assert conversation_id in message_db.event_logs
+    queue.close()
+    message_db.release_idle_logs(now + 200)
+    assert conversation_id in message_db.event_logs
+    message_db.release_idle_logs(now + 300)
+    assert conversation_id not in message_db.event_logs
+
+    # a client that reconnects after the log was released gets the full state
+    await conversation.send(UserMessage("missed"))
+    received = []
+
+    async def reconnect(text):
+        received.append(json.loads(text))
+
+    queue = message_db.subscribe(reconnect, conversation_id, last_seen_seq=last_seen_seq, epoch=message_db.epoch)
+    await queue.drain()
+    assert received[0]["full"]
+    assert [i["chat"]["content"] for i in received[1:]] == ["missed"]
+    queue.close()
@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from minichain.utils import summarize_history
+from minichain.utils.summarize_history import get_summarized_history
+
+
+def count_words(text):
+    """Counts words instead of tokens, because the tokenizer cannot be downloaded in tests"""
+    return len(text.split())
+
+
+@pytest.fixture
+def summarizer(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / ".minichain").mkdir()
+    monkeypatch.setattr(summarize_history, "count_tokens", count_words)
+    chunks = []
+    summary = [{"role": "assistant", "content": "(summarized):\nshort"}]
+
+    async def summarize_chunk(history):
+        chunks.append(list(history))
+        # like a cache hit, the same object is returned for every call
+        return summary
+
+    monkeypatch.setattr(summarize_history, "summarize_chunk", summarize_chunk)
+    return chunks, summary
+
+
+def make_messages():
+    return [{"role": "system", "content": "the task"}] + [
+        {"role": "user" if i % 2 else "assistant", "content": "word " * (i * 7 % 40 + 5)} for i in range(30)
+    ]
+
+
+def linear_chunk_length(messages, limit):
+    """How the chunk was selected before prefix sums: the first prefix that exceeds the limit"""
+    for i in range(1, len(messages)):
+        if sum(count_words(json.dumps(message)) + 1 for message in messages[:i]) > limit:
+            break
+    return i
+
+
+@pytest.mark.asyncio
+async def test_chunk_selection(summarizer):
+    chunks, summary = summarizer
+    messages = make_messages()
+    original = json.loads(json.dumps(messages))
+    max_tokens = 400
+    result = await get_summarized_history(messages, [], max_tokens=max_tokens)
+    assert messages == original
+
+    # replay the summarization with the linear chunk selection
+    expected, history, step = [], list(original), 1
+    while sum(count_words(json.dumps(i)) + 1 for i in history) + count_words("[]") > max_tokens and len(history) > 1:
+        i = linear_chunk_length(history, (max_tokens - count_words("[]")) * (1 - 0.5 ** (step + 1)))
+        step += 1
+        expected.append(len(history[:i]))
+        history = summary + history[i:]
+    assert [len(i) for i in chunks] == expected and len(expected) > 1
+    assert len(result) == len(history)
+    assert sum(count_words(json.dumps(i)) + 1 for i in result) <= max_tokens
+
+
+@pytest.mark.asyncio
+async def test_summaries_and_messages_are_not_modified(summarizer):
+    chunks, summary = summarizer
+    messages = make_messages()
+    messages[-1] = {"role": "assistant", "content": "(summarized):\nthe last message"}
+    original = json.loads(json.dumps(messages))
+    result = await get_summarized_history(messages, [], max_tokens=400)
+    assert result[-1]["content"].endswith("Okay let's continue with the task.")
+    assert messages == original
+    assert summary == [{"role": "assistant", "content": "(summarized):\nshort"}]
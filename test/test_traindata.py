@@ -0,0 +1,61 @@
+import json
+import os
+import pickle
+
+from minichain.finetune.traindata import export_conversations
+from minichain.utils.cache_keys import ChatHistory
+from minichain.utils.disk_cache import DiskCache
+
+
+def read_shards(out_dir):
+    conversations = []
+    for file in sorted(os.listdir(out_dir)):
+        if file.startswith("cache-"):
+            with open(os.path.join(out_dir, file)) as f:
+                conversations += [json.loads(line) for line in f]
+    return conversations
+
+
+def test_export_conversations(tmp_path):
+    cache_path = str(tmp_path / ".cache")
+    cache = DiskCache(cache_path)
+    system = {"role": "system", "content": "You are the Programmer"}
+    messages = [system] + [{"role": "user", "content": f"message {i}"} for i in range(4)]
+    previous = None
+    for length in [2, 3, 5]:
+        history = ChatHistory(messages[:length], previous=previous)
+        kwargs = {"model": "gpt-4-0613"}
+        cache.save_to_cache(f"call {length}", (history, [{"name": "edit"}]), kwargs, {"content": f"response {length}"})
+        previous = history
+    other = ChatHistory([{"role": "system", "content": "You are the Planner"}, messages[1]])
+    cache.save_to_cache("other", (other, []), {"model": "gpt-3.5-turbo"}, {"content": "planned"})
+
+    out_dir = str(tmp_path / "out")
+    # the shorter programmer calls are prefixes of the longest one
+    assert export_conversations([cache_path], out_dir, workers=2) == 2
+    conversations = read_shards(out_dir)
+    assert sorted(i["num_messages"] for i in conversations) == [2, 5]
+    longest = next(i for i in conversations if i["num_messages"] == 5)
+    assert longest["history"] == messages and longest["functions"] == [{"name": "edit"}]
+    assert longest["response"] == {"content": "response 5"}
+
+    # existing shards are not exported again
+    assert export_conversations([cache_path], out_dir, workers=2) == 0
+
+    filtered_dir = str(tmp_path / "filtered")
+    assert export_conversations([cache_path], filtered_dir, agent="Programmer", dedupe=False, workers=2) == 3
+    assert export_conversations([cache_path], str(tmp_path / "model"), model="gpt-3.5-turbo", workers=2) == 1
+
+
+def test_export_legacy_pickle_files(tmp_path):
+    # a cache of an older version: one pickle file per key, not migrated yet
+    cache_path = tmp_path / ".cache"
+    cache_path.mkdir()
+    for i in range(20):
+        history = [{"role": "system", "content": "You are the Programmer"}, {"role": "user", "content": f"task {i}"}]
+        entry = {"disk_cache_object": {"content": f"done {i}"}, "disk_cache_args": (history, []), "disk_cache_kwargs": {}}
+        with open(cache_path / f"{DiskCache._hash_string(f'call {i}')}.pkl", "wb") as f:
+            pickle.dump(entry, f)
+    out_dir = str(tmp_path / "out")
+    assert export_conversations([str(cache_path)], out_dir, workers=2) == 20
+    assert sorted(i["response"]["content"] for i in read_shards(out_dir)) == sorted(f"done {i}" for i in range(20))
@@ -0,0 +1,310 @@
+import hashlib
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from minichain import settings
+from minichain.memory import MemoryList, SemanticParagraphMemory, VectorDB
+from minichain.tools.text_to_memory import Memory, MemoryMeta, MemoryWithMeta
+from minichain.utils.quantization import Float16Quantizer, Int8Quantizer
+from minichain.utils.vector_index import IVFFlatIndex
+
+
+def fake_embedding(text):
+    seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:8], 16)
+    vector = np.random.default_rng(seed).normal(size=32)
+    return vector / np.linalg.norm(vector)
+
+
+def make_memory(title):
+    return MemoryWithMeta(
+        memory=Memory(start_line=1, end_line=1, title=title, relevant_questions=[], context=None, type="content"),
+        meta=MemoryMeta(source="test", content=title, watch_source=False),
+    )
+
+
+def test_vector_db_search_and_remove():
+    vector_db = VectorDB(embedding_function=fake_embedding, initial_capacity=2)
+    memories = [make_memory(f"memory {i}") for i in range(10)]
+    for memory in memories:
+        vector_db.add(memory.memory.title, memory)
+        vector_db.add(f"question about {memory.memory.title}", memory)
+    assert len(vector_db) == 20
+
+    results = vector_db.search(["memory 3"], num_results=3)
+    assert results[0].value.id == memories[3].id
+    assert len(set(i.value.id for i in results)) == len(results)
+
+    vector_db.remove_value(memories[3])
+    assert len(vector_db) == 18
+    assert memories[3].id not in [i.value.id for i in vector_db.search(["memory 3"], num_results=18)]
+
+    vector_db.remove_key("memory 4")
+    assert len(vector_db) == 17
+    results = vector_db.search(["memory 4"], num_results=17)
+    assert memories[4].id in [i.value.id for i in results]
+    assert all(i.score < 0.99 for i in results)
+
+
+def test_vector_db_set_items_roundtrip():
+    vector_db = VectorDB(embedding_function=fake_embedding)
+    memories = [make_memory(f"memory {i}") for i in range(5)]
+    for memory in memories:
+        vector_db.add(memory.memory.title, memory)
+    restored = VectorDB(embedding_function=fake_embedding)
+    restored.set_items(vector_db.keys, vector_db.values)
+    assert len(restored) == 5
+    assert restored.search(["memory 2"], num_results=1)[0].value.id == memories[2].id
+
+
+@pytest.mark.asyncio
+async def test_vector_db_add_batch_embeds_once():
+    calls = []
+
+    async def batch_embedding(texts):
+        calls.append(texts)
+        return [fake_embedding(text) for text in texts]
+
+    vector_db = VectorDB(embedding_function=fake_embedding, batch_embedding_function=batch_embedding)
+    memories = [make_memory(f"memory {i}") for i in range(4)]
+    await vector_db.add_batch([(i.memory.title, i) for i in memories])
+    assert len(calls) == 1 and len(vector_db) == 4
+    results = await vector_db.asearch(["memory 1"], num_results=1)
+    assert results[0].value.id == memories[1].id
+
+
+def test_vector_db_ivf_index():
+    index = IVFFlatIndex(nprobe=4, num_lists=4, exact_search_threshold=50)
+    vector_db = VectorDB(embedding_function=fake_embedding, index=index)
+    memories = [make_memory(f"memory {i}") for i in range(100)]
+    for memory in memories:
+        vector_db.add(memory.memory.title, memory)
+    assert index.is_trained
+    # with nprobe == num_lists, the approximate search is exact
+    assert vector_db.search(["memory 42"], num_results=1)[0].value.id == memories[42].id
+
+    vector_db.remove_value(memories[10])
+    assert vector_db.search(["memory 11"], num_results=1)[0].value.id == memories[11].id
+
+    restored = VectorDB(embedding_function=fake_embedding, index=IVFFlatIndex(nprobe=4, exact_search_threshold=50))
+    restored.set_items(vector_db.keys, vector_db.values, vector_db.index.state_dict())
+    assert len(restored.index.centroids) == 4
+    assert restored.search(["memory 7"], num_results=1)[0].value.id == memories[7].id
+
+
+def test_vector_db_save_load_compact(tmp_path):
+    memory_dir = str(tmp_path)
+    vector_db = VectorDB(embedding_function=fake_embedding)
+    memories = [make_memory(f"memory {i}") for i in range(6)]
+    for memory in memories[:3]:
+        vector_db.add(memory.memory.title, memory)
+    vector_db.save(memory_dir)
+    # the second save only appends the changes
+    for memory in memories[3:]:
+        vector_db.add(memory.memory.title, memory)
+    vector_db.remove_value(memories[1])
+    vector_db.save(memory_dir)
+
+    by_id = {i.id: i for i in memories}
+    restored = VectorDB(embedding_function=fake_embedding)
+    assert restored.load(memory_dir, by_id.get)
+    assert len(restored) == 5
+    assert restored.search(["memory 4"], num_results=1)[0].value.id == memories[4].id
+    assert memories[1].id not in [i.value.id for i in restored.search(["memory 1"], num_results=5)]
+
+    # rows of the memory-mapped base and of the in-memory tail are searched together
+    new_memory = make_memory("memory 6")
+    by_id[new_memory.id] = new_memory
+    restored.add("memory 6", new_memory)
+    restored.remove_key("memory 0")
+    restored.save(memory_dir)
+    restored.compact_files(memory_dir)
+    compacted = VectorDB(embedding_function=fake_embedding)
+    compacted.load(memory_dir, by_id.get)
+    assert len(compacted) == 5
+    assert compacted.search(["memory 5"], num_results=1)[0].value.id == memories[5].id
+    assert not VectorDB(embedding_function=fake_embedding).load(str(tmp_path / "empty"), by_id.get)
+
+
+def test_vector_db_partitions():
+    vector_db = VectorDB(
+        embedding_function=fake_embedding,
+        index=IVFFlatIndex(nprobe=2, num_lists=4, exact_search_threshold=20),
+        partition_by={"type": lambda v: v.memory.type, "scope": lambda v: v.meta.scope},
+    )
+    memories = [make_memory(f"memory {i}") for i in range(60)]
+    for i, memory in enumerate(memories):
+        memory.meta.scope = "root" if i % 10 == 0 else f"conversation {i % 3}"
+        memory.memory.type = "content" if i % 20 != 0 else "file"
+        vector_db.add(memory.memory.title, memory)
+
+    results = vector_db.search(["memory 1"], num_results=60, where={"scope": "root"})
+    assert sorted(i.value.id for i in results) == sorted(memories[i].id for i in range(0, 60, 10))
+    results = vector_db.search(["memory 1"], num_results=60, where={"scope": ["root"], "type": "content"})
+    assert sorted(i.value.id for i in results) == sorted(memories[i].id for i in [10, 30, 50])
+    assert vector_db.search(["memory 1"], where={"scope": "unknown"}) == []
+
+    # large partitions are filtered after the index selected candidates
+    results = vector_db.search(["memory 4"], num_results=1, where={"type": "content"})
+    assert results[0].value.id == memories[4].id
+    vector_db.remove_value(memories[10])
+    results = vector_db.search(["memory 10"], num_results=60, where={"scope": "root"})
+    assert memories[10].id not in [i.value.id for i in results]
+
+
+@pytest.mark.parametrize("quantizer_class", [Float16Quantizer, Int8Quantizer])
+def test_vector_db_quantized_search(tmp_path, quantizer_class):
+    vector_db = VectorDB(embedding_function=fake_embedding, quantizer=quantizer_class(initial_capacity=4))
+    memories = [make_memory(f"memory {i}") for i in range(50)]
+    for memory in memories:
+        vector_db.add(memory.memory.title, memory)
+    results = vector_db.search(["memory 7"], num_results=3)
+    assert results[0].value.id == memories[7].id
+    # scores are re-ranked with the full-precision embeddings
+    assert abs(results[0].score - 1) < 1e-5
+
+    vector_db.save(str(tmp_path))
+    restored = VectorDB(embedding_function=fake_embedding, quantizer=quantizer_class())
+    restored.load(str(tmp_path), {i.id: i for i in memories}.get)
+    assert restored.quantizer.nbytes < restored._base.nbytes
+    assert restored.search(["memory 33"], num_results=1)[0].value.id == memories[33].id
+
+
+def test_vector_db_compacts_removed_rows(tmp_path):
+    vector_db = VectorDB(
+        embedding_function=fake_embedding,
+        index=IVFFlatIndex(nprobe=4, num_lists=4, exact_search_threshold=10),
+        quantizer=Int8Quantizer(),
+        partition_by={"scope": lambda v: v.meta.scope},
+    )
+    vector_db.compaction_min_dead = 4
+    memories = [make_memory(f"memory {i}") for i in range(20)]
+    for memory in memories:
+        vector_db.add(memory.memory.title, memory)
+        vector_db.add(f"question about {memory.memory.title}", memory)
+    vector_db.save(str(tmp_path))
+    for memory in memories[:12]:
+        vector_db.remove_value(memory)
+    # after 10 removed memories, the 20 removed rows were dropped from RAM and the remaining rows moved up
+    assert vector_db._size == 20
+    assert len(vector_db) == 16
+    results = vector_db.search(["memory 15"], num_results=1, where={"scope": "root"})
+    assert results[0].value.id == memories[15].id
+    assert memories[3].id not in [i.value.id for i in vector_db.search(["memory 3"], num_results=16)]
+
+    vector_db.add("memory 20", make_memory("memory 20"))
+    vector_db.save(str(tmp_path))
+    restored = VectorDB(embedding_function=fake_embedding)
+    assert restored.load(str(tmp_path), {i.id: i for i in vector_db.values.values()}.get)
+    assert len(restored) == 17
+
+
+def test_memory_list():
+    memories = [make_memory(f"memory {i}") for i in range(5)]
+    memory_list = MemoryList(memories, min_dead=2)
+    memory_list.remove(memories[1])
+    assert len(memory_list) == 4 and memories[1] not in memory_list
+    assert memory_list.get(memories[2].id) is memories[2]
+    with pytest.raises(ValueError):
+        memory_list.remove(memories[1])
+    memory_list.remove(memories[3])
+    memory_list += [make_memory("memory 5")]
+    assert [i.memory.title for i in memory_list] == ["memory 0", "memory 2", "memory 4", "memory 5"]
+    assert memory_list.get(memories[4].id) is memories[4]
+
+
+def test_float16_scores_match_the_float32_conversion():
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(300, 32)).astype(np.float32) * 0.05
+    # zeros, subnormal float16 values and negative values
+    vectors[:, :4] = 0
+    vectors[:, 4:8] = rng.choice([-1, 1], size=(300, 4)) * 3e-6
+    quantizer = Float16Quantizer()
+    quantizer.add(0, vectors)
+    query = rng.normal(size=32).astype(np.float32)
+    expected = vectors.astype(np.float16).astype(np.float32) @ query
+    assert np.allclose(quantizer.dot(query), expected, rtol=1e-5, atol=1e-6)
+    assert np.allclose(quantizer.dot(query, np.array([5, 3, 299])), expected[[5, 3, 299]], rtol=1e-5, atol=1e-6)
+
+
+def test_vector_db_replaces_files_it_was_not_loaded_from(tmp_path):
+    memory_dir = str(tmp_path)
+    memories = [make_memory(f"memory {i}") for i in range(4)]
+    by_id = {i.id: i for i in memories}
+    vector_db = VectorDB(embedding_function=fake_embedding)
+    for memory in memories[:2]:
+        vector_db.add(memory.memory.title, memory)
+    vector_db.save(memory_dir)
+
+    fresh = VectorDB(embedding_function=fake_embedding)
+    for memory in memories[2:]:
+        fresh.add(memory.memory.title, memory)
+    # removing a row that was never saved writes no tombstone
+    fresh.remove_value(memories[3])
+    fresh.save(memory_dir)
+    assert fresh._disk_records == 1 and fresh._disk_dead == 0
+    restored = VectorDB(embedding_function=fake_embedding)
+    restored.load(memory_dir, by_id.get)
+    assert set(i.id for i in restored.values.values()) == {memories[2].id}
+
+    # removing a saved row writes a tombstone, which makes itself and the saved record obsolete
+    restored.remove_value(memories[2])
+    restored.save(memory_dir)
+    assert restored._disk_records == 2 and restored._disk_dead == 2
+
+
+def test_memory_log_is_replaced_by_memories_that_were_not_loaded_from_it(tmp_path, monkeypatch):
+    memory_dir = str(tmp_path)
+    monkeypatch.setattr(settings, "yaml", {"memory": {"embedding": "local", "embedding_kwargs": {"dim": 32}}})
+    memory = SemanticParagraphMemory(auto_save_dir=memory_dir)
+    memory.memories += [make_memory("old memory")]
+    memory.save(memory_dir)
+
+    fresh = SemanticParagraphMemory(auto_save_dir=memory_dir)
+    kept, forgotten = make_memory("kept"), make_memory("forgotten before the first save")
+    for i in [kept, forgotten]:
+        fresh.memories += [i]
+        fresh._unsaved_memories[i.id] = i
+    fresh.forget(forgotten)
+    fresh.save(memory_dir)
+    assert fresh._memory_log_records == 1 and fresh._memory_log_dead == 0
+    loaded = SemanticParagraphMemory(auto_save_dir=memory_dir).load(memory_dir)
+    assert [i.id for i in loaded.memories] == [kept.id]
+
+
+def test_saves_during_compaction_are_not_lost(tmp_path, monkeypatch):
+    memory_dir = str(tmp_path)
+    monkeypatch.setattr(settings, "yaml", {"memory": {"embedding": "local", "embedding_kwargs": {"dim": 32}}})
+    memory = SemanticParagraphMemory(auto_save_dir=memory_dir)
+    memories = [make_memory(f"memory {i}") for i in range(2)]
+
+    def add(memory_to_add):
+        memory.memories += [memory_to_add]
+        memory._unsaved_memories[memory_to_add.id] = memory_to_add
+        memory.vector_db.add(memory_to_add.memory.title, memory_to_add)
+
+    add(memories[0])
+    memory.save(memory_dir)
+
+    # a compaction in a background thread holds the locks of both files
+    started, compaction_done = threading.Event(), threading.Event()
+
+    def compact():
+        with memory.vector_db._lock, memory._lock:
+            started.set()
+            time.sleep(0.2)
+            compaction_done.set()
+
+    thread = threading.Thread(target=compact)
+    thread.start()
+    started.wait()
+    add(memories[1])
+    memory.save(memory_dir)
+    assert compaction_done.is_set()
+    thread.join()
+
+    loaded = SemanticParagraphMemory(auto_save_dir=memory_dir).load(memory_dir)
+    assert sorted(i.id for i in loaded.memories) == sorted(i.id for i in memories)
+    assert len(loaded.vector_db) == 2